@@ -6,8 +6,24 @@ class conexion:
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     LOGIN_DISABLED = False
 
+    # Perfil del pool de conexiones (solo aplica a mssql+pyodbc)
+    DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '5'))
+    DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', '10'))
+    DB_POOL_TIMEOUT = int(os.getenv('DB_POOL_TIMEOUT', '30'))
+    # Azure SQL cierra las conexiones inactivas a los 30 minutos
+    DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', '1500'))
+    DB_POOL_PRE_PING = os.getenv('DB_POOL_PRE_PING', 'true').lower() == 'true'
+    DB_FAST_EXECUTEMANY = os.getenv('DB_FAST_EXECUTEMANY', 'true').lower() == 'true'
+    # Las sesiones de reportes son de solo lectura y no necesitan transacción
+    REPORT_ISOLATION_LEVEL = os.getenv('REPORT_ISOLATION_LEVEL', 'AUTOCOMMIT') or None
+    # Réplica de lectura para reportes: se deja de usar si se atrasa más de este margen
+    REPLICA_MAX_LAG_SECONDS = int(os.getenv('DB_REPLICA_MAX_LAG', '30'))
+    REPLICA_LAG_CHECK_INTERVAL = int(os.getenv('DB_REPLICA_LAG_CHECK_INTERVAL', '10'))
+
     @staticmethod
-    def get_connection_string():
+    def get_connection_string(read_only=False):
+        # ApplicationIntent=ReadOnly hace que Azure SQL enrute a la réplica secundaria legible
+        intent = "ApplicationIntent=ReadOnly;" if read_only else ""
         # Para desarrollo local
         if os.getenv('DB_USE_MANAGED_IDENTITY', 'true').lower() == 'false':
             server = os.getenv('DB_SERVER', 'sisinfoservidor.database.windows.net')
@@ -25,6 +41,7 @@ class conexion:
                 "Encrypt=yes;"
                 "TrustServerCertificate=no;"
                 "Connection Timeout=30;"
+                f"{intent}"
             )
             return "mssql+pyodbc:///?odbc_connect=" + quote_plus(odbc_str)
         else:
@@ -41,13 +58,84 @@ class conexion:
                 "TrustServerCertificate=no;"
                 "Connection Timeout=30;"
                 "Authentication=ActiveDirectoryMSI;"
+                f"{intent}"
             )
             return "mssql+pyodbc:///?odbc_connect=" + quote_plus(odbc_str)
 
-    SQLALCHEMY_DATABASE_URI = get_connection_string()
+    @classmethod
+    def resolve_database_uri(cls):
+        return cls.get_connection_string()
+
+    @classmethod
+    def resolve_replica_uri(cls):
+        if os.getenv('DB_REPLICA_URL'):
+            return os.getenv('DB_REPLICA_URL')
+        if os.getenv('DB_READ_REPLICA', 'false').lower() == 'true':
+            return cls.get_connection_string(read_only=True)
+        return None
+
+    @staticmethod
+    def get_engine_options(config):
+        uri = str(config.get('SQLALCHEMY_DATABASE_URI') or '')
+        if uri.startswith('sqlite'):
+            # Espera en lugar de fallar de inmediato cuando otro proceso escribe
+            return {'connect_args': {'timeout': config.get('SQLITE_BUSY_TIMEOUT', 30)}}
+        if not uri.startswith('mssql'):
+            return {}
+        return {
+            'pool_size': config.get('DB_POOL_SIZE', 5),
+            'max_overflow': config.get('DB_MAX_OVERFLOW', 10),
+            'pool_timeout': config.get('DB_POOL_TIMEOUT', 30),
+            'pool_recycle': config.get('DB_POOL_RECYCLE', 1500),
+            'pool_pre_ping': config.get('DB_POOL_PRE_PING', True),
+            'fast_executemany': config.get('DB_FAST_EXECUTEMANY', True),
+        }
+
+    # Se resuelven al crear la aplicación para no exigir el driver ODBC al importar
+    SQLALCHEMY_DATABASE_URI = None
+    REPLICA_DATABASE_URI = None
 
 class DevelopmentConfig(conexion):
     DEBUG = True
 
 class ProductionConfig(conexion):
-    DEBUG = False
\ No newline at end of file
+    DEBUG = False
+    DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '10'))
+    DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', '20'))
+
+class LocalConfig(conexion):
+    DEBUG = True
+    METRICS_PUBLIC = True
+    SQLITE_PRAGMAS = {'journal_mode': 'WAL', 'synchronous': 'NORMAL', 'foreign_keys': 'ON'}
+
+    @classmethod
+    def resolve_database_uri(cls):
+        return os.getenv('LOCAL_DATABASE_URL', 'sqlite:///local.db')
+
+    @classmethod
+    def resolve_replica_uri(cls):
+        return os.getenv('LOCAL_REPLICA_DATABASE_URL')
+
+class TestingConfig(LocalConfig):
+    DEBUG = False
+    TESTING = True
+    SALES_PROJECTION_ASYNC = False
+    SQLITE_PRAGMAS = {'foreign_keys': 'ON'}
+
+    @classmethod
+    def resolve_database_uri(cls):
+        return os.getenv('TEST_DATABASE_URL', 'sqlite://')
+
+    @classmethod
+    def resolve_replica_uri(cls):
+        return os.getenv('TEST_REPLICA_DATABASE_URL')
+
+CONFIGS = {
+    'development': DevelopmentConfig,
+    'production': ProductionConfig,
+    'local': LocalConfig,
+    'testing': TestingConfig,
+}
+
+def get_config(name=None):
+    return CONFIGS[(name or os.getenv('APP_CONFIG', 'development')).lower()]
@@ -6,25 +6,82 @@ from flask import (
     request,
     jsonify,
     abort,
+    g,
     current_app,
     send_file,
+    has_request_context,
+    has_app_context,
+    session as flask_session,
 )
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session as BaseSession
+from flask.json.provider import DefaultJSONProvider
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter as PrometheusCounter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
 from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
-from Modelo.conexion import DevelopmentConfig
-from datetime import datetime, timedelta, date
-from collections import defaultdict
-from sqlalchemy import func, or_, case, extract
-from sqlalchemy.orm import aliased
+from Modelo.conexion import DevelopmentConfig, TestingConfig, conexion, get_config
+from datetime import datetime, timedelta, date, timezone
+from zoneinfo import ZoneInfo
+from collections import defaultdict, Counter, deque
+from sqlalchemy import func, or_, and_, case, literal, event, true, false
+from sqlalchemy.engine import Row
+from sqlalchemy.orm import aliased, Session
 from decimal import Decimal, InvalidOperation
-from sqlalchemy.exc import IntegrityError
+from sqlalchemy.exc import IntegrityError, DBAPIError
 import csv
 import io
 import json
-from sqlalchemy import cast, Date, func
+import threading
+import atexit
+import random
+import time
+import click
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
+import re
+import base64
+import bisect
+import unicodedata
+import itertools
+import tempfile
+import tracemalloc
+import os
+import orjson
+import gzip
+import zlib
+import brotli
+import hashlib
+import posixpath
+import rcssmin
+import rjsmin
+from sqlalchemy.schema import CreateIndex
+
+REPLICA_BIND = 'replica'
+
+
+class RoutingSession(BaseSession):
+    """
+    Sesión que envía las lecturas a la réplica cuando la petición lo marca en
+    `info['use_replica']`. Los flush y las sentencias DML siempre van al primario.
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and self.info.get('use_replica') and not self._flushing \
+                and not getattr(clause, 'is_dml', False):
+            return self._db.engines[REPLICA_BIND]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
 
-db = SQLAlchemy()
+
+db = SQLAlchemy(session_options={'class_': RoutingSession})
 login_manager = LoginManager()
 
 # ======= MODELO DE DATOS =======
@@ -61,6 +118,7 @@ class Store(db.Model):
     name = db.Column('store_name', db.String(100), nullable=False)
     location = db.Column('location', db.String(200))
     active = db.Column('active', db.Boolean, default=True)
+    time_zone = db.Column('time_zone', db.String(50))
     user_access = db.relationship('UserStoreAccess', back_populates='store', cascade='all, delete-orphan')
 
 class Category(db.Model):
@@ -91,6 +149,8 @@ class Inventory(db.Model):
     product = db.relationship('Product', backref='inventory_items')
     store = db.relationship('Store', backref='inventory_items')
 
+    __table_args__ = (db.Index('ux_inventory_product_store', 'product_id', 'store_id', unique=True),)
+
 
 class InventoryMovement(db.Model):
     __tablename__ = 'inventory_movements'
@@ -107,6 +167,8 @@ class InventoryMovement(db.Model):
     store = db.relationship('Store')
     user = db.relationship('User')
 
+    __table_args__ = (db.Index('ix_inventory_movements_store_created', 'store_id', 'created_at'),)
+
 
 class TransferRequest(db.Model):
     __tablename__ = 'transfer_requests'
@@ -139,7 +201,75 @@ class Customer(db.Model):
     phone = db.Column('phone', db.String(50))
     created_at = db.Column('created_at', db.DateTime, default=datetime.utcnow)
 
+    search_name = db.Column('search_name', db.String(150), index=True)
+    email_normalized = db.Column('email_normalized', db.String(120), index=True)
+    phone_digits = db.Column('phone_digits', db.String(50), index=True)
+
     invoices = db.relationship('Invoice', backref='customer', lazy=True)
+    search_tokens = db.relationship('CustomerSearchToken', back_populates='customer', cascade='all, delete-orphan')
+
+    def refresh_search_keys(self):
+        self.search_name = fold_search_text(self.name)[:150] or None
+        self.email_normalized = (self.email or '').strip().lower() or None
+        self.phone_digits = phone_to_digits(self.phone)[:50] or None
+        existing = {entry.token: entry for entry in self.search_tokens}
+        self.search_tokens = [
+            existing.get(token) or CustomerSearchToken(token=token)
+            for token in search_tokens_for(self.name)
+        ]
+
+
+class CustomerSearchToken(db.Model):
+    __tablename__ = 'customer_search_tokens'
+    id = db.Column('token_id', db.Integer, primary_key=True)
+    customer_id = db.Column('customer_id', db.Integer, db.ForeignKey('customers.customer_id'), nullable=False)
+    token = db.Column('token', db.String(50), nullable=False)
+
+    customer = db.relationship('Customer', back_populates='search_tokens')
+
+    __table_args__ = (
+        db.UniqueConstraint('customer_id', 'token', name='uq_customer_search_token'),
+        db.Index('ix_customer_search_tokens_token', 'token', 'customer_id'),
+    )
+
+class CustomerStats(db.Model):
+    __tablename__ = 'customer_stats'
+    customer_id = db.Column('customer_id', db.Integer, db.ForeignKey('customers.customer_id'), primary_key=True)
+    store_id = db.Column('store_id', db.Integer, db.ForeignKey('stores.store_id'), primary_key=True)
+    invoice_count = db.Column('invoice_count', db.Integer, nullable=False, default=0)
+    total_spent = db.Column('total_spent', db.Numeric(14, 2), nullable=False, default=0)
+    first_purchase = db.Column('first_purchase', db.DateTime)
+    last_purchase = db.Column('last_purchase', db.DateTime)
+
+
+class CustomerSegment(db.Model):
+    __tablename__ = 'customer_segments'
+    customer_id = db.Column('customer_id', db.Integer, db.ForeignKey('customers.customer_id'), primary_key=True)
+    last_purchase = db.Column('last_purchase', db.DateTime)
+    frequency = db.Column('frequency', db.Integer, nullable=False, default=0)
+    monetary = db.Column('monetary', db.Numeric(14, 2), nullable=False, default=0)
+    recency_days = db.Column('recency_days', db.Integer)
+    r_score = db.Column('r_score', db.Integer)
+    f_score = db.Column('f_score', db.Integer)
+    m_score = db.Column('m_score', db.Integer)
+    segment = db.Column('segment', db.String(30), index=True)
+    scored_at = db.Column('scored_at', db.DateTime)
+
+
+class JobWatermark(db.Model):
+    __tablename__ = 'job_watermarks'
+    job_name = db.Column('job_name', db.String(50), primary_key=True)
+    high_water_mark = db.Column('high_water_mark', db.DateTime)
+    updated_at = db.Column('updated_at', db.DateTime, default=datetime.utcnow)
+
+
+class CheckoutIdempotencyKey(db.Model):
+    __tablename__ = 'checkout_idempotency_keys'
+    user_id = db.Column('user_id', db.Integer, db.ForeignKey('user_account.user_id'), primary_key=True)
+    idempotency_key = db.Column('idempotency_key', db.String(64), primary_key=True)
+    invoice_id = db.Column('invoice_id', db.Integer, db.ForeignKey('invoices.invoice_id'), nullable=False)
+    created_at = db.Column('created_at', db.DateTime, default=datetime.utcnow)
+
 
 class POSSession(db.Model):
     __tablename__ = 'pos_sessions'
@@ -156,6 +286,8 @@ class POSSession(db.Model):
     store = db.relationship('Store', backref='pos_sessions')
     user = db.relationship('User', backref='pos_sessions')
 
+    __table_args__ = (db.Index('ix_pos_sessions_user_status', 'user_id', 'status'),)
+
 class Invoice(db.Model):
     __tablename__ = 'invoices'
     id = db.Column('invoice_id', db.Integer, primary_key=True)
@@ -168,11 +300,26 @@ class Invoice(db.Model):
     payment_method = db.Column('payment_method', db.String(50))
     status = db.Column('status', db.String(20), default='paid')
     created_at = db.Column('created_at', db.DateTime, default=datetime.utcnow)
+    sale_day = db.Column('sale_day', db.Date)
+    sale_hour = db.Column('sale_hour', db.SmallInteger)
+    sale_weekday = db.Column('sale_weekday', db.SmallInteger)
 
     user = db.relationship('User', backref='invoices')
     store = db.relationship('Store', backref='invoices')
     session = db.relationship('POSSession', backref='invoices')
 
+    __table_args__ = (
+        db.Index('ix_invoices_customer_created', 'customer_id', 'created_at'),
+        db.Index(
+            'ix_invoices_store_created_status', 'store_id', 'created_at', 'status',
+            mssql_include=['total_amount', 'customer_id', 'payment_method']
+        ),
+        db.Index(
+            'ix_invoices_store_day', 'store_id', 'sale_day',
+            mssql_include=['total_amount', 'status', 'customer_id']
+        ),
+    )
+
 class InvoiceItem(db.Model):
     __tablename__ = 'invoice_items'
     id = db.Column('invoice_item_id', db.Integer, primary_key=True)
@@ -196,11 +343,33 @@ class Sale(db.Model):
     sale_date = db.Column('sale_date', db.DateTime, default=datetime.utcnow)
     session_id = db.Column('session_id', db.Integer, db.ForeignKey('pos_sessions.session_id'))
     invoice_id = db.Column('invoice_id', db.Integer, db.ForeignKey('invoices.invoice_id'))
+    sale_day = db.Column('sale_day', db.Date)
+    sale_hour = db.Column('sale_hour', db.SmallInteger)
+    sale_weekday = db.Column('sale_weekday', db.SmallInteger)
 
     store = db.relationship('Store', backref='sales')
     product = db.relationship('Product', backref='sales')
     session = db.relationship('POSSession', backref='sales')
 
+    __table_args__ = (
+        db.Index(
+            'ix_sales_store_date', 'store_id', 'sale_date',
+            mssql_include=['product_id', 'quantity', 'total_amount']
+        ),
+        db.Index(
+            'ix_sales_store_day', 'store_id', 'sale_day',
+            mssql_include=['product_id', 'quantity', 'total_amount', 'sale_hour', 'sale_weekday']
+        ),
+    )
+
+
+class SalesOutbox(db.Model):
+    __tablename__ = 'sales_outbox'
+    id = db.Column('outbox_id', db.Integer, primary_key=True)
+    invoice_id = db.Column('invoice_id', db.Integer, db.ForeignKey('invoices.invoice_id'), nullable=False)
+    created_at = db.Column('created_at', db.DateTime, default=datetime.utcnow)
+    processed_at = db.Column('processed_at', db.DateTime, index=True)
+
 
 class InvoiceAuditLog(db.Model):
     __tablename__ = 'invoice_audit_logs'
@@ -338,6 +507,8 @@ class StockAlert(db.Model):
 
     inventory = db.relationship('Inventory', backref='alerts')
 
+    __table_args__ = (db.Index('ix_stock_alerts_inventory_active', 'inventory_id', 'is_active'),)
+
 
 # ======= HELPERS INVENTARIO =======
 def get_or_create_inventory(product_id, store_id, default_min_stock=None):
@@ -371,6 +542,49 @@ def update_stock_alerts(inventory):
         active_alert.is_active = False
 
 
+def update_stock_alerts_bulk(inventories):
+    inventories = [inventory for inventory in inventories if inventory.id is not None]
+    if not inventories:
+        return
+    inventory_ids = [inventory.id for inventory in inventories]
+    active_alerts = {
+        alert.inventory_id: alert
+        for alert in StockAlert.query.filter(
+            StockAlert.inventory_id.in_(inventory_ids),
+            StockAlert.is_active == True
+        ).all()
+    }
+    labels = {
+        row.inventory_id: (row.product_name, row.store_name)
+        for row in db.session.query(
+            Inventory.id.label('inventory_id'),
+            Product.name.label('product_name'),
+            Store.name.label('store_name')
+        ).join(Product, Inventory.product_id == Product.id)
+         .join(Store, Inventory.store_id == Store.id)
+         .filter(Inventory.id.in_(inventory_ids))
+    }
+    new_alerts = []
+    for inventory in inventories:
+        active_alert = active_alerts.get(inventory.id)
+        if (inventory.quantity or 0) <= (inventory.min_stock or 0):
+            product_name, store_name = labels.get(inventory.id, (None, None))
+            message = f"Stock bajo para {product_name} en {store_name}"
+            if active_alert:
+                active_alert.message = message
+                active_alert.alert_type = 'LOW_STOCK'
+            else:
+                new_alerts.append(StockAlert(
+                    inventory_id=inventory.id,
+                    alert_type='LOW_STOCK',
+                    message=message,
+                    is_active=True
+                ))
+        elif active_alert:
+            active_alert.is_active = False
+    db.session.add_all(new_alerts)
+
+
 def record_inventory_movement(product_id, store_id, quantity, movement_type, user_id=None, notes=None):
     movement = InventoryMovement(
         product_id=product_id,
@@ -381,6 +595,7 @@ def record_inventory_movement(product_id, store_id, quantity, movement_type, use
         notes=notes
     )
     db.session.add(movement)
+    count_on_commit(INVENTORY_MOVEMENTS, movement_type=movement_type)
     return movement
 
 
@@ -425,6 +640,1025 @@ def get_or_create_category_by_name(name):
     return category
 
 
+# ======= HELPERS FACTURAS =======
+def diff_invoice_items(old_items, new_items):
+    """
+    Empareja las líneas actuales de una factura con las líneas solicitadas.
+    Primero usa invoice_item_id, luego líneas idénticas del mismo producto y
+    por último cualquier línea libre del mismo producto.
+    Devuelve las líneas a insertar, actualizar (item, entrada) y eliminar.
+    """
+    remaining = {item.id: item for item in old_items}
+    pending = []
+    updated = []
+
+    def same_values(item, entry):
+        return (
+            item.quantity == entry['quantity']
+            and Decimal(item.unit_price or 0) == entry['unit_price']
+            and Decimal(item.discount or 0) == entry['discount']
+        )
+
+    def claim(item, entry):
+        del remaining[item.id]
+        if not same_values(item, entry):
+            updated.append((item, entry))
+
+    for entry in new_items:
+        item = remaining.get(entry.get('invoice_item_id'))
+        if item is not None and item.product_id == entry['product_id']:
+            claim(item, entry)
+        else:
+            pending.append(entry)
+
+    unmatched = []
+    for entry in pending:
+        item = next(
+            (item for item in remaining.values()
+             if item.product_id == entry['product_id'] and same_values(item, entry)),
+            None
+        )
+        if item is not None:
+            claim(item, entry)
+        else:
+            unmatched.append(entry)
+
+    added = []
+    for entry in unmatched:
+        item = next((item for item in remaining.values() if item.product_id == entry['product_id']), None)
+        if item is not None:
+            claim(item, entry)
+        else:
+            added.append(entry)
+
+    return {'added': added, 'updated': updated, 'removed': list(remaining.values())}
+
+
+INVOICE_AUDIT_FORMAT = 2
+INVOICE_LINE_FIELDS = ('product_id', 'quantity', 'unit_price', 'discount')
+# Cada cuántas entradas compactas se guarda de nuevo el estado completo
+INVOICE_AUDIT_CHECKPOINT_EVERY = 20
+
+
+def compact_invoice_line(item):
+    return {
+        'id': item.id,
+        'product_id': item.product_id,
+        'quantity': int(item.quantity),
+        'unit_price': float(item.unit_price or 0),
+        'discount': float(item.discount or 0)
+    }
+
+
+def apply_invoice_audit_delta(snapshot, metadatas):
+    """
+    Aplica la metadata de una entrada de auditoría sobre el estado previo de
+    la factura. Las entradas compactas (formato 2) solo guardan los cambios;
+    las entradas antiguas que incluyen la lista completa reemplazan el estado.
+    Una entrada compacta con `baseline` parte de ese estado completo (previo
+    al cambio) en lugar del anterior.
+    """
+    if not isinstance(metadatas, dict):
+        return snapshot
+    if metadatas.get('v') != INVOICE_AUDIT_FORMAT:
+        if isinstance(metadatas.get('items'), list):
+            return dict(metadatas)
+        return snapshot
+
+    state = dict(metadatas['baseline'] if 'baseline' in metadatas else snapshot or {})
+    lines = {
+        line.get('id', f'legacy-{index}'): dict(line)
+        for index, line in enumerate(state.get('items', []))
+    }
+    if 'items' in metadatas:
+        lines = {line['id']: dict(line) for line in metadatas['items']}
+    for line_id in metadatas.get('removed', []):
+        lines.pop(line_id, None)
+    for change in metadatas.get('updated', []):
+        lines.setdefault(change['id'], {'id': change['id']}).update(change)
+    for line in metadatas.get('added', []):
+        lines[line['id']] = dict(line)
+
+    state['items'] = sorted(lines.values(), key=lambda line: line.get('id') or 0)
+    for key in ('total_amount', 'payment_method', 'status'):
+        if key in metadatas:
+            state[key] = metadatas[key]
+    return state
+
+
+def is_full_audit_state(metadatas):
+    """Indica si la entrada reconstruye la factura sin depender de las anteriores."""
+    if not isinstance(metadatas, dict):
+        return False
+    if metadatas.get('v') != INVOICE_AUDIT_FORMAT:
+        return isinstance(metadatas.get('items'), list)
+    return 'baseline' in metadatas or 'items' in metadatas
+
+
+def invoice_audit_needs_baseline(invoice_id):
+    """
+    La próxima entrada compacta debe llevar el estado completo si el último
+    estado completo es de formato antiguo (líneas sin invoice_item_id, que los
+    cambios por id no pueden ubicar) o si quedó a más de
+    INVOICE_AUDIT_CHECKPOINT_EVERY entradas.
+    """
+    recent = db.session.query(InvoiceAuditLog.metadatas) \
+        .filter(InvoiceAuditLog.invoice_id == invoice_id) \
+        .order_by(InvoiceAuditLog.created_at.desc(), InvoiceAuditLog.id.desc()) \
+        .limit(INVOICE_AUDIT_CHECKPOINT_EVERY).all()
+    for (metadatas,) in recent:
+        if is_full_audit_state(metadatas):
+            return metadatas.get('v') != INVOICE_AUDIT_FORMAT
+    return True
+
+
+# ======= HELPERS CLIENTES =======
+def fold_search_text(value):
+    """
+    Normaliza un texto para búsquedas: minúsculas, sin tildes y solo con
+    letras, dígitos y espacios simples.
+    """
+    decomposed = unicodedata.normalize('NFKD', value or '')
+    stripped = ''.join(char for char in decomposed if not unicodedata.combining(char))
+    return ' '.join(re.sub(r'[^0-9a-z]+', ' ', stripped.lower()).split())
+
+
+def search_tokens_for(value):
+    return list(dict.fromkeys(token[:50] for token in fold_search_text(value).split()))
+
+
+def phone_to_digits(value):
+    return re.sub(r'\D', '', value or '')
+
+
+def like_prefix(value):
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+
+
+def apply_customer_stats_delta(customer_id, store_id, invoice_delta, amount_delta, purchased_at=None):
+    stats_table = CustomerStats.__table__
+    values = {
+        'invoice_count': stats_table.c.invoice_count + invoice_delta,
+        'total_spent': stats_table.c.total_spent + amount_delta
+    }
+    if purchased_at is not None:
+        values['first_purchase'] = case(
+            (or_(stats_table.c.first_purchase.is_(None), stats_table.c.first_purchase > purchased_at), purchased_at),
+            else_=stats_table.c.first_purchase
+        )
+        values['last_purchase'] = case(
+            (or_(stats_table.c.last_purchase.is_(None), stats_table.c.last_purchase < purchased_at), purchased_at),
+            else_=stats_table.c.last_purchase
+        )
+    update_statement = stats_table.update().where(
+        stats_table.c.customer_id == customer_id,
+        stats_table.c.store_id == store_id
+    ).values(**values)
+
+    if db.session.execute(update_statement).rowcount:
+        return
+    try:
+        with db.session.begin_nested():
+            db.session.execute(stats_table.insert().values(
+                customer_id=customer_id,
+                store_id=store_id,
+                invoice_count=invoice_delta,
+                total_spent=amount_delta,
+                first_purchase=purchased_at,
+                last_purchase=purchased_at
+            ))
+    except IntegrityError:
+        db.session.execute(update_statement)
+
+
+def customer_stats_source(customer_ids=None):
+    query = db.select(
+        Invoice.customer_id,
+        Invoice.store_id,
+        func.count(Invoice.id),
+        func.coalesce(func.sum(Invoice.total_amount), 0),
+        func.min(Invoice.created_at),
+        func.max(Invoice.created_at)
+    ).where(
+        Invoice.customer_id.isnot(None),
+        Invoice.store_id.isnot(None),
+        Invoice.status != 'void'
+    ).group_by(Invoice.customer_id, Invoice.store_id)
+    if customer_ids is not None:
+        query = query.where(Invoice.customer_id.in_(customer_ids))
+    return query
+
+
+def refresh_customer_stats(customer_ids):
+    customer_ids = sorted({customer_id for customer_id in customer_ids if customer_id})
+    if not customer_ids:
+        return
+    CustomerStats.query.filter(CustomerStats.customer_id.in_(customer_ids)).delete(synchronize_session=False)
+    db.session.execute(CustomerStats.__table__.insert().from_select(
+        ['customer_id', 'store_id', 'invoice_count', 'total_spent', 'first_purchase', 'last_purchase'],
+        customer_stats_source(customer_ids)
+    ))
+
+
+CUSTOMER_SEGMENTS = (
+    'champions',
+    'loyal',
+    'potential_loyalist',
+    'new',
+    'at_risk',
+    'hibernating',
+    'need_attention',
+)
+
+
+def quintile_scores(values, reverse=False):
+    """
+    Asigna a cada valor un puntaje de 1 a 5 según el quintil en el que cae.
+    Con reverse=True los valores más bajos obtienen el puntaje más alto.
+    """
+    if not values:
+        return []
+    ordered = sorted(values)
+    total = len(ordered)
+    cuts = [ordered[(total * step) // 5] for step in range(1, 5)]
+    scores = [bisect.bisect_right(cuts, value) + 1 for value in values]
+    if reverse:
+        scores = [6 - score for score in scores]
+    return scores
+
+
+def classify_rfm(r_score, f_score):
+    if r_score >= 4 and f_score >= 4:
+        return 'champions'
+    if f_score >= 4:
+        return 'loyal' if r_score >= 3 else 'at_risk'
+    if r_score >= 4:
+        return 'new' if f_score == 1 else 'potential_loyalist'
+    if r_score <= 2:
+        return 'at_risk' if f_score >= 3 else 'hibernating'
+    return 'need_attention'
+
+
+def compute_customer_segments(full=False, now=None, lag_minutes=5):
+    """
+    Actualiza customer_segments con una sola lectura agrupada de las facturas
+    posteriores a la marca de agua (o de todas con full=True) y recalcula los
+    puntajes RFM de todos los clientes por quintiles.
+    """
+    now = now or datetime.utcnow()
+    upper_bound = now - timedelta(minutes=lag_minutes)
+    watermark = db.session.get(JobWatermark, 'customer_segments')
+    if watermark is None:
+        watermark = JobWatermark(job_name='customer_segments')
+        db.session.add(watermark)
+        full = True
+
+    invoice_scan = db.session.query(
+        Invoice.customer_id,
+        func.max(Invoice.created_at).label('last_purchase'),
+        func.count(Invoice.id).label('frequency'),
+        func.coalesce(func.sum(Invoice.total_amount), 0).label('monetary')
+    ).filter(
+        Invoice.customer_id.isnot(None),
+        Invoice.status != 'void',
+        Invoice.created_at <= upper_bound
+    )
+    if full:
+        CustomerSegment.query.delete(synchronize_session=False)
+    elif watermark.high_water_mark is not None:
+        invoice_scan = invoice_scan.filter(Invoice.created_at > watermark.high_water_mark)
+    scanned_rows = invoice_scan.group_by(Invoice.customer_id).all()
+
+    existing = {}
+    if scanned_rows and not full:
+        existing = {
+            segment.customer_id: segment
+            for segment in CustomerSegment.query.filter(
+                CustomerSegment.customer_id.in_([row.customer_id for row in scanned_rows])
+            )
+        }
+    new_segments = []
+    for row in scanned_rows:
+        segment = existing.get(row.customer_id)
+        if segment is None:
+            new_segments.append({
+                'customer_id': row.customer_id,
+                'last_purchase': row.last_purchase,
+                'frequency': int(row.frequency or 0),
+                'monetary': Decimal(row.monetary or 0)
+            })
+            continue
+        segment.frequency = int(segment.frequency or 0) + int(row.frequency or 0)
+        segment.monetary = Decimal(segment.monetary or 0) + Decimal(row.monetary or 0)
+        if segment.last_purchase is None or row.last_purchase > segment.last_purchase:
+            segment.last_purchase = row.last_purchase
+    if new_segments:
+        db.session.execute(db.insert(CustomerSegment), new_segments)
+    db.session.flush()
+
+    all_segments = db.session.query(
+        CustomerSegment.customer_id,
+        CustomerSegment.last_purchase,
+        CustomerSegment.frequency,
+        CustomerSegment.monetary
+    ).all()
+    recency = [(now - (row.last_purchase or now)).days for row in all_segments]
+    r_scores = quintile_scores(recency, reverse=True)
+    f_scores = quintile_scores([int(row.frequency or 0) for row in all_segments])
+    m_scores = quintile_scores([Decimal(row.monetary or 0) for row in all_segments])
+    if all_segments:
+        db.session.execute(db.update(CustomerSegment), [
+            {
+                'customer_id': row.customer_id,
+                'recency_days': recency[index],
+                'r_score': r_scores[index],
+                'f_score': f_scores[index],
+                'm_score': m_scores[index],
+                'segment': classify_rfm(r_scores[index], f_scores[index]),
+                'scored_at': now
+            }
+            for index, row in enumerate(all_segments)
+        ])
+
+    latest = max((row.last_purchase for row in scanned_rows), default=None)
+    if latest and (watermark.high_water_mark is None or latest > watermark.high_water_mark or full):
+        watermark.high_water_mark = latest
+    watermark.updated_at = now
+    db.session.commit()
+    return len(scanned_rows), len(all_segments)
+
+
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(token):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(token.encode('ascii')))
+    except (ValueError, TypeError):
+        raise ValueError('Cursor inválido')
+    if not isinstance(values, list):
+        raise ValueError('Cursor inválido')
+    return values
+
+
+# ======= PROYECCIÓN DE VENTAS =======
+def enqueue_sales_projection(invoice_ids):
+    now = datetime.utcnow()
+    rows = [{'invoice_id': invoice_id, 'created_at': now} for invoice_id in invoice_ids]
+    if rows:
+        db.session.execute(db.insert(SalesOutbox), rows)
+
+
+def project_sales(batch_size=500):
+    """
+    Reconstruye las filas de `sales` de las facturas pendientes en el outbox
+    a partir de sus `invoice_items` confirmados. Las facturas anuladas quedan
+    sin filas de venta. Devuelve la cantidad de facturas proyectadas.
+    """
+    projected = 0
+    while True:
+        # Cada worker reclama sus filas: FOR UPDATE SKIP LOCKED en PostgreSQL y
+        # las sugerencias equivalentes en SQL Server, donde SQLAlchemy no
+        # traduce with_for_update. Los bloqueos duran hasta el commit.
+        pending = SalesOutbox.query.filter(SalesOutbox.processed_at.is_(None)) \
+            .order_by(SalesOutbox.id).limit(batch_size) \
+            .with_for_update(skip_locked=True) \
+            .with_hint(SalesOutbox, 'WITH (UPDLOCK, READPAST, ROWLOCK)', 'mssql').all()
+        if not pending:
+            return projected
+
+        invoice_ids = sorted({entry.invoice_id for entry in pending})
+        Sale.query.filter(Sale.invoice_id.in_(invoice_ids)).delete(synchronize_session=False)
+
+        derived_rows = db.select(
+            Invoice.store_id,
+            InvoiceItem.product_id,
+            InvoiceItem.quantity,
+            InvoiceItem.line_total,
+            Invoice.created_at,
+            Invoice.session_id,
+            Invoice.id,
+            Invoice.sale_day,
+            Invoice.sale_hour,
+            Invoice.sale_weekday
+        ).join(Invoice, InvoiceItem.invoice_id == Invoice.id) \
+         .where(Invoice.id.in_(invoice_ids), Invoice.status != 'void') \
+         .order_by(Invoice.id, InvoiceItem.id)
+        db.session.execute(
+            Sale.__table__.insert().from_select(
+                [
+                    'store_id', 'product_id', 'quantity', 'total_amount', 'sale_date', 'session_id', 'invoice_id',
+                    'sale_day', 'sale_hour', 'sale_weekday'
+                ],
+                derived_rows
+            )
+        )
+
+        # Solo las filas reclamadas: las de la misma factura que tenga bloqueadas
+        # otro worker se procesan en su propio lote, sin esperar su bloqueo
+        SalesOutbox.query.filter(
+            SalesOutbox.id.in_([entry.id for entry in pending])
+        ).update({SalesOutbox.processed_at: datetime.utcnow()}, synchronize_session=False)
+        db.session.commit()
+        projected += len(invoice_ids)
+
+
+# ======= DATOS SINTÉTICOS =======
+SEED_CATEGORIES = (
+    ('Camisetas', 'Camiseta', 39900),
+    ('Camisas', 'Camisa', 89900),
+    ('Pantalones', 'Pantalón', 119900),
+    ('Jeans', 'Jean', 139900),
+    ('Vestidos', 'Vestido', 159900),
+    ('Faldas', 'Falda', 79900),
+    ('Chaquetas', 'Chaqueta', 229900),
+    ('Buzos', 'Buzo', 109900),
+    ('Ropa interior', 'Bóxer', 29900),
+    ('Calzado', 'Tenis', 199900),
+    ('Accesorios', 'Gorra', 34900),
+    ('Deportiva', 'Licra', 69900),
+)
+SEED_STYLES = ('Básico', 'Clásico', 'Slim', 'Oversize', 'Urbano', 'Casual', 'Premium', 'Sport', 'Vintage', 'Essential')
+SEED_MATERIALS = ('Algodón', 'Lino', 'Denim', 'Poliéster', 'Dril', 'Jersey', 'Seda', 'Cuero')
+SEED_SIZES = ('XS', 'S', 'M', 'L', 'XL', 'XXL')
+SEED_SIZE_WEIGHTS = (0.5, 0.9, 1.4, 1.3, 0.8, 0.4)
+SEED_COLORS = ('Negro', 'Blanco', 'Azul', 'Gris', 'Rojo', 'Verde', 'Beige', 'Rosado', 'Café', 'Mostaza')
+SEED_CITIES = (
+    'Bogotá', 'Medellín', 'Cali', 'Barranquilla', 'Cartagena',
+    'Bucaramanga', 'Pereira', 'Manizales', 'Santa Marta', 'Cúcuta'
+)
+SEED_FIRST_NAMES = (
+    'José', 'María', 'Juan', 'Ana', 'Luis', 'Carmen', 'Carlos', 'Laura', 'Andrés', 'Valentina',
+    'Jorge', 'Camila', 'Diego', 'Paola', 'Santiago', 'Daniela', 'Felipe', 'Natalia', 'Sebastián', 'Sofía'
+)
+SEED_LAST_NAMES = (
+    'Pérez', 'Gómez', 'Rodríguez', 'López', 'Martínez', 'García', 'Hernández', 'Díaz', 'Muñoz', 'Rojas',
+    'Moreno', 'Jiménez', 'Vargas', 'Castro', 'Ramírez', 'Torres', 'Suárez', 'Ortiz', 'Ríos', 'Zapata'
+)
+# Tiendas abiertas de 9:00 a 22:00 con picos al almuerzo y al salir del trabajo
+SEED_HOUR_WEIGHTS = (0, 0, 0, 0, 0, 0, 0, 0, 0, 2, 4, 6, 9, 8, 6, 6, 7, 9, 11, 10, 7, 3, 0, 0)
+SEED_WEEKDAY_WEIGHTS = (0.8, 0.85, 0.9, 0.95, 1.15, 1.45, 1.1)
+SEED_MONTH_WEIGHTS = (0.75, 0.8, 0.9, 0.9, 1.05, 1.15, 1.05, 0.95, 0.95, 1.0, 1.25, 1.8)
+SEED_LINES_PER_INVOICE = ((1, 40), (2, 28), (3, 17), (4, 9), (5, 4), (6, 2))
+SEED_QUANTITIES = ((1, 72), (2, 20), (3, 6), (4, 2))
+SEED_PAYMENT_METHODS = (('Efectivo', 45), ('Tarjeta', 40), ('Transferencia', 15))
+SEED_TRANSFER_STATUSES = (('completed', 70), ('approved', 10), ('pending', 15), ('rejected', 5))
+
+
+def cumulative(weights):
+    total = 0
+    result = []
+    for weight in weights:
+        total += weight
+        result.append(total)
+    return result
+
+
+def seed_price(base_price, rng):
+    price = int(base_price * rng.lognormvariate(0, 0.25))
+    return Decimal(max(9900, price // 1000 * 1000 + 900))
+
+
+def generate_synthetic_data(stores=5, products=2000, customers=5000, days=90, sales_lines=100000,
+                            batch_size=5000, password='demo1234', seed=None, log=None):
+    """
+    Genera un conjunto de datos sintético con volúmenes configurables.
+
+    Las ventas siguen la distribución por hora, día de la semana y mes de las
+    constantes SEED_*; la popularidad de productos y clientes es tipo Zipf.
+    Todos los identificadores se asignan en memoria para insertar por lotes
+    sin consultar la base de datos entre tablas. Devuelve los conteos creados.
+    """
+    rng = random.Random(seed)
+    log = log or (lambda message: None)
+    days = max(1, days)
+    # Las tiendas sintéticas no tienen zona propia: se generan horas locales de
+    # la zona por defecto y se guardan en UTC, como las ventas reales
+    time_zone = store_time_zone(None)
+    today = datetime.combine(utc_to_local(datetime.utcnow(), time_zone).date(), datetime.min.time())
+    start_day = today - timedelta(days=days - 1)
+    counts = defaultdict(int)
+    buffers = defaultdict(list)
+    insert_order = (
+        Store, Category, Product, User, UserStoreAccess, Customer, CustomerSearchToken, Inventory, StockAlert,
+        POSSession, Invoice, InvoiceItem, Sale, TransferRequest, InventoryMovement
+    )
+    last_ids = {
+        model: db.session.query(func.max(model.__mapper__.primary_key[0])).scalar() or 0
+        for model in (Store, Category, Product, User, Customer, CustomerSearchToken, Inventory, POSSession, Invoice, TransferRequest)
+    }
+
+    def allocate(model):
+        last_ids[model] += 1
+        return last_ids[model]
+
+    def add(model, row):
+        buffers[model].append(row)
+
+    column_keys = {
+        model: {prop.key: prop.columns[0].key for prop in model.__mapper__.column_attrs}
+        for model in insert_order
+    }
+
+    def flush():
+        # Core executemany: el INSERT ORM separa los lotes cuando hay valores NULL
+        for model in insert_order:
+            rows = buffers.pop(model, None)
+            if rows:
+                keys = column_keys[model]
+                db.session.execute(model.__table__.insert(), [{keys[key]: value for key, value in row.items()} for row in rows])
+                counts[model.__tablename__] += len(rows)
+        db.session.commit()
+
+    # Sucursales y usuarios
+    store_ids = []
+    store_weights = []
+    store_names = {}
+    staff = {}
+    password_hash = generate_password_hash(password)
+    for index in range(stores):
+        store_id = allocate(Store)
+        city = SEED_CITIES[index % len(SEED_CITIES)]
+        store_names[store_id] = f'{city} {index // len(SEED_CITIES) + 1}'
+        add(Store, {'id': store_id, 'name': store_names[store_id], 'location': f'Centro comercial {city}', 'active': True})
+        store_ids.append(store_id)
+        store_weights.append(rng.lognormvariate(0, 0.45))
+        staff[store_id] = []
+        for prefix, user_type in (('gerente', 2), ('cajero', 3), ('cajero', 3)):
+            user_id = allocate(User)
+            add(User, {'id': user_id, 'username': f'{prefix}{store_id}_{user_id}', 'password_hash': password_hash, 'user_type': user_type})
+            add(UserStoreAccess, {'user_id': user_id, 'store_id': store_id})
+            staff[store_id].append(user_id)
+
+    # Categorías y productos con variantes de talla y color
+    existing_categories = {name.lower(): category_id for category_id, name in db.session.query(Category.id, Category.name)}
+    category_ids = []
+    for name, _, _ in SEED_CATEGORIES:
+        category_id = existing_categories.get(name.lower())
+        if not category_id:
+            category_id = allocate(Category)
+            add(Category, {'id': category_id, 'name': name, 'description': f'{name} (datos sintéticos)'})
+        category_ids.append(category_id)
+    flush()
+
+    product_ids = []
+    product_weights = []
+    product_prices = {}
+    product_names = {}
+    model_rank = 0
+    while len(product_ids) < products:
+        model_rank += 1
+        category_index = rng.randrange(len(SEED_CATEGORIES))
+        _, singular, base_price = SEED_CATEGORIES[category_index]
+        name = f'{singular} {rng.choice(SEED_STYLES)} {rng.choice(SEED_MATERIALS)}'
+        price = seed_price(base_price, rng)
+        model_weight = 1 / model_rank ** 1.07
+        if SEED_CATEGORIES[category_index][0] == 'Accesorios':
+            sizes = [('Única', 1.0)]
+        else:
+            first = rng.randint(0, 2)
+            sizes = list(zip(SEED_SIZES, SEED_SIZE_WEIGHTS))[first:first + rng.randint(3, 6)]
+        colors = rng.sample(SEED_COLORS, rng.randint(1, 4))
+        for color_rank, color in enumerate(colors):
+            for size, size_weight in sizes:
+                if len(product_ids) >= products:
+                    break
+                product_id = allocate(Product)
+                add(Product, {
+                    'id': product_id,
+                    'name': name,
+                    'sku': f'SKU-{product_id:07d}',
+                    'price': price,
+                    'size': size,
+                    'color': color,
+                    'category_id': category_ids[category_index]
+                })
+                product_ids.append(product_id)
+                product_weights.append(model_weight * size_weight / (color_rank + 1))
+                product_prices[product_id] = int(price)
+                product_names[product_id] = name
+        if len(buffers[Product]) >= batch_size:
+            flush()
+    flush()
+    log(f'Productos: {len(product_ids)} SKUs de {model_rank} modelos')
+
+    # Clientes con tienda habitual
+    store_customer_ids = defaultdict(list)
+    store_customer_weights = defaultdict(list)
+    store_cum_weights = cumulative(store_weights)
+    customer_start = start_day - timedelta(days=365)
+    for rank in range(1, customers + 1):
+        customer_id = allocate(Customer)
+        first_name = rng.choice(SEED_FIRST_NAMES)
+        last_name = f'{rng.choice(SEED_LAST_NAMES)} {rng.choice(SEED_LAST_NAMES)}'
+        name = f'{first_name} {last_name}'
+        email = f"{fold_search_text(first_name)}.{fold_search_text(last_name).replace(' ', '')}{customer_id}@correo.com"
+        phone = f'+57 3{rng.randint(0, 2)}{rng.randint(0, 9)} {rng.randint(1000000, 9999999)}'
+        add(Customer, {
+            'id': customer_id,
+            'name': name,
+            'email': email,
+            'phone': phone,
+            'created_at': local_to_utc(customer_start + timedelta(seconds=rng.randrange(int((today - customer_start).total_seconds()))), time_zone),
+            'search_name': fold_search_text(name)[:150],
+            'email_normalized': email,
+            'phone_digits': phone_to_digits(phone)
+        })
+        for token in search_tokens_for(name):
+            add(CustomerSearchToken, {'id': allocate(CustomerSearchToken), 'customer_id': customer_id, 'token': token})
+        home_store = rng.choices(store_ids, cum_weights=store_cum_weights)[0]
+        store_customer_ids[home_store].append(customer_id)
+        store_customer_weights[home_store].append(1 / rank ** 0.8)
+        if len(buffers[Customer]) >= batch_size:
+            flush()
+    flush()
+    customer_ids = [customer_id for store_id in store_ids for customer_id in store_customer_ids[store_id]]
+    store_customer_cum = {store_id: cumulative(store_customer_weights[store_id]) for store_id in store_ids}
+
+    # Inventario por sucursal: las sucursales grandes manejan más referencias
+    max_store_weight = max(store_weights) if store_weights else 1
+    store_products = {}
+    store_product_cum = {}
+    for store_id, store_weight in zip(store_ids, store_weights):
+        coverage = 0.5 + 0.5 * store_weight / max_store_weight
+        carried = [(product_id, weight) for product_id, weight in zip(product_ids, product_weights) if rng.random() < coverage]
+        if not carried and product_ids:
+            carried = [(product_ids[0], product_weights[0])]
+        store_products[store_id] = [product_id for product_id, _ in carried]
+        store_product_cum[store_id] = cumulative(weight for _, weight in carried)
+        for product_id, _ in carried:
+            inventory_id = allocate(Inventory)
+            min_stock = rng.randint(5, 15)
+            quantity = rng.randint(0, min_stock) if rng.random() < 0.06 else rng.randint(min_stock + 1, 120)
+            add(Inventory, {'id': inventory_id, 'product_id': product_id, 'store_id': store_id, 'quantity': quantity, 'min_stock': min_stock})
+            if quantity <= min_stock:
+                add(StockAlert, {
+                    'inventory_id': inventory_id,
+                    'alert_type': 'LOW_STOCK',
+                    'message': f'Stock bajo para {product_names[product_id]} en {store_names[store_id]}'[:255],
+                    'is_active': True,
+                    'created_at': local_to_utc(today - timedelta(hours=rng.randint(1, 72)), time_zone)
+                })
+            if len(buffers[Inventory]) >= batch_size:
+                flush()
+    flush()
+    log(f"Inventario: {counts['inventory']} registros, {counts['stock_alerts']} alertas")
+
+    # Facturas, líneas y ventas
+    day_factors = [
+        SEED_WEEKDAY_WEIGHTS[(start_day + timedelta(days=offset)).weekday()] *
+        SEED_MONTH_WEIGHTS[(start_day + timedelta(days=offset)).month - 1]
+        for offset in range(days)
+    ]
+    mean_lines = sum(lines * weight for lines, weight in SEED_LINES_PER_INVOICE) / sum(weight for _, weight in SEED_LINES_PER_INVOICE)
+    expected_invoices = sales_lines / mean_lines
+    total_day_factor = sum(day_factors)
+    total_store_weight = sum(store_weights) or 1
+    hour_cum = cumulative(SEED_HOUR_WEIGHTS)
+    hours = list(range(24))
+    lines_values, lines_cum = zip(*SEED_LINES_PER_INVOICE)
+    lines_cum = cumulative(lines_cum)
+    quantity_values, quantity_cum = zip(*SEED_QUANTITIES)
+    quantity_cum = cumulative(quantity_cum)
+    payment_values, payment_cum = zip(*SEED_PAYMENT_METHODS)
+    payment_cum = cumulative(payment_cum)
+    lines_written = 0
+
+    for offset, day_factor in enumerate(day_factors):
+        day = start_day + timedelta(days=offset)
+        for store_id, store_weight in zip(store_ids, store_weights):
+            mean = expected_invoices * day_factor / total_day_factor * store_weight / total_store_weight
+            invoice_count = max(0, int(round(rng.gauss(mean, mean * 0.15))))
+            if not invoice_count or not store_products[store_id]:
+                continue
+            session_id = allocate(POSSession)
+            cashier_id = rng.choice(staff[store_id])
+            cash_total = 0
+            timestamps = sorted(
+                day + timedelta(hours=hour, seconds=rng.randrange(3600))
+                for hour in rng.choices(hours, cum_weights=hour_cum, k=invoice_count)
+            )
+            for local_time in timestamps:
+                invoice_id = allocate(Invoice)
+                created_at = local_to_utc(local_time, time_zone)
+                buckets = local_buckets(local_time)
+                status = 'void' if rng.random() < 0.01 else 'paid'
+                payment_method = rng.choices(payment_values, cum_weights=payment_cum)[0]
+                customer_id = None
+                if store_customer_ids[store_id] and rng.random() < 0.6:
+                    customer_id = rng.choices(store_customer_ids[store_id], cum_weights=store_customer_cum[store_id])[0]
+                line_count = rng.choices(lines_values, cum_weights=lines_cum)[0]
+                chosen = dict.fromkeys(rng.choices(store_products[store_id], cum_weights=store_product_cum[store_id], k=line_count))
+                invoice_total = 0
+                for product_id in chosen:
+                    quantity = rng.choices(quantity_values, cum_weights=quantity_cum)[0]
+                    unit_price = product_prices[product_id]
+                    discount = unit_price * rng.choice((10, 20, 30)) // 10000 * 100 if rng.random() < 0.12 else 0
+                    line_total = (unit_price - discount) * quantity
+                    invoice_total += line_total
+                    add(InvoiceItem, {
+                        'invoice_id': invoice_id,
+                        'product_id': product_id,
+                        'quantity': quantity,
+                        'unit_price': Decimal(unit_price),
+                        'discount': Decimal(discount),
+                        'line_total': Decimal(line_total)
+                    })
+                    if status != 'void':
+                        add(Sale, {
+                            'store_id': store_id,
+                            'product_id': product_id,
+                            'quantity': quantity,
+                            'total_amount': Decimal(line_total),
+                            'sale_date': created_at,
+                            'session_id': session_id,
+                            'invoice_id': invoice_id,
+                            **buckets
+                        })
+                lines_written += len(chosen)
+                if status != 'void' and payment_method == 'Efectivo':
+                    cash_total += invoice_total
+                add(Invoice, {
+                    'id': invoice_id,
+                    'invoice_number': f"INV-{created_at.strftime('%Y%m%d%H%M%S')}-{invoice_id}",
+                    'customer_id': customer_id,
+                    'user_id': cashier_id,
+                    'store_id': store_id,
+                    'session_id': session_id,
+                    'total_amount': Decimal(invoice_total),
+                    'payment_method': payment_method,
+                    'status': status,
+                    'created_at': created_at,
+                    **buckets
+                })
+            add(POSSession, {
+                'id': session_id,
+                'user_id': cashier_id,
+                'store_id': store_id,
+                'opened_at': local_to_utc(day + timedelta(hours=8, minutes=30), time_zone),
+                'closed_at': local_to_utc(day + timedelta(hours=22), time_zone),
+                'opening_amount': Decimal(200000),
+                'closing_amount': Decimal(200000 + cash_total),
+                'status': 'closed'
+            })
+            if len(buffers[InvoiceItem]) >= batch_size:
+                flush()
+
+        # Reposiciones semanales y transferencias entre sucursales
+        if day.weekday() == 0 or offset == 0:
+            for store_id in store_ids:
+                products_to_restock = rng.sample(store_products[store_id], min(len(store_products[store_id]), max(1, len(store_products[store_id]) // 40)))
+                for product_id in products_to_restock:
+                    add(InventoryMovement, {
+                        'product_id': product_id,
+                        'store_id': store_id,
+                        'quantity': rng.randint(10, 60),
+                        'movement_type': 'entry',
+                        'notes': 'Reposición semanal',
+                        'performed_by': staff[store_id][0],
+                        'created_at': local_to_utc(day + timedelta(hours=7, minutes=rng.randrange(120)), time_zone)
+                    })
+            if len(store_ids) > 1:
+                transfer_statuses, transfer_cum = zip(*SEED_TRANSFER_STATUSES)
+                for _ in range(len(store_ids) * 2):
+                    source_id, target_id = rng.sample(store_ids, 2)
+                    if not store_products[source_id]:
+                        continue
+                    transfer_id = allocate(TransferRequest)
+                    product_id = rng.choice(store_products[source_id])
+                    quantity = rng.randint(2, 20)
+                    status = rng.choices(transfer_statuses, cum_weights=cumulative(transfer_cum))[0]
+                    requested_at = local_to_utc(day + timedelta(hours=rng.randint(9, 18)), time_zone)
+                    approved_at = requested_at + timedelta(hours=rng.randint(2, 30)) if status in ('approved', 'completed') else None
+                    confirmed_at = approved_at + timedelta(hours=rng.randint(12, 72)) if status == 'completed' else None
+                    add(TransferRequest, {
+                        'id': transfer_id,
+                        'product_id': product_id,
+                        'source_store_id': source_id,
+                        'target_store_id': target_id,
+                        'quantity': quantity,
+                        'status': status,
+                        'requested_by': staff[target_id][0],
+                        'approved_by': staff[source_id][0] if approved_at else None,
+                        'confirmed_by': staff[target_id][0] if confirmed_at else None,
+                        'requested_at': requested_at,
+                        'approved_at': approved_at,
+                        'confirmed_at': confirmed_at
+                    })
+                    if approved_at:
+                        add(InventoryMovement, {
+                            'product_id': product_id,
+                            'store_id': source_id,
+                            'quantity': -quantity,
+                            'movement_type': 'transfer_out',
+                            'notes': f'Salida por transferencia #{transfer_id}',
+                            'performed_by': staff[source_id][0],
+                            'created_at': approved_at
+                        })
+                    if confirmed_at:
+                        add(InventoryMovement, {
+                            'product_id': product_id,
+                            'store_id': target_id,
+                            'quantity': quantity,
+                            'movement_type': 'transfer_in',
+                            'notes': f'Entrada por transferencia #{transfer_id}',
+                            'performed_by': staff[target_id][0],
+                            'created_at': confirmed_at
+                        })
+        if offset % 7 == 6 or offset == days - 1:
+            log(f'{day.date().isoformat()}: {lines_written} líneas de venta generadas')
+    flush()
+
+    for start in range(0, len(customer_ids), batch_size):
+        refresh_customer_stats(customer_ids[start:start + batch_size])
+        db.session.commit()
+
+    return dict(counts)
+
+
+# ======= BENCHMARKS =======
+BENCHMARK_SCALES = {
+    'small': {'stores': 3, 'products': 500, 'customers': 1000, 'days': 30, 'sales_lines': 10000},
+    'medium': {'stores': 10, 'products': 5000, 'customers': 10000, 'days': 120, 'sales_lines': 150000},
+    'large': {'stores': 50, 'products': 100000, 'customers': 200000, 'days': 365, 'sales_lines': 2000000},
+}
+BENCHMARK_METRICS = ('p50_ms', 'p95_ms', 'sql_count', 'peak_kb')
+# Escrituras que no se miden: cambian de estado en la primera llamada y no se
+# pueden repetir sobre los mismos datos, o son operaciones de administración
+BENCHMARK_EXCLUDED_WRITES = (
+    ('POST /api/inventory/transfers/<id>/approve', 'solo se aprueba una vez por transferencia'),
+    ('POST /api/inventory/transfers/<id>/confirm', 'solo se confirma una vez por transferencia'),
+    ('POST /api/invoices/void', 'anulación masiva; la individual sí se mide'),
+    ('POST /api/pos/session/open y /close', 'una sola caja abierta por usuario'),
+    ('POST/PUT/DELETE /api/users*', 'administración de usuarios'),
+    ('PUT /api/inventory/products/<id>', 'edición de catálogo'),
+    ('POST /api/alerts/<id>/dismiss', 'solo se descarta una vez por alerta'),
+    ('POST/DELETE /api/admin/slow-queries*', 'herramientas de diagnóstico'),
+)
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    position = (len(ordered) - 1) * fraction
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+def benchmark_targets(app, sample_ids, query_args):
+    """Arma la lista de endpoints GET de /api/* con parámetros de ejemplo."""
+    targets = []
+    with app.test_request_context():
+        for rule in sorted(app.url_map.iter_rules(), key=lambda rule: rule.rule):
+            if not rule.rule.startswith('/api/') or 'GET' not in rule.methods:
+                continue
+            if any(argument not in sample_ids for argument in rule.arguments):
+                continue
+            values = {argument: sample_ids[argument] for argument in rule.arguments}
+            targets.append((f'GET {rule.rule}', url_for(rule.endpoint, **values, **query_args)))
+    return targets
+
+
+def benchmark_write_targets(sample_ids):
+    """
+    Escrituras medidas con cuerpos que se pueden repetir en cada iteración.
+    `url` y `body` pueden ser funciones del número de llamada cuando cada
+    llamada necesita un recurso distinto (por ejemplo, anular otra factura).
+    """
+    store_id = sample_ids['store_id']
+    product_id = sample_ids['product_id']
+    invoice_items = sample_ids['invoice_items']
+    void_ids = sample_ids['void_invoice_ids']
+    targets = [
+        ('POST /api/inventory/movements', 'POST', '/api/inventory/movements', {
+            'product_id': product_id, 'store_id': store_id, 'quantity': 1,
+            'movement_type': 'entry', 'notes': 'Benchmark'
+        }),
+        ('POST /api/customers', 'POST', '/api/customers', {'name': 'Cliente Benchmark', 'phone': '3000000000'}),
+        ('PUT /api/customers/<customer_id>', 'PUT', f"/api/customers/{sample_ids['customer_id']}", {'name': 'Cliente Benchmark'}),
+        # Alterna el método de pago para que cada llamada modifique la factura
+        ('PUT /api/invoices/<invoice_id>', 'PUT', f"/api/invoices/{sample_ids['invoice_id']}", lambda call: {
+            'items': invoice_items, 'payment_method': 'Tarjeta' if call % 2 else 'Efectivo'
+        }),
+        ('POST /api/invoices/<invoice_id>/void', 'POST', lambda call: f'/api/invoices/{void_ids[call]}/void', None),
+    ]
+    if sample_ids.get('target_store_id'):
+        targets.append(('POST /api/inventory/transfers', 'POST', '/api/inventory/transfers', {
+            'product_id': product_id, 'source_store_id': store_id,
+            'target_store_id': sample_ids['target_store_id'], 'quantity': 1
+        }))
+    return targets
+
+
+def measure_endpoint(client, engine, method, url, iterations, json_body=None):
+    statements = []
+
+    def call(number):
+        target = url(number) if callable(url) else url
+        body = json_body(number) if callable(json_body) else json_body
+        return client.open(target, method=method, json=body)
+
+    def count_statement(*args):
+        statements[-1] += 1
+
+    event.listen(engine, 'before_cursor_execute', count_statement)
+    latencies = []
+    status = None
+    try:
+        for number in range(iterations + 1):
+            statements.append(0)
+            started = time.perf_counter()
+            response = call(number)
+            response.get_data()
+            latencies.append((time.perf_counter() - started) * 1000)
+            status = response.status_code
+    finally:
+        event.remove(engine, 'before_cursor_execute', count_statement)
+
+    # La primera llamada calienta cachés y compila sentencias; no se mide
+    latencies = latencies[1:]
+    statements = statements[1:]
+
+    tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        call(iterations + 1).get_data()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {
+        'status': status,
+        'p50_ms': round(percentile(latencies, 0.5), 3),
+        'p95_ms': round(percentile(latencies, 0.95), 3),
+        'p99_ms': round(percentile(latencies, 0.99), 3),
+        'sql_count': int(percentile(statements, 0.5)),
+        'peak_kb': round(peak / 1024, 1)
+    }
+
+
+def compare_benchmarks(baseline, current, threshold=0.2, sql_threshold=0.0, min_delta_ms=2.0):
+    """Devuelve la lista de regresiones de `current` frente a `baseline`."""
+    regressions = []
+    for scale, scale_result in current.get('scales', {}).items():
+        reference = baseline.get('scales', {}).get(scale, {}).get('endpoints', {})
+        for name, metrics in scale_result.get('endpoints', {}).items():
+            previous = reference.get(name)
+            if not previous:
+                continue
+            if previous.get('status') != metrics.get('status'):
+                regressions.append(f"{scale} {name}: estado {previous.get('status')} -> {metrics.get('status')}")
+                continue
+            for metric in BENCHMARK_METRICS:
+                before = previous.get(metric)
+                after = metrics.get(metric)
+                if before is None or after is None:
+                    continue
+                limit = sql_threshold if metric == 'sql_count' else threshold
+                allowed = before * (1 + limit)
+                if metric.endswith('_ms'):
+                    allowed = max(allowed, before + min_delta_ms)
+                if after > allowed:
+                    regressions.append(f'{scale} {name}: {metric} {before} -> {after}')
+    return regressions
+
+
+def manual_row_dict(row):
+    """Conversión a mano que hacían las vistas antes de entregar filas al proveedor JSON."""
+    values = {}
+    for key, value in row._mapping.items():
+        if isinstance(value, Decimal):
+            value = float(value)
+        elif isinstance(value, datetime):
+            value = value.strftime('%Y-%m-%d %H:%M')
+        elif isinstance(value, date):
+            value = value.isoformat()
+        values[key] = value
+    return values
+
+
+def benchmark_json_serialization(app, rows, repeat=5):
+    """Mediana en milisegundos por cada 10.000 filas de cada forma de serializar `rows`."""
+    scale = 10000 / max(len(rows), 1)
+    strategies = {
+        'dicts manuales + json': (TimedJSONProvider(app), lambda: [manual_row_dict(row) for row in rows]),
+        'filas + json': (TimedJSONProvider(app), lambda: rows),
+        'filas + orjson': (FastJSONProvider(app), lambda: rows),
+    }
+    results = {}
+    for name, (provider, prepare) in strategies.items():
+        samples = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            payload = provider.dumps(prepare())
+            samples.append((time.perf_counter() - started) * 1000)
+        results[name] = {'ms_per_10k': round(percentile(samples, 0.5) * scale, 2), 'bytes': len(payload)}
+    return results
+
+
 # ======= FECHAS =======
 def get_date_range_filter(fecha_inicio_str, fecha_fin_str):
     """
@@ -443,25 +1677,1023 @@ def get_date_range_filter(fecha_inicio_str, fecha_fin_str):
     except ValueError:
         return datetime.combine(date.today(), datetime.min.time()), datetime.combine(date.today(), datetime.max.time())
 
+
+DEFAULT_STORE_TIME_ZONE = 'America/Bogota'
+SALE_BUCKET_COLUMNS = ('sale_day', 'sale_hour', 'sale_weekday')
+
+_store_time_zone_lock = threading.Lock()
+
+
+def store_time_zone_cache():
+    # Por aplicación, como los principales: dos apps en el mismo proceso
+    # pueden apuntar a bases con zonas distintas para el mismo id de tienda
+    return current_app.extensions['store_time_zones']
+
+
+def invalidate_store_time_zone(store_id=None):
+    cache = store_time_zone_cache()
+    with _store_time_zone_lock:
+        if store_id is None:
+            cache.clear()
+        else:
+            cache.pop(store_id, None)
+
+
+def store_time_zone(store_id, connection=None):
+    """
+    Zona horaria de la tienda, o STORE_TIME_ZONE si la tienda no define una.
+    Se cachea por aplicación durante STORE_TIME_ZONE_TTL segundos: se consulta
+    en cada factura nueva y las zonas casi nunca cambian.
+    """
+    if not has_app_context():
+        default = DEFAULT_STORE_TIME_ZONE
+        if store_id is None:
+            return default
+        return connection.execute(db.select(Store.time_zone).where(Store.id == store_id)).scalar() or default
+    default = current_app.config.get('STORE_TIME_ZONE', DEFAULT_STORE_TIME_ZONE)
+    if store_id is None:
+        return default
+    ttl = current_app.config.get('STORE_TIME_ZONE_TTL', 300)
+    now = time.monotonic()
+    cache = store_time_zone_cache()
+    with _store_time_zone_lock:
+        cached = cache.get(store_id)
+    if cached and cached[0] > now:
+        return cached[1] or default
+
+    executor = connection if connection is not None else db.session
+    time_zone = executor.execute(db.select(Store.time_zone).where(Store.id == store_id)).scalar()
+    if ttl > 0:
+        with _store_time_zone_lock:
+            cache[store_id] = (now + ttl, time_zone)
+    return time_zone or default
+
+
+@event.listens_for(Store, 'after_update')
+@event.listens_for(Store, 'after_delete')
+def discard_store_time_zone(mapper, connection, target):
+    # Solo cubre este proceso; los demás workers la ven al vencer el TTL
+    if has_app_context():
+        invalidate_store_time_zone(target.id)
+
+
+def utc_to_local(moment, time_zone):
+    """Hora local (sin zona) de una fecha guardada en UTC."""
+    return moment.replace(tzinfo=timezone.utc).astimezone(ZoneInfo(time_zone)).replace(tzinfo=None)
+
+
+def local_to_utc(local, time_zone):
+    """Fecha UTC (sin zona), como se guarda en la base de datos, de una hora local."""
+    return local.replace(tzinfo=ZoneInfo(time_zone)).astimezone(timezone.utc).replace(tzinfo=None)
+
+
+def local_buckets(local):
+    return {'sale_day': local.date(), 'sale_hour': local.hour, 'sale_weekday': local.weekday()}
+
+
+def sale_buckets(moment, time_zone):
+    """Día, hora y día de la semana (lunes = 0) locales de una fecha guardada en UTC."""
+    return local_buckets(utc_to_local(moment, time_zone))
+
+
+@event.listens_for(Invoice, 'before_insert')
+def set_invoice_sale_buckets(mapper, connection, target):
+    # Las ventas proyectadas copian estas columnas de la factura
+    if target.created_at is None:
+        target.created_at = datetime.utcnow()
+    if target.sale_day is None:
+        for key, value in sale_buckets(target.created_at, store_time_zone(target.store_id, connection)).items():
+            setattr(target, key, value)
+
+
+def backfill_sale_buckets(model, moment_column, batch_size=5000):
+    """Completa sale_day/sale_hour/sale_weekday de las filas antiguas por lotes de clave primaria."""
+    key = model.__mapper__.primary_key[0]
+    last_id = 0
+    updated = 0
+    while True:
+        rows = db.session.query(key.label('id'), model.store_id, moment_column.label('moment')) \
+            .filter(key > last_id, model.sale_day.is_(None), moment_column.isnot(None)) \
+            .order_by(key).limit(batch_size).all()
+        if not rows:
+            return updated
+        db.session.execute(db.update(model), [
+            {'id': row.id, **sale_buckets(row.moment, store_time_zone(row.store_id))}
+            for row in rows
+        ])
+        db.session.commit()
+        last_id = rows[-1].id
+        updated += len(rows)
+
+# ======= SESIÓN DE USUARIO =======
+class UserPrincipal(UserMixin):
+    """
+    Datos mínimos del usuario autenticado que se necesitan para autorizar
+    solicitudes, sin mantener una entidad ORM asociada a la sesión.
+    """
+
+    def __init__(self, id, username, user_type, store_ids):
+        self.id = id
+        self.username = username
+        self.user_type = user_type
+        self.store_ids = frozenset(store_ids)
+
+
+_principal_cache_lock = threading.Lock()
+
+
+def principal_cache():
+    # Cada aplicación guarda sus principales: dos apps en el mismo proceso
+    # (tests, CLI) pueden tener usuarios distintos con el mismo id
+    return current_app.extensions['user_principals']
+
+
+def build_user_principal(user_id):
+    user_row = db.session.query(User.id, User.username, User.user_type).filter(User.id == user_id).first()
+    if not user_row:
+        return None
+    store_ids = [row.store_id for row in db.session.query(UserStoreAccess.store_id).filter(UserStoreAccess.user_id == user_id)]
+    return UserPrincipal(user_row.id, user_row.username, user_row.user_type, store_ids)
+
+
+def invalidate_user_principal(user_id=None):
+    cache = principal_cache()
+    with _principal_cache_lock:
+        if user_id is None:
+            cache.clear()
+        else:
+            cache.pop(user_id, None)
+
+
 @login_manager.user_loader
 def load_user(user_id):
-    return db.session.get(User, int(user_id))
+    user_id = int(user_id)
+    ttl = current_app.config.get('USER_PRINCIPAL_TTL', 5)
+    now = time.monotonic()
+    cache = principal_cache()
+    with _principal_cache_lock:
+        cached = cache.get(user_id)
+    if cached and cached[0] > now:
+        CACHE_REQUESTS.labels(cache='user_principal', result='hit').inc()
+        return cached[1]
+
+    CACHE_REQUESTS.labels(cache='user_principal', result='miss').inc()
+    principal = build_user_principal(user_id)
+    if principal is not None and ttl > 0:
+        with _principal_cache_lock:
+            cache[user_id] = (now + ttl, principal)
+    return principal
 
 def page_not_found(error):
     return render_template('404.html'), 404
 
+# ======= MÉTRICAS =======
+# Con PROMETHEUS_MULTIPROC_DIR definido, cada worker de gunicorn escribe sus valores en ese directorio
+REQUEST_LATENCY = Histogram(
+    'sisinfo_http_request_duration_seconds',
+    'Duración de las solicitudes HTTP por endpoint.',
+    ['endpoint', 'method'],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+)
+REQUESTS_TOTAL = PrometheusCounter(
+    'sisinfo_http_requests_total', 'Solicitudes HTTP por endpoint y estado.', ['endpoint', 'method', 'status']
+)
+CLOSING_REPORT_LATENCY = Histogram(
+    'sisinfo_closing_report_duration_seconds', 'Tiempo de cálculo del reporte de cierre de caja.'
+)
+INVOICES_CREATED = PrometheusCounter('sisinfo_invoices_created_total', 'Facturas registradas.', ['store_id'])
+INVOICES_VOIDED = PrometheusCounter('sisinfo_invoices_voided_total', 'Facturas anuladas.', ['store_id'])
+INVENTORY_MOVEMENTS = PrometheusCounter(
+    'sisinfo_inventory_movements_total', 'Movimientos de inventario registrados.', ['movement_type']
+)
+CACHE_REQUESTS = PrometheusCounter('sisinfo_cache_requests_total', 'Consultas a cachés internas.', ['cache', 'result'])
+DB_RETRIES = PrometheusCounter('sisinfo_db_retries_total', 'Reintentos por errores transitorios de BD.', ['outcome'])
+DB_POOL_CHECKED_OUT = Gauge(
+    'sisinfo_db_pool_checked_out', 'Conexiones del pool en uso.', ['engine'], multiprocess_mode='livesum'
+)
+DB_POOL_CAPACITY = Gauge(
+    'sisinfo_db_pool_capacity', 'Conexiones máximas del pool (tamaño + overflow).', ['engine'], multiprocess_mode='livesum'
+)
+COMPRESSION_SECONDS = Histogram(
+    'sisinfo_response_compression_seconds', 'Tiempo de compresión de respuestas.', ['encoding', 'content_type'],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5)
+)
+COMPRESSION_RATIO = Histogram(
+    'sisinfo_response_compression_ratio', 'Tamaño comprimido / tamaño original de las respuestas.',
+    ['encoding', 'content_type'], buckets=(0.05, 0.1, 0.15, 0.2, 0.3, 0.4, 0.5, 0.75, 1.0)
+)
+COMPRESSION_BYTES = PrometheusCounter(
+    'sisinfo_response_compression_bytes_total', 'Bytes de respuestas comprimidas antes y después de comprimir.',
+    ['encoding', 'stage']
+)
+DB_REPLICA_LAG = Gauge(
+    'sisinfo_db_replica_lag_seconds', 'Atraso medido de la réplica de lectura.', multiprocess_mode='livemax'
+)
+
+
+def count_on_commit(counter, amount=1, **labels):
+    """Incrementa el contador solo si la transacción actual se confirma."""
+    db.session.info.setdefault('pending_metrics', []).append((counter, amount, labels))
+
+
+@event.listens_for(Session, 'after_commit')
+def apply_pending_metrics(session):
+    for counter, amount, labels in session.info.pop('pending_metrics', []):
+        (counter.labels(**labels) if labels else counter).inc(amount)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def discard_pending_metrics(session, previous_transaction):
+    session.info.pop('pending_metrics', None)
+
+
+def install_pool_metrics(engine, name):
+    pool = engine.pool
+    size = getattr(pool, 'size', None)
+    max_overflow = getattr(pool, '_max_overflow', 0)
+    if callable(size):
+        # set y no inc: crear otra app en el mismo proceso reemplaza el valor
+        DB_POOL_CAPACITY.labels(engine=name).set(size() + max(max_overflow, 0))
+    checked_out = DB_POOL_CHECKED_OUT.labels(engine=name)
+
+    @event.listens_for(engine, 'checkout')
+    def pool_checkout(dbapi_connection, connection_record, connection_proxy):
+        checked_out.inc()
+
+    @event.listens_for(engine, 'checkin')
+    def pool_checkin(dbapi_connection, connection_record):
+        checked_out.dec()
+
+
+def metrics_registry():
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return registry
+    return REGISTRY
+
+# ======= COMPRESIÓN =======
+# Nivel por tipo de contenido; los tipos ausentes no se comprimen
+COMPRESSION_LEVELS = {
+    'application/json': {'br': 4, 'gzip': 6},
+    'text/csv': {'br': 5, 'gzip': 6},
+    'text/html': {'br': 4, 'gzip': 6},
+    'text/css': {'br': 5, 'gzip': 6},
+    'text/javascript': {'br': 5, 'gzip': 6},
+    'application/javascript': {'br': 5, 'gzip': 6},
+}
+COMPRESSION_ENCODINGS = ('br', 'gzip')
+
+
+def negotiate_encoding(accept_encodings, available):
+    """Codificación aceptada por el cliente con mayor calidad; en empate gana el orden de `available`."""
+    best, best_quality = None, 0
+    for encoding in available:
+        quality = accept_encodings[encoding]
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+def record_compression(encoding, content_type, original, compressed, seconds):
+    COMPRESSION_SECONDS.labels(encoding=encoding, content_type=content_type).observe(seconds)
+    COMPRESSION_RATIO.labels(encoding=encoding, content_type=content_type).observe(compressed / original if original else 1.0)
+    COMPRESSION_BYTES.labels(encoding=encoding, stage='original').inc(original)
+    COMPRESSION_BYTES.labels(encoding=encoding, stage='compressed').inc(compressed)
+
+
+def compress_body(data, encoding, level):
+    if encoding == 'br':
+        return brotli.compress(data, quality=level)
+    return gzip.compress(data, compresslevel=level, mtime=0)
+
+
+def compress_chunks(chunks, encoding, level, content_type, flush_size=8192):
+    """
+    Comprime una respuesta en streaming. El compresor se vacía cada
+    `flush_size` bytes de entrada para que el cliente reciba los datos a
+    medida que se generan sin perder la compresión de fragmentos pequeños.
+    """
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=level)
+        process, flush, finish = compressor.process, compressor.flush, compressor.finish
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+        process, flush, finish = compressor.compress, lambda: compressor.flush(zlib.Z_SYNC_FLUSH), compressor.flush
+    original = compressed = pending = 0
+    seconds = 0.0
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode('utf-8')
+            if not chunk:
+                continue
+            started = time.perf_counter()
+            output = process(chunk)
+            pending += len(chunk)
+            if pending >= flush_size:
+                output += flush()
+                pending = 0
+            seconds += time.perf_counter() - started
+            original += len(chunk)
+            compressed += len(output)
+            if output:
+                yield output
+        output = finish()
+        compressed += len(output)
+        yield output
+        record_compression(encoding, content_type, original, compressed, seconds)
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+# ======= ARCHIVOS ESTÁTICOS =======
+STATIC_BUILD_DIR = 'dist'
+STATIC_MANIFEST = 'manifest.json'
+CSS_URL_PATTERN = re.compile(r'url\(\s*([\'"]?)([^\'")]+)\1\s*\)')
+
+
+def fingerprint(path, content):
+    root, extension = posixpath.splitext(path)
+    return f'{root}.{hashlib.sha256(content).hexdigest()[:12]}{extension}'
+
+
+def rewrite_css_urls(css, source, manifest):
+    """Apunta los url() relativos de una hoja de estilos a las versiones con huella."""
+    base = posixpath.dirname(source)
+    output_dir = posixpath.join(STATIC_BUILD_DIR, base)
+
+    def replace(match):
+        quote, target = match.groups()
+        if target.startswith(('data:', 'http:', 'https:', '//', '/', '#')):
+            return match.group(0)
+        resolved = posixpath.normpath(posixpath.join(base, target.split('?')[0].split('#')[0]))
+        if resolved not in manifest:
+            return match.group(0)
+        return f'url({quote}{posixpath.relpath(manifest[resolved], output_dir)}{quote})'
+
+    return CSS_URL_PATTERN.sub(replace, css)
+
+
+def build_static_assets(static_folder, minify=True, clean=False):
+    """
+    Copia los archivos de `static` a `static/dist` con el hash del contenido en
+    el nombre, minificando JS y CSS, y escribe el manifiesto nombre -> versión.
+    Las hojas de estilo se procesan al final para reescribir sus url().
+    """
+    build_dir = os.path.join(static_folder, STATIC_BUILD_DIR)
+    sources = []
+    for root, directories, files in os.walk(static_folder):
+        if os.path.abspath(root) == os.path.abspath(static_folder) and STATIC_BUILD_DIR in directories:
+            directories.remove(STATIC_BUILD_DIR)
+        for name in files:
+            sources.append(os.path.relpath(os.path.join(root, name), static_folder).replace(os.sep, '/'))
+    sources.sort(key=lambda path: (path.endswith('.css'), path))
+
+    manifest = {}
+    sizes = []
+    for source in sources:
+        with open(os.path.join(static_folder, source), 'rb') as handle:
+            content = handle.read()
+        original_size = len(content)
+        if source.endswith('.css'):
+            text = rewrite_css_urls(content.decode('utf-8'), source, manifest)
+            content = (rcssmin.cssmin(text) if minify else text).encode('utf-8')
+        elif source.endswith('.js') and minify:
+            content = rjsmin.jsmin(content.decode('utf-8')).encode('utf-8')
+
+        target = posixpath.join(STATIC_BUILD_DIR, fingerprint(source, content))
+        target_path = os.path.join(static_folder, *target.split('/'))
+        if not os.path.exists(target_path):
+            os.makedirs(os.path.dirname(target_path), exist_ok=True)
+            with open(target_path + '.tmp', 'wb') as handle:
+                handle.write(content)
+            os.replace(target_path + '.tmp', target_path)
+        manifest[source] = target
+        sizes.append((source, original_size, len(content)))
+
+    if clean:
+        current = {os.path.join(static_folder, *target.split('/')) for target in manifest.values()}
+        for root, _, files in os.walk(build_dir):
+            for name in files:
+                path = os.path.join(root, name)
+                if name != STATIC_MANIFEST and path not in current:
+                    os.remove(path)
+
+    manifest_path = os.path.join(build_dir, STATIC_MANIFEST)
+    with open(manifest_path + '.tmp', 'w', encoding='utf-8') as handle:
+        json.dump(manifest, handle, indent=2, sort_keys=True)
+    os.replace(manifest_path + '.tmp', manifest_path)
+    return manifest, sizes
+
+
+def load_static_manifest(static_folder):
+    try:
+        with open(os.path.join(static_folder, STATIC_BUILD_DIR, STATIC_MANIFEST), encoding='utf-8') as handle:
+            return json.load(handle)
+    except FileNotFoundError:
+        return {}
+
+# ======= BASE DE DATOS =======
+REPORT_PATH_PREFIXES = ('/api/reports/', '/api/dashboard/', '/api/pos/closing-report')
+
+# Errores de Azure SQL / SQL Server que indican throttling, failover o bloqueos temporales
+TRANSIENT_DB_ERROR_CODES = {
+    1205, 4060, 4221, 10053, 10054, 10060, 10928, 10929,
+    40143, 40197, 40501, 40540, 40613, 42108, 42109, 49918, 49919, 49920
+}
+TRANSIENT_SQLSTATES = {'08S01', '08001', '08004', '40001', 'HYT00', 'HYT01'}
+TRANSIENT_DB_MESSAGES = ('database is locked', 'connection is busy', 'communication link failure')
+DB_ERROR_CODE_PATTERN = re.compile(r'\((\d{4,5})\)')
+
+db_retry_stats = {'retries': 0, 'recovered': 0, 'exhausted': 0, 'by_code': defaultdict(int)}
+db_retry_stats_lock = threading.Lock()
+
+
+def classify_db_error(exc):
+    """Devuelve el código transitorio del error o None si no debe reintentarse."""
+    if not isinstance(exc, DBAPIError):
+        return None
+    if exc.connection_invalidated:
+        return 'disconnect'
+    args = getattr(exc.orig, 'args', ()) or ()
+    sqlstate = args[0] if args and isinstance(args[0], str) else None
+    message = ' '.join(str(arg) for arg in args)
+    for code in DB_ERROR_CODE_PATTERN.findall(message):
+        if int(code) in TRANSIENT_DB_ERROR_CODES:
+            return code
+    if sqlstate in TRANSIENT_SQLSTATES:
+        return sqlstate
+    lowered = message.lower()
+    for fragment in TRANSIENT_DB_MESSAGES:
+        if fragment in lowered:
+            return fragment
+    return None
+
+
+def record_db_retry(outcome, code=None):
+    DB_RETRIES.labels(outcome=outcome).inc()
+    with db_retry_stats_lock:
+        db_retry_stats[outcome] += 1
+        if code is not None:
+            db_retry_stats['by_code'][str(code)] += 1
+
+
+def db_retry_snapshot():
+    with db_retry_stats_lock:
+        return {**db_retry_stats, 'by_code': dict(db_retry_stats['by_code'])}
+
+
+def run_with_db_retry(operation, config, cleanup=None):
+    """Ejecuta la operación reintentando errores transitorios con backoff exponencial y jitter."""
+    attempts = max(1, config.get('DB_RETRY_ATTEMPTS', 1))
+    base_delay = config.get('DB_RETRY_BASE_DELAY', 0.1)
+    max_delay = config.get('DB_RETRY_MAX_DELAY', 2.0)
+    max_elapsed = config.get('DB_RETRY_MAX_ELAPSED', 10.0)
+    started = time.monotonic()
+    attempt = 0
+    while True:
+        try:
+            result = operation()
+        except DBAPIError as exc:
+            code = classify_db_error(exc)
+            if cleanup:
+                cleanup()
+            if code is None:
+                raise
+            attempt += 1
+            delay = random.uniform(0, min(max_delay, base_delay * (2 ** (attempt - 1))))
+            if attempt >= attempts or time.monotonic() - started + delay > max_elapsed:
+                record_db_retry('exhausted', code)
+                raise
+            record_db_retry('retries', code)
+            time.sleep(delay)
+            continue
+        if attempt:
+            record_db_retry('recovered')
+        return result
+
+
+request_metrics_stats = defaultdict(lambda: {
+    'requests': 0, 'total_ms': 0.0, 'sql_count': 0, 'sql_max': 0, 'db_ms': 0.0,
+    'rows_written': 0, 'serialize_ms': 0.0, 'max_repeat': 0
+})
+request_metrics_lock = threading.Lock()
+
+
+def current_request_metrics():
+    if not has_request_context():
+        return None
+    return g.get('request_metrics')
+
+
+def install_request_sql_metrics(engine):
+    """Acumula en `g.request_metrics` las sentencias, el tiempo de BD y las filas escritas de cada solicitud."""
+    @event.listens_for(engine, 'before_cursor_execute')
+    def start_statement_timer(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('request_query_started', []).append(time.perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def stop_statement_timer(conn, cursor, statement, parameters, context, executemany):
+        started_stack = conn.info.get('request_query_started')
+        started = started_stack.pop() if started_stack else None
+        metrics = current_request_metrics()
+        if metrics is None or started is None:
+            return
+        metrics['sql_count'] += 1
+        metrics['db_ms'] += (time.perf_counter() - started) * 1000
+        metrics['statements'][statement] += 1
+        # Solo filas escritas: el rowcount de un SELECT no es confiable en
+        # todos los drivers y las filas leídas dependen de cómo se consuma el resultado
+        if (context.isinsert or context.isupdate or context.isdelete) and cursor.rowcount > 0:
+            metrics['rows_written'] += cursor.rowcount
+
+    @event.listens_for(engine, 'handle_error')
+    def discard_statement_timer(exception_context):
+        # Una sentencia que falla no llega a after_cursor_execute
+        connection = exception_context.connection
+        started_stack = connection.info.get('request_query_started') if connection is not None else None
+        if started_stack:
+            started_stack.pop()
+
+
+def record_request_metrics(endpoint, metrics):
+    with request_metrics_lock:
+        entry = request_metrics_stats[endpoint]
+        entry['requests'] += 1
+        entry['total_ms'] += metrics['total_ms']
+        entry['sql_count'] += metrics['sql_count']
+        entry['sql_max'] = max(entry['sql_max'], metrics['sql_count'])
+        entry['db_ms'] += metrics['db_ms']
+        entry['rows_written'] += metrics['rows_written']
+        entry['serialize_ms'] += metrics['serialize_ms']
+        entry['max_repeat'] = max(entry['max_repeat'], metrics['max_repeat'])
+
+
+def top_request_metrics(sort='sql_count', limit=20):
+    with request_metrics_lock:
+        snapshot = {endpoint: dict(entry) for endpoint, entry in request_metrics_stats.items()}
+    rows = []
+    for endpoint, entry in snapshot.items():
+        requests_count = entry['requests'] or 1
+        rows.append({
+            'endpoint': endpoint,
+            'requests': entry['requests'],
+            'avg_ms': round(entry['total_ms'] / requests_count, 2),
+            'avg_sql_count': round(entry['sql_count'] / requests_count, 2),
+            'max_sql_count': entry['sql_max'],
+            'avg_db_ms': round(entry['db_ms'] / requests_count, 2),
+            'total_db_ms': round(entry['db_ms'], 2),
+            'avg_rows_written': round(entry['rows_written'] / requests_count, 2),
+            'avg_serialize_ms': round(entry['serialize_ms'] / requests_count, 2),
+            'max_repeated_statement': entry['max_repeat']
+        })
+    sort_keys = {
+        'sql_count': lambda row: row['avg_sql_count'],
+        'db_time': lambda row: row['total_db_ms'],
+        'latency': lambda row: row['avg_ms'],
+        'repeat': lambda row: row['max_repeated_statement'],
+    }
+    rows.sort(key=sort_keys.get(sort, sort_keys['sql_count']), reverse=True)
+    return rows[:limit]
+
+
+slow_query_log = deque(maxlen=200)
+slow_query_lock = threading.Lock()
+slow_query_ids = itertools.count(1)
+
+
+def parameter_shape(parameters, executemany):
+    """Describe los parámetros por tipo, sin exponer sus valores."""
+    sample = parameters[0] if executemany and parameters else parameters
+    if isinstance(sample, dict):
+        types = {key: type(value).__name__ for key, value in sample.items()}
+    elif isinstance(sample, (list, tuple)):
+        types = [type(value).__name__ for value in sample]
+    else:
+        types = None
+    return {'executemany': executemany, 'rows': len(parameters) if executemany else 1, 'types': types}
+
+
+def install_slow_query_recorder(engine, threshold_ms, buffer_size=200):
+    global slow_query_log
+    with slow_query_lock:
+        if slow_query_log.maxlen != buffer_size:
+            slow_query_log = deque(slow_query_log, maxlen=buffer_size)
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def start_slow_query_timer(conn, cursor, statement, parameters, context, executemany):
+        context._slow_query_started = time.perf_counter()
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def record_slow_query(conn, cursor, statement, parameters, context, executemany):
+        started = getattr(context, '_slow_query_started', None)
+        if started is None or context.execution_options.get('skip_slow_query_log'):
+            return
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        if elapsed_ms < threshold_ms:
+            return
+        if has_request_context():
+            origin = f'{request.method} {request.url_rule.rule if request.url_rule else request.path}'
+        else:
+            origin = 'cli/segundo plano'
+        entry = {
+            'id': next(slow_query_ids),
+            'recorded_at': datetime.utcnow().isoformat(timespec='seconds'),
+            'elapsed_ms': round(elapsed_ms, 2),
+            'endpoint': origin,
+            'dialect': conn.engine.dialect.name,
+            'statement': statement,
+            'parameters': parameter_shape(parameters, executemany),
+            'plan': None,
+            # Los valores solo se guardan en memoria para poder obtener el plan
+            '_parameters': parameters[0] if executemany and parameters else parameters,
+            # El plan se pide al mismo motor: los reportes corren en la réplica
+            '_engine': conn.engine
+        }
+        with slow_query_lock:
+            slow_query_log.append(entry)
+
+
+def slow_query_entries(limit=50):
+    with slow_query_lock:
+        entries = list(slow_query_log)[-limit:]
+    return [
+        {key: value for key, value in entry.items() if not key.startswith('_')}
+        for entry in reversed(entries)
+    ]
+
+
+def find_slow_query(entry_id):
+    with slow_query_lock:
+        return next((entry for entry in slow_query_log if entry['id'] == entry_id), None)
+
+
+def capture_query_plan(engine, statement, parameters):
+    """Obtiene el plan estimado de la sentencia sin ejecutarla."""
+    with engine.connect() as connection:
+        connection = connection.execution_options(skip_slow_query_log=True)
+        if engine.dialect.name == 'sqlite':
+            rows = connection.exec_driver_sql('EXPLAIN QUERY PLAN ' + statement, parameters or ()).all()
+            return {'format': 'text', 'plan': [{'id': row[0], 'parent': row[1], 'detail': row[-1]} for row in rows]}
+        if engine.dialect.name == 'mssql':
+            connection.exec_driver_sql('SET SHOWPLAN_XML ON')
+            try:
+                plan = connection.exec_driver_sql(statement, parameters or ()).scalar()
+            finally:
+                connection.exec_driver_sql('SET SHOWPLAN_XML OFF')
+            return {'format': 'xml', 'plan': plan}
+    raise ValueError(f'No se soporta capturar planes para {engine.dialect.name}.')
+
+
+class TimedJSONProvider(DefaultJSONProvider):
+    """
+    Mide el tiempo de serialización JSON de la solicitud en curso. Acepta
+    filas de SQLAlchemy; el resto de tipos se codifica como en Flask.
+    """
+
+    @staticmethod
+    def default(value):
+        if isinstance(value, Row):
+            return value._asdict()
+        return DefaultJSONProvider.default(value)
+
+    def response(self, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return super().response(*args, **kwargs)
+        finally:
+            metrics = current_request_metrics()
+            if metrics is not None:
+                metrics['serialize_ms'] += (time.perf_counter() - started) * 1000
+
+
+class FastJSONProvider(TimedJSONProvider):
+    """
+    Proveedor JSON basado en orjson para los endpoints que entregan filas de
+    la consulta sin convertirlas a mano (ver `jsonify_rows`). date y datetime
+    se codifican de forma nativa (ISO 8601 sin microsegundos) y Decimal como
+    número, a diferencia del proveedor de la aplicación.
+    """
+    sort_keys = False
+    options = orjson.OPT_NON_STR_KEYS | orjson.OPT_OMIT_MICROSECONDS
+
+    @staticmethod
+    def default(value):
+        if isinstance(value, Decimal):
+            return float(value)
+        if isinstance(value, Row):
+            return value._asdict()
+        if isinstance(value, (set, frozenset)):
+            return list(value)
+        return DefaultJSONProvider.default(value)
+
+    @staticmethod
+    def expand_rows(obj):
+        # Convertir las listas de filas de una vez es varias veces más rápido
+        # que dejar que orjson llame a `default` fila por fila
+        if isinstance(obj, list) and obj and isinstance(obj[0], Row):
+            fields = obj[0]._fields
+            return [dict(zip(fields, row)) for row in obj]
+        if isinstance(obj, dict):
+            return {key: FastJSONProvider.expand_rows(value) for key, value in obj.items()}
+        return obj
+
+    def dumps(self, obj, **kwargs):
+        options = self.options
+        if kwargs.get('indent'):
+            options |= orjson.OPT_INDENT_2
+        if kwargs.get('sort_keys'):
+            options |= orjson.OPT_SORT_KEYS
+        return orjson.dumps(self.expand_rows(obj), default=self.default, option=options).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+
+JSON_PROVIDERS = {'default': TimedJSONProvider, 'orjson': FastJSONProvider}
+
+
+def install_db_fault_injector(engine, rate=0.0, code=40613):
+    """Simula errores transitorios de Azure SQL sobre cualquier motor (p. ej. SQLite local)."""
+    state = {'rate': rate, 'code': code, 'pending': 0, 'injected': 0}
+
+    def inject_fault(cursor, statement, *args):
+        if state['pending'] > 0:
+            state['pending'] -= 1
+        elif not state['rate'] or random.random() >= state['rate']:
+            return None
+        state['injected'] += 1
+        raise engine.dialect.dbapi.OperationalError(
+            f"[08S01] Fallo simulado: la base de datos no está disponible ({state['code']})"
+        )
+
+    # Los eventos del dialecto se ejecutan dentro del manejo de errores DBAPI de SQLAlchemy
+    for event_name in ('do_execute', 'do_executemany', 'do_execute_no_params'):
+        event.listen(engine, event_name, inject_fault)
+    return state
+
+
+def install_sqlite_pragmas(engine, pragmas):
+    @event.listens_for(engine, 'connect')
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f'PRAGMA {name}={value}')
+        cursor.close()
+
+
+def engine_pool_status(engine):
+    pool = engine.pool
+    status = {'pool_class': type(pool).__name__, 'status': pool.status()}
+    for metric in ('size', 'checkedin', 'checkedout', 'overflow'):
+        reader = getattr(pool, metric, None)
+        if callable(reader):
+            status[metric] = reader()
+    max_overflow = getattr(pool, '_max_overflow', None)
+    if 'size' in status and max_overflow is not None and max_overflow >= 0:
+        capacity = status['size'] + max_overflow
+        status['max_overflow'] = max_overflow
+        status['utilization'] = round(status.get('checkedout', 0) / capacity, 4) if capacity else 0
+    return status
+
+
+replica_state = {'checked_at': None, 'measured_at': None, 'lag_seconds': None, 'healthy': False, 'error': None}
+replica_lock = threading.Lock()
+
+
+def measure_replica_lag(primary, replica):
+    """
+    Antigüedad en segundos de la factura más vieja que todavía no llegó a la
+    réplica (0 si está al día). Solo usa búsquedas por clave primaria.
+    """
+    with replica.connect() as connection:
+        replicated_id = connection.execute(db.select(func.max(Invoice.id))).scalar() or 0
+    with primary.connect() as connection:
+        oldest_missing = connection.execute(
+            db.select(func.min(Invoice.created_at)).where(Invoice.id > replicated_id)
+        ).scalar()
+    if oldest_missing is None:
+        return 0.0
+    return max((datetime.utcnow() - oldest_missing).total_seconds(), 0.0)
+
+
+def replica_available(config):
+    """
+    Indica si la réplica está dentro del atraso permitido. La medición se
+    repite cada REPLICA_LAG_CHECK_INTERVAL segundos; mientras tanto las demás
+    peticiones usan el último resultado.
+    """
+    with replica_lock:
+        now = time.monotonic()
+        checked_at = replica_state['checked_at']
+        if checked_at is not None and now - checked_at < config['REPLICA_LAG_CHECK_INTERVAL']:
+            return replica_state['healthy']
+        replica_state['checked_at'] = now
+
+    try:
+        lag, error = measure_replica_lag(db.engine, db.engines[REPLICA_BIND]), None
+    except DBAPIError as exc:
+        lag, error = None, str(exc.orig)[:200]
+    healthy = lag is not None and lag <= config['REPLICA_MAX_LAG_SECONDS']
+    replica_state.update(measured_at=datetime.utcnow().isoformat(), lag_seconds=lag, healthy=healthy, error=error)
+    if lag is not None:
+        DB_REPLICA_LAG.set(lag)
+    if not healthy:
+        current_app.logger.warning('Réplica de lectura fuera de servicio (atraso=%s, error=%s)', lag, error)
+    return healthy
+
+
+def missing_indexes(engine):
+    """Índices declarados en los modelos que todavía no existen en la base de datos."""
+    inspector = db.inspect(engine)
+    existing_tables = set(inspector.get_table_names())
+    missing = []
+    for table in db.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+        present = {index['name'] for index in inspector.get_indexes(table.name)}
+        present.update(constraint['name'] for constraint in inspector.get_unique_constraints(table.name))
+        missing.extend(index for index in sorted(table.indexes, key=lambda index: index.name) if index.name not in present)
+    return missing
+
+
+def duplicate_keys_for(connection, index, limit=5):
+    columns = list(index.columns)
+    return connection.execute(
+        db.select(*columns, func.count().label('total'))
+        .group_by(*columns)
+        .having(func.count() > 1)
+        .limit(limit)
+    ).all()
+
+
+def create_index_online(connection, index):
+    statement = str(CreateIndex(index).compile(dialect=connection.dialect))
+    if connection.dialect.name == 'mssql':
+        # Azure SQL permite construir el índice sin bloquear lecturas ni escrituras
+        statement += ' WITH (ONLINE = ON)'
+    connection.exec_driver_sql(statement)
+
+
+def missing_columns(engine):
+    """Columnas nulables declaradas en los modelos que faltan en tablas ya creadas."""
+    inspector = db.inspect(engine)
+    existing_tables = set(inspector.get_table_names())
+    missing = []
+    for table in db.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+        present = {column['name'] for column in inspector.get_columns(table.name)}
+        missing.extend(column for column in table.columns if column.name not in present and column.nullable)
+    return missing
+
+
+def add_column(connection, column):
+    preparer = connection.dialect.identifier_preparer
+    keyword = 'ADD COLUMN' if connection.dialect.name == 'sqlite' else 'ADD'
+    connection.exec_driver_sql(
+        f'ALTER TABLE {preparer.format_table(column.table)} {keyword} '
+        f'{preparer.format_column(column)} {column.type.compile(dialect=connection.dialect)} NULL'
+    )
+
+
+def index_benchmark_queries():
+    """Consultas representativas de los reportes y del POS para comparar planes."""
+    store_id = db.session.query(func.min(Store.id)).scalar() or 0
+    product_id = db.session.query(Inventory.product_id).filter(Inventory.store_id == store_id).limit(1).scalar() or 0
+    user_id = db.session.query(func.min(POSSession.user_id)).scalar() or 0
+    inventory_ids = [row.id for row in db.session.query(Inventory.id).filter(Inventory.store_id == store_id).limit(50)]
+    end = datetime.utcnow()
+    start = end - timedelta(days=30)
+    return [
+        ('ventas_por_sucursal', db.select(func.sum(Sale.total_amount), func.sum(Sale.quantity))
+            .where(Sale.store_id == store_id, Sale.sale_date.between(start, end))),
+        ('facturas_por_sucursal', db.select(func.count(Invoice.id), func.sum(Invoice.total_amount))
+            .where(Invoice.store_id == store_id, Invoice.created_at.between(start, end), Invoice.status != 'void')),
+        ('ventas_por_dia', db.select(Sale.sale_day, func.sum(Sale.total_amount))
+            .where(Sale.store_id == store_id, Sale.sale_day.between(start.date(), end.date()))
+            .group_by(Sale.sale_day)),
+        ('inventario_producto', db.select(Inventory.id, Inventory.quantity)
+            .where(Inventory.product_id == product_id, Inventory.store_id == store_id)),
+        ('alertas_activas', db.select(StockAlert.id)
+            .where(StockAlert.inventory_id.in_(inventory_ids or [-1]), StockAlert.is_active == True)),
+        ('movimientos_recientes', db.select(InventoryMovement.id)
+            .where(InventoryMovement.store_id == store_id)
+            .order_by(InventoryMovement.created_at.desc()).limit(50)),
+        ('caja_abierta', db.select(POSSession.id).where(POSSession.user_id == user_id, POSSession.status == 'open')),
+    ]
+
+
+def summarize_plan(plan):
+    if plan['format'] == 'xml':
+        operators = dict.fromkeys(re.findall(r'PhysicalOp="([^"]+)"', plan['plan'] or ''))
+        return ', '.join(operators)
+    return '; '.join(step['detail'] for step in plan['plan'])
+
+
+def run_index_benchmark(engine, queries, repeat=5):
+    results = {}
+    for name, statement in queries:
+        compiled = statement.compile(dialect=engine.dialect, compile_kwargs={'render_postcompile': True})
+        parameters = tuple(compiled.params[key] for key in compiled.positiontup) if compiled.positional else compiled.params
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            db.session.execute(statement).all()
+            timings.append((time.perf_counter() - started) * 1000)
+        try:
+            plan = summarize_plan(capture_query_plan(engine, str(compiled), parameters))
+        except (ValueError, DBAPIError) as exc:
+            plan = f'sin plan: {exc}'
+        results[name] = {'median_ms': round(percentile(timings, 0.5), 3), 'plan': plan}
+    return results
+
 # ======= FÁBRICA =======
 def create_app(config_class=DevelopmentConfig):
     app = Flask(__name__)
     app.config.from_object(config_class)
+    if not app.config.get('SQLALCHEMY_DATABASE_URI'):
+        app.config['SQLALCHEMY_DATABASE_URI'] = config_class.resolve_database_uri()
+    if not app.config.get('REPLICA_DATABASE_URI') and hasattr(config_class, 'resolve_replica_uri'):
+        app.config['REPLICA_DATABASE_URI'] = config_class.resolve_replica_uri()
     app.config.setdefault('SALES_TAX_RATE', '0.19')
+    app.config.setdefault('BULK_VOID_LIMIT', 500)
+    app.config.setdefault('SALES_PROJECTION_ASYNC', True)
+    app.config.setdefault('SALES_PROJECTION_DRAIN_TIMEOUT', 10)
+    # Corto: otros workers no reciben la invalidación y siguen con el principal
+    # anterior (rol, sucursales o usuario eliminado) hasta que vence
+    app.config.setdefault('USER_PRINCIPAL_TTL', 5)
+    app.config.setdefault('BULK_USER_LIMIT', 200)
+    app.config.setdefault('BULK_HASH_WORKERS', 4)
+    app.config.setdefault('REPORT_ISOLATION_LEVEL', None)
+    app.config.setdefault('REPLICA_DATABASE_URI', None)
+    app.config.setdefault('REPLICA_MAX_LAG_SECONDS', 30)
+    app.config.setdefault('REPLICA_LAG_CHECK_INTERVAL', 10)
+    app.config.setdefault('DB_RETRY_ATTEMPTS', 4)
+    app.config.setdefault('DB_RETRY_BASE_DELAY', 0.1)
+    app.config.setdefault('DB_RETRY_MAX_DELAY', 2.0)
+    app.config.setdefault('DB_RETRY_MAX_ELAPSED', 10.0)
+    app.config.setdefault('DB_FAULT_INJECTION_RATE', None)
+    app.config.setdefault('REQUEST_METRICS_ENABLED', True)
+    app.config.setdefault('SERVER_TIMING_ENABLED', True)
+    app.config.setdefault('REPEATED_SQL_WARNING', 10)
+    app.config.setdefault('SLOW_QUERY_THRESHOLD_MS', 500)
+    app.config.setdefault('SLOW_QUERY_BUFFER_SIZE', 200)
+    app.config.setdefault('METRICS_TOKEN', os.getenv('METRICS_TOKEN'))
+    app.config.setdefault('METRICS_PUBLIC', False)
+    app.config.setdefault('COMPRESSION_ENABLED', True)
+    app.config.setdefault('COMPRESSION_MIN_SIZE', 1024)
+    app.config.setdefault('COMPRESSION_ENCODINGS', COMPRESSION_ENCODINGS)
+    app.config.setdefault('COMPRESSION_LEVELS', dict(COMPRESSION_LEVELS))
+    app.config.setdefault('COMPRESSION_STREAM_FLUSH_SIZE', 8192)
+    app.config.setdefault('STATIC_FINGERPRINTS', not app.debug)
+    app.config.setdefault('STATIC_IMMUTABLE_MAX_AGE', 31536000)
+    app.config.setdefault('JSON_PROVIDER', os.getenv('JSON_PROVIDER', 'orjson'))
+    app.config.setdefault('STORE_TIME_ZONE', os.getenv('STORE_TIME_ZONE', DEFAULT_STORE_TIME_ZONE))
+    # Otros workers no reciben la invalidación al editar una tienda
+    app.config.setdefault('STORE_TIME_ZONE_TTL', 300)
+    if 'SQLALCHEMY_ENGINE_OPTIONS' not in app.config:
+        app.config['SQLALCHEMY_ENGINE_OPTIONS'] = conexion.get_engine_options(app.config)
+    replica_uri = app.config['REPLICA_DATABASE_URI']
+    if replica_uri and REPLICA_BIND not in (app.config.get('SQLALCHEMY_BINDS') or {}):
+        app.config['SQLALCHEMY_BINDS'] = {
+            **(app.config.get('SQLALCHEMY_BINDS') or {}),
+            REPLICA_BIND: {'url': replica_uri, **conexion.get_engine_options({**app.config, 'SQLALCHEMY_DATABASE_URI': replica_uri})}
+        }
 
     db.init_app(app)
     login_manager.init_app(app)
+    app.extensions['user_principals'] = {}
+    app.extensions['store_time_zones'] = {}
     login_manager.login_view = 'login'
 
     app.register_error_handler(404, page_not_found)
 
+    with app.app_context():
+        engines = list(db.engines.values())
+        engine_names = {engine: bind or 'primary' for bind, engine in db.engines.items()}
+
+    if app.config.get('SQLITE_PRAGMAS'):
+        for engine in engines:
+            if engine.dialect.name == 'sqlite':
+                install_sqlite_pragmas(engine, app.config['SQLITE_PRAGMAS'])
+
+    app.json = TimedJSONProvider(app)
+    # Solo los endpoints de filas crudas usan este proveedor; el resto mantiene
+    # el formato de Flask (fechas RFC 822, Decimal como texto)
+    app.extensions['row_json'] = JSON_PROVIDERS[app.config['JSON_PROVIDER']](app)
+    for engine in engines:
+        if app.config['REQUEST_METRICS_ENABLED']:
+            install_request_sql_metrics(engine)
+        install_pool_metrics(engine, engine_names[engine])
+        if app.config['SLOW_QUERY_THRESHOLD_MS'] is not None:
+            install_slow_query_recorder(engine, app.config['SLOW_QUERY_THRESHOLD_MS'], app.config['SLOW_QUERY_BUFFER_SIZE'])
+
+    if app.config['DB_FAULT_INJECTION_RATE'] is not None:
+        with app.app_context():
+            app.extensions['db_fault_injector'] = install_db_fault_injector(db.engine, app.config['DB_FAULT_INJECTION_RATE'])
+
     def ensure_admin_access():
         if current_user.user_type != 1:
             abort(403)
@@ -474,13 +2706,130 @@ def create_app(config_class=DevelopmentConfig):
         if current_user.user_type != 1:
             abort(403)
 
+    request_log = app.logger.getChild('requests')
+
+    @app.before_request
+    def start_request_metrics():
+        if app.config['REQUEST_METRICS_ENABLED'] and request.endpoint != 'static':
+            g.request_metrics = {
+                'started': time.perf_counter(),
+                'sql_count': 0,
+                'db_ms': 0.0,
+                'rows_written': 0,
+                'serialize_ms': 0.0,
+                'statements': Counter()
+            }
+
+    @app.after_request
+    def finish_request_metrics(response):
+        metrics = g.pop('request_metrics', None)
+        if metrics is None:
+            return response
+        metrics['total_ms'] = (time.perf_counter() - metrics.pop('started')) * 1000
+        statements = metrics.pop('statements')
+        repeated_statement, metrics['max_repeat'] = statements.most_common(1)[0] if statements else (None, 0)
+        endpoint = f'{request.method} {request.url_rule.rule if request.url_rule else request.path}'
+        record_request_metrics(endpoint, metrics)
+
+        if app.config['SERVER_TIMING_ENABLED']:
+            app_ms = max(metrics['total_ms'] - metrics['db_ms'] - metrics['serialize_ms'], 0)
+            response.headers['Server-Timing'] = ', '.join([
+                f"db;dur={metrics['db_ms']:.2f};desc=\"{metrics['sql_count']} SQL\"",
+                f"serialize;dur={metrics['serialize_ms']:.2f}",
+                f'app;dur={app_ms:.2f}',
+                f"total;dur={metrics['total_ms']:.2f}"
+            ])
+        request_log.info(json.dumps({
+            'event': 'request',
+            'endpoint': endpoint,
+            'path': request.path,
+            'status': response.status_code,
+            'total_ms': round(metrics['total_ms'], 2),
+            'sql_count': metrics['sql_count'],
+            'db_ms': round(metrics['db_ms'], 2),
+            'rows_written': metrics['rows_written'],
+            'serialize_ms': round(metrics['serialize_ms'], 2),
+            'max_repeat': metrics['max_repeat']
+        }, ensure_ascii=False))
+        if metrics['max_repeat'] >= app.config['REPEATED_SQL_WARNING']:
+            request_log.warning(
+                'Posible N+1 en %s: la misma sentencia se ejecutó %s veces: %s',
+                endpoint, metrics['max_repeat'], ' '.join(repeated_statement.split())[:200]
+            )
+        return response
+
+    @app.before_request
+    def start_latency_timer():
+        g.latency_started = time.perf_counter()
+
+    @app.after_request
+    def observe_request_latency(response):
+        started = g.pop('latency_started', None)
+        if started is None or request.endpoint in ('static', 'prometheus_metrics'):
+            return response
+        endpoint = request.endpoint or 'not_found'
+        REQUEST_LATENCY.labels(endpoint=endpoint, method=request.method).observe(time.perf_counter() - started)
+        REQUESTS_TOTAL.labels(endpoint=endpoint, method=request.method, status=str(response.status_code)).inc()
+        return response
+
+    @app.route('/metrics')
+    def prometheus_metrics():
+        token = app.config['METRICS_TOKEN']
+        # Sin token el endpoint no existe, salvo en perfiles locales que lo habilitan
+        if not token and not app.config['METRICS_PUBLIC']:
+            abort(404)
+        if token and request.headers.get('Authorization') != f'Bearer {token}':
+            abort(401)
+        return app.response_class(generate_latest(metrics_registry()), content_type=CONTENT_TYPE_LATEST)
+
+    def is_report_request():
+        return request.method == 'GET' and request.path.startswith(REPORT_PATH_PREFIXES)
+
+    def replica_configured():
+        return REPLICA_BIND in (app.config.get('SQLALCHEMY_BINDS') or {})
+
+    @app.before_request
+    def route_report_reads():
+        if not replica_configured() or not is_report_request():
+            return
+        # Quien acaba de escribir lee del primario hasta que la réplica alcance sus cambios
+        if flask_session.get('primary_until', 0) > time.time() or not replica_available(app.config):
+            g.db_route = 'primary'
+            return
+        db.session().info['use_replica'] = True
+        g.db_route = 'replica'
+
+    @app.after_request
+    def pin_writes_to_primary(response):
+        if not replica_configured():
+            return response
+        if request.method not in ('GET', 'HEAD', 'OPTIONS') and response.status_code < 400 \
+                and current_user.is_authenticated:
+            flask_session['primary_until'] = time.time() + app.config['REPLICA_MAX_LAG_SECONDS'] \
+                + app.config['REPLICA_LAG_CHECK_INTERVAL']
+        if 'db_route' in g:
+            response.headers['X-Database-Route'] = g.db_route
+        return response
+
+    @app.before_request
+    def use_report_isolation():
+        isolation_level = app.config['REPORT_ISOLATION_LEVEL']
+        if isolation_level and is_report_request() and not db.session().in_transaction():
+            db.session.connection(execution_options={'isolation_level': isolation_level})
+
     def get_accessible_store_ids(user=None):
-        user = user or current_user
+        if user is None:
+            if 'accessible_store_ids' not in g:
+                g.accessible_store_ids = get_accessible_store_ids(current_user._get_current_object())
+            return g.accessible_store_ids
         if not getattr(user, 'is_authenticated', False):
             return []
         if user.user_type == 1:
             return None
-        return [access.store_id for access in user.store_access]
+        store_ids = getattr(user, 'store_ids', None)
+        if store_ids is None:
+            store_ids = [access.store_id for access in user.store_access]
+        return sorted(store_ids)
 
     def apply_store_filter(query, column):
         store_ids = get_accessible_store_ids()
@@ -509,8 +2858,10 @@ def create_app(config_class=DevelopmentConfig):
         custom_start = request.args.get('start_date')
         custom_end = request.args.get('end_date')
 
-        today = date.today()
-        now = datetime.utcnow()
+        # Los límites son días locales de la tienda: se comparan con sale_day y
+        # apply_date_range_filter los pasa a UTC para las columnas de fecha y hora
+        now = utc_to_local(datetime.utcnow(), report_time_zone())
+        today = now.date()
 
         def normalize_day_range(target_date):
             return (
@@ -560,8 +2911,20 @@ def create_app(config_class=DevelopmentConfig):
             adjusted_start = start_date
         return adjusted_start, end_date
 
+    def report_time_zone():
+        return store_time_zone(request.args.get('store_id', type=int))
+
+    def jsonify_rows(*args, **kwargs):
+        return app.extensions['row_json'].response(*args, **kwargs)
+
     def apply_date_range_filter(query, column, start_date, end_date):
-        return query.filter(column >= start_date, column <= end_date)
+        # Para columnas guardadas en UTC: convierte los límites locales del período
+        time_zone = report_time_zone()
+        return query.filter(column >= local_to_utc(start_date, time_zone), column <= local_to_utc(end_date, time_zone))
+
+    def apply_day_range_filter(query, column, start_date, end_date):
+        # Para columnas sale_day: compara días locales completos
+        return query.filter(column >= start_date.date(), column <= end_date.date())
 
     def decimal_to_float(value):
         if value is None:
@@ -584,27 +2947,447 @@ def create_app(config_class=DevelopmentConfig):
         except (InvalidOperation, TypeError):
             return Decimal('0')
 
-    def record_invoice_audit(invoice, action, description, metadatas=None):
-        metadata_payload = metadatas if metadatas is None else json.loads(json.dumps(metadatas))
-        log_entry = InvoiceAuditLog(
-            invoice_id=invoice.id,
-            user_id=current_user.id,
-            action=action,
-            description=description[:255] if description else None,
-            metadatas=metadata_payload
+    projection_lock = threading.Lock()
+    projection_requested = threading.Event()
+    projection_stopping = threading.Event()
+    projection_worker = {'thread': None, 'pid': None}
+    projection_worker_lock = threading.Lock()
+
+    def run_sales_projection():
+        with projection_lock:
+            try:
+                with app.app_context():
+                    project_sales()
+            except Exception:
+                app.logger.exception('Error al proyectar las ventas desde el outbox')
+
+    def sales_projection_worker():
+        # Un solo hilo por proceso: las solicitudes que llegan durante una
+        # pasada se atienden juntas en la siguiente.
+        while True:
+            projection_requested.wait()
+            projection_requested.clear()
+            run_sales_projection()
+            if projection_stopping.is_set() and not projection_requested.is_set():
+                return
+
+    def ensure_sales_projection_worker():
+        with projection_worker_lock:
+            thread = projection_worker['thread']
+            # Tras un fork el hilo del proceso padre no existe en el hijo
+            if thread is not None and thread.is_alive() and projection_worker['pid'] == os.getpid():
+                return
+            thread = threading.Thread(target=sales_projection_worker, name='sales-projection', daemon=True)
+            thread.start()
+            projection_worker.update(thread=thread, pid=os.getpid())
+
+    def stop_sales_projection_worker():
+        thread = projection_worker['thread']
+        if thread is None or not thread.is_alive() or projection_worker['pid'] != os.getpid():
+            return
+        projection_stopping.set()
+        projection_requested.set()
+        thread.join(app.config['SALES_PROJECTION_DRAIN_TIMEOUT'])
+
+    atexit.register(stop_sales_projection_worker)
+
+    def schedule_sales_projection():
+        if app.config['SALES_PROJECTION_ASYNC'] and not projection_stopping.is_set():
+            ensure_sales_projection_worker()
+            projection_requested.set()
+        else:
+            run_sales_projection()
+
+    @app.cli.command('project-sales')
+    @click.option('--all', 'rebuild_all', is_flag=True, help='Vuelve a proyectar todas las facturas.')
+    def project_sales_command(rebuild_all):
+        """Proyecta en `sales` las facturas pendientes del outbox."""
+        if rebuild_all:
+            invoice_ids = [row.id for row in db.session.query(Invoice.id).order_by(Invoice.id)]
+            enqueue_sales_projection(invoice_ids)
+            db.session.commit()
+        click.echo(f'Facturas proyectadas: {project_sales()}')
+
+    @app.cli.command('reindex-customers')
+    @click.option('--batch-size', default=1000, show_default=True)
+    def reindex_customers_command(batch_size):
+        """
+        Agrega las columnas de búsqueda de `customers` y la tabla
+        customer_search_tokens si faltan, y recalcula las claves normalizadas.
+        Los índices se crean después con flask apply-indexes.
+        """
+        # create_all no altera tablas existentes: sin esto toda consulta de
+        # Customer falla con "invalid column name" en bases ya creadas
+        with db.engine.connect() as connection:
+            for column in missing_columns(db.engine):
+                if column.table is Customer.__table__:
+                    add_column(connection, column)
+                    click.echo(f'Columna agregada: {column.table.name}.{column.name}')
+            CustomerSearchToken.__table__.create(connection, checkfirst=True)
+            connection.commit()
+
+        last_id = 0
+        total = 0
+        while True:
+            customers = Customer.query.filter(Customer.id > last_id).order_by(Customer.id).limit(batch_size).all()
+            if not customers:
+                break
+            for customer in customers:
+                customer.refresh_search_keys()
+            db.session.commit()
+            last_id = customers[-1].id
+            total += len(customers)
+        click.echo(f'Clientes reindexados: {total}')
+
+    @app.cli.command('rebuild-customer-stats')
+    @click.option('--verify', is_flag=True, help='Solo compara customer_stats con las facturas, sin escribir.')
+    @click.option('--batch-size', default=1000, show_default=True)
+    def rebuild_customer_stats_command(verify, batch_size):
+        """Reconstruye o verifica la tabla customer_stats a partir de las facturas."""
+        if verify:
+            def as_amount(value):
+                # SQLite devuelve float en las sumas; se comparan ambos lados al centavo
+                return Decimal(str(value or 0)).quantize(Decimal('0.01'))
+
+            expected = {
+                (row[0], row[1]): (int(row[2]), as_amount(row[3]), row[4], row[5])
+                for row in db.session.execute(customer_stats_source())
+            }
+            stored = {
+                (stats.customer_id, stats.store_id): (
+                    int(stats.invoice_count or 0),
+                    as_amount(stats.total_spent),
+                    stats.first_purchase,
+                    stats.last_purchase
+                )
+                for stats in CustomerStats.query.all()
+            }
+            mismatches = sorted(
+                key for key in set(expected) | set(stored)
+                if expected.get(key) != stored.get(key) and (expected.get(key) or stored.get(key)[0])
+            )
+            for customer_id, store_id in mismatches[:50]:
+                click.echo(f'Cliente {customer_id} / sucursal {store_id}: esperado {expected.get((customer_id, store_id))}, '
+                           f'registrado {stored.get((customer_id, store_id))}')
+            click.echo(f'Diferencias encontradas: {len(mismatches)}')
+            if mismatches:
+                raise SystemExit(1)
+            return
+
+        last_id = 0
+        total = 0
+        while True:
+            customer_ids = [
+                row.id for row in db.session.query(Customer.id)
+                .filter(Customer.id > last_id).order_by(Customer.id).limit(batch_size)
+            ]
+            if not customer_ids:
+                break
+            refresh_customer_stats(customer_ids)
+            db.session.commit()
+            last_id = customer_ids[-1]
+            total += len(customer_ids)
+        click.echo(f'Clientes recalculados: {total}')
+
+    @app.cli.command('seed-data')
+    @click.option('--stores', default=5, show_default=True)
+    @click.option('--products', default=2000, show_default=True, help='Cantidad de SKUs (variantes de talla y color).')
+    @click.option('--customers', default=5000, show_default=True)
+    @click.option('--days', default=90, show_default=True, help='Días de historia de ventas hasta hoy.')
+    @click.option('--sales-lines', default=100000, show_default=True, help='Líneas de venta aproximadas a generar.')
+    @click.option('--batch-size', default=5000, show_default=True)
+    @click.option('--password', default='demo1234', show_default=True, help='Contraseña de los usuarios generados.')
+    @click.option('--seed', type=int, help='Semilla para obtener siempre los mismos datos.')
+    @click.option('--create-tables', is_flag=True, help='Crea las tablas faltantes antes de generar.')
+    def seed_data_command(stores, products, customers, days, sales_lines, batch_size, password, seed, create_tables):
+        """
+        Genera datos sintéticos a gran escala para pruebas de rendimiento.
+        Solo funciona sobre SQLite (perfiles local y testing): los ids se
+        asignan en memoria y se insertan explícitos, lo que SQL Server rechaza
+        en columnas IDENTITY sin IDENTITY_INSERT y otros motores no reflejan
+        en sus secuencias.
+        """
+        if db.engine.dialect.name != 'sqlite':
+            click.echo(f'seed-data solo se ejecuta sobre SQLite; la base configurada es {db.engine.dialect.name}. '
+                       'Usa APP_CONFIG=local o LOCAL_DATABASE_URL.')
+            raise SystemExit(1)
+        if create_tables:
+            db.create_all()
+        started = time.monotonic()
+        counts = generate_synthetic_data(
+            stores=stores,
+            products=products,
+            customers=customers,
+            days=days,
+            sales_lines=sales_lines,
+            batch_size=batch_size,
+            password=password,
+            seed=seed,
+            log=click.echo
         )
-        db.session.add(log_entry)
+        for table, total in sorted(counts.items()):
+            click.echo(f'{table}: {total}')
+        click.echo(f'Datos generados en {time.monotonic() - started:.1f} s')
+
+    @app.cli.command('benchmark-json')
+    @click.option('--rows', default=10000, show_default=True, type=click.IntRange(min=1))
+    @click.option('--repeat', default=5, show_default=True, type=click.IntRange(min=1))
+    def benchmark_json_command(rows, repeat):
+        """Compara el costo de serializar filas de ventas con y sin el proveedor orjson."""
+        sale_rows = db.session.query(
+            Sale.id, Sale.store_id, Sale.product_id, Sale.quantity, Sale.total_amount, Sale.sale_date, Sale.sale_day
+        ).order_by(Sale.id.desc()).limit(rows).all()
+        if not sale_rows:
+            click.echo('No hay ventas para medir; ejecuta flask seed-data primero.')
+            raise SystemExit(1)
+        click.echo(f'{len(sale_rows)} filas, {repeat} repeticiones')
+        for name, result in benchmark_json_serialization(app, sale_rows, repeat).items():
+            click.echo(f"{name:<24} {result['ms_per_10k']:>8} ms / 10k filas  {result['bytes']:>10} bytes")
+
+    @app.cli.command('benchmark')
+    @click.option('--scales', default='small', show_default=True, help='Escalas separadas por coma: ' + ', '.join(BENCHMARK_SCALES))
+    @click.option('--iterations', default=10, show_default=True)
+    @click.option('--baseline', 'baseline_path', default='benchmark_baseline.json', show_default=True)
+    @click.option('--update-baseline', is_flag=True, help='Guarda los resultados como nueva línea base.')
+    @click.option('--threshold', default=0.2, show_default=True, help='Regresión tolerada en latencia y memoria (0.2 = 20%).')
+    @click.option('--sql-threshold', default=0.0, show_default=True, help='Regresión tolerada en cantidad de sentencias SQL.')
+    @click.option('--min-delta-ms', default=2.0, show_default=True, help='Diferencia mínima de latencia para considerar regresión.')
+    @click.option('--seed', default=7, show_default=True)
+    def benchmark_command(scales, iterations, baseline_path, update_baseline, threshold, sql_threshold, min_delta_ms, seed):
+        """Mide los endpoints /api/* sobre bases SQLite sembradas y compara con la línea base."""
+        results = {'generated_at': datetime.utcnow().isoformat(timespec='seconds'), 'iterations': iterations, 'scales': {}}
+        for scale in [name.strip() for name in scales.split(',') if name.strip()]:
+            if scale not in BENCHMARK_SCALES:
+                raise click.BadParameter(f'Escala desconocida: {scale}', param_hint='--scales')
+            with tempfile.TemporaryDirectory() as workdir:
+                bench_config = type('BenchmarkConfig', (TestingConfig,), {
+                    'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.join(workdir, 'benchmark.db'),
+                    'SQLITE_PRAGMAS': {'journal_mode': 'WAL', 'synchronous': 'OFF'},
+                    'TESTING': False
+                })
+                bench_app = create_app(bench_config)
+                with bench_app.app_context():
+                    db.create_all()
+                    click.echo(f'[{scale}] generando datos...')
+                    generate_synthetic_data(**BENCHMARK_SCALES[scale], seed=seed)
+                    admin = User(username='benchmark_admin', user_type=1)
+                    admin.set_password('benchmark')
+                    db.session.add(admin)
+                    db.session.commit()
+                    sample_ids = {
+                        'store_id': db.session.query(func.min(Store.id)).scalar(),
+                        'customer_id': db.session.query(CustomerStats.customer_id)
+                            .order_by(CustomerStats.invoice_count.desc()).limit(1).scalar(),
+                        'invoice_id': db.session.query(func.max(Invoice.id)).scalar(),
+                    }
+                    store_id = sample_ids['store_id']
+                    checkout_products = [
+                        row.product_id for row in db.session.query(Inventory.product_id)
+                        .filter(Inventory.store_id == store_id, Inventory.quantity > 100).limit(2)
+                    ]
+                    write_ids = {
+                        'product_id': checkout_products[0] if checkout_products else None,
+                        'target_store_id': db.session.query(func.min(Store.id)).filter(Store.id != store_id).scalar(),
+                        'invoice_items': [
+                            {'invoice_item_id': item.id, 'product_id': item.product_id, 'quantity': item.quantity}
+                            for item in InvoiceItem.query.filter_by(invoice_id=sample_ids['invoice_id'])
+                        ],
+                        'void_invoice_ids': [
+                            row.id for row in db.session.query(Invoice.id)
+                            .filter(Invoice.status != 'void', Invoice.id != sample_ids['invoice_id'])
+                            .order_by(Invoice.id.desc()).limit(iterations + 2)
+                        ]
+                    }
+                    engine = db.engine
+                last_day = date.today()
+                first_day = last_day - timedelta(days=BENCHMARK_SCALES[scale]['days'] - 1)
+                query_args = {
+                    'fecha_inicio': first_day.isoformat(), 'fecha_fin': last_day.isoformat(),
+                    'start_date': first_day.isoformat(), 'end_date': last_day.isoformat(),
+                    'query': 'ma'
+                }
+
+                client = bench_app.test_client()
+                client.post('/login', data={'username': 'benchmark_admin', 'password': 'benchmark'})
+                endpoints = {}
+                for name, url in benchmark_targets(bench_app, sample_ids, query_args):
+                    endpoints[name] = measure_endpoint(client, engine, 'GET', url, iterations)
+                    click.echo(f"[{scale}] {name}: p50 {endpoints[name]['p50_ms']} ms, "
+                               f"p95 {endpoints[name]['p95_ms']} ms, {endpoints[name]['sql_count']} SQL")
+                client.post('/api/pos/session/open', json={'store_id': store_id, 'opening_amount': 0})
+                endpoints['POST /api/pos/checkout'] = measure_endpoint(
+                    client, engine, 'POST', '/api/pos/checkout', iterations,
+                    json_body={'items': [{'product_id': product_id, 'quantity': 1} for product_id in checkout_products]}
+                )
+                click.echo(f"[{scale}] POST /api/pos/checkout: p50 {endpoints['POST /api/pos/checkout']['p50_ms']} ms, "
+                           f"{endpoints['POST /api/pos/checkout']['sql_count']} SQL")
+                for name, method, url, body in benchmark_write_targets({**sample_ids, **write_ids}):
+                    endpoints[name] = measure_endpoint(client, engine, method, url, iterations, json_body=body)
+                    click.echo(f"[{scale}] {name}: p50 {endpoints[name]['p50_ms']} ms, "
+                               f"p95 {endpoints[name]['p95_ms']} ms, {endpoints[name]['sql_count']} SQL, "
+                               f"estado {endpoints[name]['status']}")
+                results['scales'][scale] = {'parameters': BENCHMARK_SCALES[scale], 'endpoints': endpoints}
+                with bench_app.app_context():
+                    db.session.remove()
+                    db.engine.dispose()
+
+        click.echo('Escrituras no medidas:')
+        for name, reason in BENCHMARK_EXCLUDED_WRITES:
+            click.echo(f'  {name}: {reason}')
+
+        if update_baseline or not os.path.exists(baseline_path):
+            with open(baseline_path, 'w', encoding='utf-8') as handle:
+                json.dump(results, handle, indent=2, sort_keys=True)
+            click.echo(f'Línea base guardada en {baseline_path}')
+            return
+
+        with open(baseline_path, encoding='utf-8') as handle:
+            baseline = json.load(handle)
+        regressions = compare_benchmarks(baseline, results, threshold, sql_threshold, min_delta_ms)
+        for regression in regressions:
+            click.echo(f'REGRESIÓN {regression}')
+        if regressions:
+            raise SystemExit(1)
+        click.echo('Sin regresiones frente a la línea base.')
+
+    @app.cli.command('apply-indexes')
+    @click.option('--dry-run', is_flag=True, help='Solo lista los índices faltantes.')
+    @click.option('--benchmark', is_flag=True, help='Compara tiempos y planes antes y después de crear los índices.')
+    def apply_indexes_command(dry_run, benchmark):
+        """Crea en línea los índices declarados en los modelos que falten en la base de datos."""
+        columns = missing_columns(db.engine)
+        if columns:
+            click.echo(
+                'Faltan columnas: ' + ', '.join(f'{column.table.name}.{column.name}' for column in columns)
+                + '. Ejecuta primero flask migrate-columns y flask backfill-sale-buckets.'
+            )
+            raise SystemExit(1)
+        pending = missing_indexes(db.engine)
+        if not pending:
+            click.echo('Todos los índices declarados ya existen.')
+        for index in pending:
+            click.echo(f'Pendiente: {index.name} en {index.table.name} ({", ".join(column.name for column in index.columns)})')
+        if dry_run or not pending:
+            return
+
+        queries = index_benchmark_queries() if benchmark else []
+        before = run_index_benchmark(db.engine, queries) if benchmark else {}
+        db.session.commit()
+
+        created = 0
+        for index in pending:
+            with db.engine.connect() as connection:
+                if index.unique:
+                    duplicates = duplicate_keys_for(connection, index)
+                    if duplicates:
+                        click.echo(f'Omitido {index.name}: hay claves duplicadas, por ejemplo {[tuple(row) for row in duplicates]}')
+                        continue
+                started = time.monotonic()
+                create_index_online(connection, index)
+                connection.commit()
+                created += 1
+                click.echo(f'Creado {index.name} en {time.monotonic() - started:.1f} s')
+        click.echo(f'Índices creados: {created} de {len(pending)}')
+
+        if benchmark:
+            after = run_index_benchmark(db.engine, queries)
+            for name in before:
+                click.echo(f'{name}: {before[name]["median_ms"]} ms -> {after[name]["median_ms"]} ms')
+                click.echo(f'  antes:   {before[name]["plan"]}')
+                click.echo(f'  después: {after[name]["plan"]}')
+
+    @app.cli.command('build-assets')
+    @click.option('--no-minify', is_flag=True, help='Solo agrega la huella sin minificar.')
+    @click.option('--clean', is_flag=True, help='Elimina las versiones anteriores que ya no están en el manifiesto.')
+    def build_assets_command(no_minify, clean):
+        """Genera static/dist con los archivos estáticos minificados y con huella de contenido."""
+        manifest, sizes = build_static_assets(app.static_folder, minify=not no_minify, clean=clean)
+        for source, original_size, built_size in sizes:
+            click.echo(f'{source} -> {manifest[source]} ({original_size} -> {built_size} bytes)')
+        total_before = sum(size for _, size, _ in sizes)
+        total_after = sum(size for _, _, size in sizes)
+        click.echo(f'{len(manifest)} archivos: {total_before} -> {total_after} bytes')
+
+    @app.cli.command('migrate-columns')
+    @click.option('--dry-run', is_flag=True, help='Solo lista las columnas faltantes.')
+    def migrate_columns_command(dry_run):
+        """Agrega a las tablas existentes las columnas nulables declaradas en los modelos que falten."""
+        columns = missing_columns(db.engine)
+        if not columns:
+            click.echo('Todas las columnas declaradas ya existen.')
+            return
+        for column in columns:
+            click.echo(f'Pendiente: {column.table.name}.{column.name} ({column.type})')
+        if dry_run:
+            return
+        with db.engine.connect() as connection:
+            for column in columns:
+                add_column(connection, column)
+                click.echo(f'Columna agregada: {column.table.name}.{column.name}')
+            connection.commit()
+
+    @app.cli.command('backfill-sale-buckets')
+    @click.option('--batch-size', default=5000, show_default=True, type=click.IntRange(min=1))
+    def backfill_sale_buckets_command(batch_size):
+        """Completa el día/hora/día de la semana locales de las facturas y ventas existentes."""
+        if missing_columns(db.engine):
+            click.echo('Faltan columnas en la base de datos. Ejecuta primero flask migrate-columns.')
+            raise SystemExit(1)
+
+        invalidate_store_time_zone()
+        for model, moment_column in ((Invoice, Invoice.created_at), (Sale, Sale.sale_date)):
+            started = time.monotonic()
+            updated = backfill_sale_buckets(model, moment_column, batch_size=batch_size)
+            click.echo(f'{model.__tablename__}: {updated} filas completadas en {time.monotonic() - started:.1f} s')
+        click.echo('Ejecuta flask apply-indexes para crear los índices por día.')
+
+    @app.cli.command('segment-customers')
+    @click.option('--full', is_flag=True, help='Recalcula desde cero en lugar de usar la marca de agua.')
+    def segment_customers_command(full):
+        """Calcula los segmentos RFM de los clientes."""
+        scanned, scored = compute_customer_segments(full=full)
+        click.echo(f'Clientes con compras nuevas: {scanned}. Clientes puntuados: {scored}')
+
+    def record_invoice_audit(invoice, action, description, metadatas=None):
+        g.setdefault('invoice_audit_buffer', []).append({
+            'invoice_id': invoice.id,
+            'user_id': current_user.id,
+            'action': action,
+            'description': description[:255] if description else None,
+            'metadatas': metadatas,
+            'created_at': datetime.utcnow()
+        })
 
-    def serialize_audit_log(entry):
+    def flush_invoice_audit():
+        entries = g.pop('invoice_audit_buffer', None)
+        if entries:
+            db.session.execute(db.insert(InvoiceAuditLog), entries)
+
+    def discard_invoice_audit():
+        g.pop('invoice_audit_buffer', None)
+
+    def serialize_audit_log(entry, snapshot, product_names):
+        items = []
+        for line in (snapshot or {}).get('items', []):
+            unit_price = line.get('unit_price') or 0
+            discount = line.get('discount') or 0
+            items.append({
+                **line,
+                'product_name': line.get('product_name') or product_names.get(line.get('product_id')),
+                'line_total': line.get('line_total', round((unit_price - discount) * (line.get('quantity') or 0), 2))
+            })
         return {
             'id': entry.id,
             'action': entry.action,
             'description': entry.description,
-            'metadatas': entry.metadatas,
-            'user': entry.user.username if entry.user else None,
+            'metadatas': {**snapshot, 'items': items} if snapshot else entry.metadatas,
+            'changes': {key: value for key, value in entry.metadatas.items() if key != 'baseline'}
+            if isinstance(entry.metadatas, dict) else entry.metadatas,
+            'user': entry.username,
             'created_at': entry.created_at.strftime('%Y-%m-%d %H:%M') if entry.created_at else None
         }
 
+    @CLOSING_REPORT_LATENCY.time()
     def compute_closing_report(target_date, store_id=None):
         if store_id:
             ensure_store_permission(store_id)
@@ -852,6 +3635,7 @@ def create_app(config_class=DevelopmentConfig):
 
         db.session.add(user)
         db.session.commit()
+        invalidate_user_principal(user.id)
 
         return jsonify({'message': 'Usuario creado correctamente.', 'user': serialize_user_account(user)}), 201
 
@@ -861,52 +3645,269 @@ def create_app(config_class=DevelopmentConfig):
         ensure_admin_access()
         user = User.query.get_or_404(user_id)
 
-        if user.user_type == 1:
-            return jsonify({'error': 'No es posible modificar este usuario.'}), 400
+        if user.user_type == 1:
+            return jsonify({'error': 'No es posible modificar este usuario.'}), 400
+
+        if request.method == 'DELETE':
+            db.session.delete(user)
+            db.session.commit()
+            invalidate_user_principal(user_id)
+            return jsonify({'message': 'Usuario eliminado correctamente.'})
+
+        data = request.get_json(force=True)
+
+        username = data.get('username')
+        if username is not None:
+            username = username.strip()
+            if not username:
+                return jsonify({'error': 'El nombre de usuario no puede estar vacío.'}), 400
+            existing = User.query.filter(func.lower(User.username) == username.lower(), User.id != user.id).first()
+            if existing:
+                return jsonify({'error': 'El nombre de usuario ya está en uso.'}), 400
+            user.username = username
+
+        if 'user_type' in data:
+            new_type = data.get('user_type')
+            if new_type not in [2, 3]:
+                return jsonify({'error': 'Solo se permiten usuarios tipo gerente o auxiliar.'}), 400
+            user.user_type = new_type
+
+        password = data.get('password')
+        if password:
+            user.set_password(password.strip())
+
+        if 'store_ids' in data:
+            raw_store_ids = data.get('store_ids') or []
+            if not isinstance(raw_store_ids, list) or (user.user_type in [2, 3] and not raw_store_ids):
+                return jsonify({'error': 'Debe asignar al menos una sucursal al usuario.'}), 400
+            try:
+                store_ids = [int(store_id) for store_id in raw_store_ids]
+            except (TypeError, ValueError):
+                return jsonify({'error': 'Las sucursales proporcionadas no son válidas.'}), 400
+            stores = Store.query.filter(Store.id.in_(store_ids)).all()
+            if len(stores) != len(set(store_ids)):
+                return jsonify({'error': 'Alguna de las sucursales seleccionadas no existe.'}), 400
+            current_access = {access.store_id: access for access in user.store_access}
+            user.store_access = [current_access.get(store.id) or UserStoreAccess(store=store) for store in stores]
+
+        db.session.commit()
+        invalidate_user_principal(user.id)
+
+        return jsonify({'message': 'Usuario actualizado correctamente.', 'user': serialize_user_account(user)})
+
+    @app.route('/api/admin/db-pool', methods=['GET'])
+    @login_required
+    def get_db_pool_status():
+        ensure_admin_access()
+        options = app.config.get('SQLALCHEMY_ENGINE_OPTIONS') or {}
+        return jsonify({
+            'dialect': db.engine.dialect.name,
+            'pool': engine_pool_status(db.engine),
+            'engine_options': {key: value for key, value in options.items() if isinstance(value, (bool, int, float, str))},
+            'report_isolation_level': app.config['REPORT_ISOLATION_LEVEL'],
+            'retries': db_retry_snapshot(),
+            'replica': {
+                'pool': engine_pool_status(db.engines[REPLICA_BIND]),
+                'max_lag_seconds': app.config['REPLICA_MAX_LAG_SECONDS'],
+                **{key: value for key, value in replica_state.items() if key != 'checked_at'}
+            } if replica_configured() else None
+        })
+
+    @app.route('/api/admin/request-stats', methods=['GET'])
+    @login_required
+    def get_request_stats():
+        ensure_admin_access()
+        sort = request.args.get('sort', 'sql_count')
+        limit = min(max(request.args.get('limit', 20, type=int), 1), 200)
+        return jsonify({'sort': sort, 'endpoints': top_request_metrics(sort, limit)})
+
+    @app.route('/api/admin/slow-queries', methods=['GET', 'DELETE'])
+    @login_required
+    def manage_slow_queries():
+        ensure_admin_access()
+        if request.method == 'DELETE':
+            with slow_query_lock:
+                slow_query_log.clear()
+            return jsonify({'message': 'Registro de consultas lentas vaciado.'})
+        limit = min(max(request.args.get('limit', 50, type=int), 1), 500)
+        return jsonify({
+            'threshold_ms': app.config['SLOW_QUERY_THRESHOLD_MS'],
+            'queries': slow_query_entries(limit)
+        })
+
+    @app.route('/api/admin/slow-queries/<int:entry_id>/plan', methods=['POST'])
+    @login_required
+    def capture_slow_query_plan(entry_id):
+        ensure_admin_access()
+        entry = find_slow_query(entry_id)
+        if not entry:
+            return jsonify({'error': 'La consulta ya no está en el registro.'}), 404
+        try:
+            plan = capture_query_plan(entry['_engine'], entry['statement'], entry['_parameters'])
+        except ValueError as exc:
+            return jsonify({'error': str(exc)}), 400
+        except DBAPIError as exc:
+            return jsonify({'error': f'No fue posible obtener el plan: {exc.orig}'}), 400
+        with slow_query_lock:
+            entry['plan'] = plan
+        return jsonify({'id': entry_id, 'plan': plan})
+
+    @app.route('/api/users/bulk', methods=['POST'])
+    @login_required
+    def bulk_provision_users():
+        ensure_admin_access()
+        data = request.get_json(force=True)
+        rows = data.get('users') if isinstance(data, dict) else None
+        if not isinstance(rows, list) or not rows:
+            return jsonify({'error': 'Debe enviar la lista de usuarios a registrar.'}), 400
+        limit = app.config['BULK_USER_LIMIT']
+        if len(rows) > limit:
+            return jsonify({'error': f'Solo se pueden procesar hasta {limit} usuarios por solicitud.'}), 400
+
+        errors = []
+        parsed = []
+        for index, row in enumerate(rows):
+            if not isinstance(row, dict):
+                errors.append({'index': index, 'error': 'El registro no es válido.'})
+                continue
+            user_id = row.get('id')
+            username = (row.get('username') or '').strip()
+            password = (row.get('password') or '').strip()
+            user_type = row.get('user_type')
+            raw_store_ids = row.get('store_ids')
+            try:
+                user_id = int(user_id) if user_id is not None else None
+                store_ids = None if raw_store_ids is None and user_id else [int(store_id) for store_id in raw_store_ids or []]
+            except (TypeError, ValueError):
+                errors.append({'index': index, 'username': username, 'error': 'Los identificadores proporcionados no son válidos.'})
+                continue
+
+            if user_id is None and (not username or not password):
+                error = 'El nombre de usuario y la contraseña son obligatorios.'
+            elif user_id is not None and 'username' in row and not username:
+                error = 'El nombre de usuario no puede estar vacío.'
+            elif (user_id is None or 'user_type' in row) and user_type not in [2, 3]:
+                error = 'Solo se pueden crear usuarios de tipo gerente o auxiliar.'
+            elif store_ids is not None and not store_ids:
+                error = 'Debe asignar al menos una sucursal al usuario.'
+            else:
+                error = None
+            if error:
+                errors.append({'index': index, 'username': username, 'error': error})
+                continue
+            parsed.append({
+                'index': index,
+                'id': user_id,
+                'username': username or None,
+                'password': password or None,
+                'user_type': user_type,
+                'store_ids': store_ids
+            })
+
+        requested_names = {entry['username'].lower() for entry in parsed if entry['username']}
+        requested_ids = {entry['id'] for entry in parsed if entry['id']}
+        known_users = db.session.query(User.id, User.username, User.user_type).filter(
+            or_(
+                func.lower(User.username).in_(requested_names or ['']),
+                User.id.in_(requested_ids or [-1])
+            )
+        ).all()
+        owners_by_name = {row.username.lower(): row.id for row in known_users}
+        users_by_id = {row.id: row for row in known_users if row.id in requested_ids}
 
-        if request.method == 'DELETE':
-            db.session.delete(user)
-            db.session.commit()
-            return jsonify({'message': 'Usuario eliminado correctamente.'})
+        requested_store_ids = {store_id for entry in parsed for store_id in entry['store_ids'] or []}
+        existing_store_ids = {
+            row.id for row in db.session.query(Store.id).filter(Store.id.in_(requested_store_ids or [-1]))
+        }
 
-        data = request.get_json(force=True)
+        accepted = []
+        claimed_names = {}
+        for entry in parsed:
+            name_key = entry['username'].lower() if entry['username'] else None
+            target = users_by_id.get(entry['id']) if entry['id'] else None
+            if entry['id'] and target is None:
+                error = 'El usuario no existe.'
+            elif target is not None and target.user_type == 1:
+                error = 'No es posible modificar este usuario.'
+            elif name_key and owners_by_name.get(name_key, entry['id']) != entry['id']:
+                error = 'El nombre de usuario ya está en uso.'
+            elif name_key and name_key in claimed_names:
+                error = 'El nombre de usuario está repetido en la solicitud.'
+            elif set(entry['store_ids'] or []) - existing_store_ids:
+                error = 'Alguna de las sucursales seleccionadas no existe.'
+            else:
+                error = None
+            if error:
+                errors.append({'index': entry['index'], 'username': entry['username'], 'error': error})
+                continue
+            if name_key:
+                claimed_names[name_key] = entry['index']
+            accepted.append(entry)
 
-        username = data.get('username')
-        if username is not None:
-            username = username.strip()
-            if not username:
-                return jsonify({'error': 'El nombre de usuario no puede estar vacío.'}), 400
-            existing = User.query.filter(func.lower(User.username) == username.lower(), User.id != user.id).first()
-            if existing:
-                return jsonify({'error': 'El nombre de usuario ya está en uso.'}), 400
-            user.username = username
+        to_hash = [entry for entry in accepted if entry['password']]
+        if to_hash:
+            workers = max(1, min(app.config['BULK_HASH_WORKERS'], len(to_hash)))
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                hashes = list(executor.map(generate_password_hash, [entry['password'] for entry in to_hash]))
+            for entry, password_hash in zip(to_hash, hashes):
+                entry['password_hash'] = password_hash
 
-        if 'user_type' in data:
-            new_type = data.get('user_type')
-            if new_type not in [2, 3]:
-                return jsonify({'error': 'Solo se permiten usuarios tipo gerente o auxiliar.'}), 400
-            user.user_type = new_type
+        creates = [entry for entry in accepted if not entry['id']]
+        updates = [entry for entry in accepted if entry['id']]
 
-        password = data.get('password')
-        if password:
-            user.set_password(password.strip())
+        try:
+            if creates:
+                inserted = db.session.execute(
+                    db.insert(User).returning(User.id, User.username, sort_by_parameter_order=True),
+                    [
+                        {
+                            'username': entry['username'],
+                            'password_hash': entry['password_hash'],
+                            'user_type': entry['user_type']
+                        }
+                        for entry in creates
+                    ]
+                ).all()
+                for entry, row in zip(creates, inserted):
+                    entry['id'] = row.id
+
+            if updates:
+                db.session.execute(db.update(User), [
+                    {
+                        'id': entry['id'],
+                        **({'username': entry['username']} if entry['username'] else {}),
+                        **({'user_type': entry['user_type']} if entry['user_type'] in [2, 3] else {}),
+                        **({'password_hash': entry['password_hash']} if entry.get('password_hash') else {})
+                    }
+                    for entry in updates
+                    if entry['username'] or entry['user_type'] in [2, 3] or entry.get('password_hash')
+                ])
+                replaced_ids = [entry['id'] for entry in updates if entry['store_ids'] is not None]
+                if replaced_ids:
+                    UserStoreAccess.query.filter(UserStoreAccess.user_id.in_(replaced_ids)).delete(synchronize_session=False)
+
+            access_rows = [
+                {'user_id': entry['id'], 'store_id': store_id}
+                for entry in accepted if entry['store_ids'] is not None
+                for store_id in sorted(set(entry['store_ids']))
+            ]
+            if access_rows:
+                db.session.execute(db.insert(UserStoreAccess), access_rows)
 
-        if 'store_ids' in data:
-            raw_store_ids = data.get('store_ids') or []
-            if not isinstance(raw_store_ids, list) or (user.user_type in [2, 3] and not raw_store_ids):
-                return jsonify({'error': 'Debe asignar al menos una sucursal al usuario.'}), 400
-            try:
-                store_ids = [int(store_id) for store_id in raw_store_ids]
-            except (TypeError, ValueError):
-                return jsonify({'error': 'Las sucursales proporcionadas no son válidas.'}), 400
-            stores = Store.query.filter(Store.id.in_(store_ids)).all()
-            if len(stores) != len(set(store_ids)):
-                return jsonify({'error': 'Alguna de las sucursales seleccionadas no existe.'}), 400
-            user.store_access = [UserStoreAccess(store=store) for store in stores]
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            return jsonify({'error': 'No fue posible registrar los usuarios. Verifica los datos enviados.'}), 400
 
-        db.session.commit()
+        for entry in updates:
+            invalidate_user_principal(entry['id'])
 
-        return jsonify({'message': 'Usuario actualizado correctamente.', 'user': serialize_user_account(user)})
+        return jsonify({
+            'message': f'{len(creates)} usuarios creados y {len(updates)} actualizados.',
+            'created': [{'index': entry['index'], 'id': entry['id'], 'username': entry['username']} for entry in creates],
+            'updated': [{'index': entry['index'], 'id': entry['id']} for entry in updates],
+            'errors': sorted(errors, key=lambda error: error['index'])
+        })
 
     @app.route('/products_clients')
     @login_required
@@ -1183,19 +4184,18 @@ def create_app(config_class=DevelopmentConfig):
         total_units = sum(int(row.units or 0) for row in current_rows)
         total_revenue = sum(decimal_to_float(row.revenue or 0) for row in current_rows)
 
-        sale_day = cast(Sale.sale_date, Date).label('sale_day')
         history_query = db.session.query(
             Sale.product_id,
-            sale_day,
+            Sale.sale_day,
             func.coalesce(func.sum(Sale.quantity), 0).label('units'),
             func.coalesce(func.sum(Sale.total_amount), 0).label('revenue')
         ).select_from(Sale) \
          .join(Product, Sale.product_id == Product.id)
         history_query = apply_store_selection_filter(history_query, Sale.store_id)
-        history_query = apply_date_range_filter(history_query, Sale.sale_date, period_start, period_end)
+        history_query = apply_day_range_filter(history_query, Sale.sale_day, period_start, period_end)
         if category_id:
             history_query = history_query.filter(Product.category_id == category_id)
-        history_query = history_query.group_by(Sale.product_id, sale_day)
+        history_query = history_query.group_by(Sale.product_id, Sale.sale_day)
         history_rows = history_query.all()
 
         history_map = defaultdict(list)
@@ -1259,6 +4259,7 @@ def create_app(config_class=DevelopmentConfig):
             Invoice.id.label('invoice_id'),
             Invoice.customer_id.label('customer_id'),
             Invoice.created_at.label('created_at'),
+            Invoice.sale_day.label('sale_day'),
             func.coalesce(func.sum(InvoiceItem.line_total), 0).label('amount')
         ).select_from(Invoice) \
          .join(InvoiceItem, InvoiceItem.invoice_id == Invoice.id) \
@@ -1268,14 +4269,12 @@ def create_app(config_class=DevelopmentConfig):
         if category_id:
             base_invoice_query = base_invoice_query.filter(Product.category_id == category_id)
 
-        current_invoices = base_invoice_query \
-            .filter(Invoice.created_at >= period_start, Invoice.created_at <= period_end) \
-            .group_by(Invoice.id, Invoice.customer_id, Invoice.created_at) \
+        current_invoices = apply_day_range_filter(base_invoice_query, Invoice.sale_day, period_start, period_end) \
+            .group_by(Invoice.id, Invoice.customer_id, Invoice.created_at, Invoice.sale_day) \
             .all()
 
-        previous_invoices = base_invoice_query \
-            .filter(Invoice.created_at >= prev_start, Invoice.created_at <= prev_end) \
-            .group_by(Invoice.id, Invoice.customer_id, Invoice.created_at) \
+        previous_invoices = apply_day_range_filter(base_invoice_query, Invoice.sale_day, prev_start, prev_end) \
+            .group_by(Invoice.id, Invoice.customer_id, Invoice.created_at, Invoice.sale_day) \
             .all()
 
         def aggregate_invoices(rows):
@@ -1288,8 +4287,7 @@ def create_app(config_class=DevelopmentConfig):
                 if row.customer_id:
                     unique_customers.add(row.customer_id)
                     invoices_per_customer[row.customer_id].append(row)
-                day = row.created_at.date()
-                daily_totals[day] += row.amount or Decimal('0')
+                daily_totals[row.sale_day] += row.amount or Decimal('0')
             return total_amount, unique_customers, invoices_per_customer, daily_totals
 
         current_total, current_customers, current_invoices_map, current_daily = aggregate_invoices(current_invoices)
@@ -1302,7 +4300,7 @@ def create_app(config_class=DevelopmentConfig):
         margin_previous = previous_total * margin_ratio
 
         customer_history_query = base_invoice_query \
-            .group_by(Invoice.id, Invoice.customer_id, Invoice.created_at)
+            .group_by(Invoice.id, Invoice.customer_id, Invoice.created_at, Invoice.sale_day)
         customer_history_rows = customer_history_query.all()
 
         customer_first_purchase = {}
@@ -1310,8 +4308,8 @@ def create_app(config_class=DevelopmentConfig):
             if row.customer_id is None:
                 continue
             first_purchase = customer_first_purchase.get(row.customer_id)
-            if not first_purchase or row.created_at < first_purchase:
-                customer_first_purchase[row.customer_id] = row.created_at
+            if row.sale_day and (not first_purchase or row.sale_day < first_purchase):
+                customer_first_purchase[row.customer_id] = row.sale_day
 
         new_customers = 0
         recurring_customers = 0
@@ -1321,7 +4319,7 @@ def create_app(config_class=DevelopmentConfig):
         for customer_id, invoices in current_invoices_map.items():
             first_purchase = customer_first_purchase.get(customer_id)
             customer_amount = sum((invoice.amount or Decimal('0')) for invoice in invoices)
-            if first_purchase and first_purchase >= period_start:
+            if first_purchase and first_purchase >= period_start.date():
                 new_customers += 1
                 new_revenue += customer_amount
             else:
@@ -1419,29 +4417,27 @@ def create_app(config_class=DevelopmentConfig):
 
         sales_query = db.session.query(
             Sale.store_id,
-            Sale.sale_date,
-            func.coalesce(Sale.total_amount, 0).label('amount')
-        ).select_from(Sale) \
-         .join(Product, Sale.product_id == Product.id)
+            Sale.sale_weekday,
+            Sale.sale_hour,
+            func.coalesce(func.sum(Sale.total_amount), 0).label('amount')
+        ).select_from(Sale)
 
         sales_query = apply_store_selection_filter(sales_query, Sale.store_id)
-        sales_query = apply_date_range_filter(sales_query, Sale.sale_date, period_start, period_end)
+        sales_query = apply_day_range_filter(sales_query, Sale.sale_day, period_start, period_end)
         if category_id:
-            sales_query = sales_query.filter(Product.category_id == category_id)
+            sales_query = sales_query.join(Product, Sale.product_id == Product.id) \
+                .filter(Product.category_id == category_id)
 
-        sales_rows = sales_query.all()
+        sales_rows = sales_query.group_by(Sale.store_id, Sale.sale_weekday, Sale.sale_hour).all()
 
         heatmap = defaultdict(lambda: defaultdict(lambda: defaultdict(float)))
         totals_per_store = defaultdict(float)
 
         for row in sales_rows:
-            sale_date = row.sale_date
-            if not sale_date:
+            if row.sale_weekday is None:
                 continue
-            weekday = sale_date.weekday()
-            hour = sale_date.hour
             amount = decimal_to_float(row.amount or 0)
-            heatmap[row.store_id][weekday][hour] += amount
+            heatmap[row.store_id][row.sale_weekday][row.sale_hour] += amount
             totals_per_store[row.store_id] += amount
 
         day_labels = ['Lunes', 'Martes', 'Miércoles', 'Jueves', 'Viernes', 'Sábado', 'Domingo']
@@ -1579,20 +4575,18 @@ def create_app(config_class=DevelopmentConfig):
                 'margin': margin_value
             })
 
-        sale_day = cast(Sale.sale_date, Date).label('sale_day')
         seasonality_query = db.session.query(
             Category.id.label('category_id'),
-            sale_day,
+            Sale.sale_day,
             func.coalesce(func.sum(Sale.total_amount), 0).label('revenue')
         ).select_from(Sale) \
          .join(Product, Sale.product_id == Product.id) \
          .outerjoin(Category, Product.category_id == Category.id)
 
-        seasonality_query = seasonality_query.group_by(Category.id, sale_day)
-        seasonality_query = apply_date_range_filter(seasonality_query, Sale.sale_date, period_start - timedelta(days=365), period_end)
+        seasonality_query = apply_day_range_filter(seasonality_query, Sale.sale_day, period_start - timedelta(days=365), period_end)
         if category_id:
             seasonality_query = seasonality_query.filter(Category.id == category_id)
-        seasonality_query = seasonality_query.group_by(Category.id, sale_day)
+        seasonality_query = seasonality_query.group_by(Category.id, Sale.sale_day)
         seasonality_rows = seasonality_query.all()
 
         seasonality_map = defaultdict(lambda: defaultdict(float))
@@ -1650,20 +4644,23 @@ def create_app(config_class=DevelopmentConfig):
     @app.route('/api/inventory/overview', methods=['GET'])
     @login_required
     def inventory_overview():
+        min_stock = func.coalesce(Inventory.min_stock, 0)
+        quantity = func.coalesce(Inventory.quantity, 0)
+        # Las filas se entregan tal cual al proveedor JSON
         inventory_query = db.session.query(
             Inventory.id.label('inventory_id'),
-            Inventory.quantity,
-            Inventory.min_stock,
             Product.id.label('product_id'),
             Product.name.label('product_name'),
             Product.sku,
             Product.size,
             Product.color,
-            Product.price,
-            Category.name.label('category_name'),
+            Category.name.label('category'),
             Store.id.label('store_id'),
             Store.name.label('store_name'),
-            Store.location
+            Store.location,
+            quantity.label('quantity'),
+            min_stock.label('min_stock'),
+            case((quantity <= min_stock, true()), else_=false()).label('low_stock')
         ).join(Product, Inventory.product_id == Product.id) \
          .join(Store, Inventory.store_id == Store.id) \
          .outerjoin(Category, Product.category_id == Category.id) \
@@ -1672,49 +4669,11 @@ def create_app(config_class=DevelopmentConfig):
         inventory_query = apply_store_filter(inventory_query, Store.id)
         inventory_rows = inventory_query.all()
 
-        items = []
-        total_units = 0
-        low_stock_count = 0
-        sizes = set()
-        colors = set()
-        categories = set()
-
-        product_min_stock = {}
-
-        for row in inventory_rows:
-            total_units += int(row.quantity or 0)
-            min_stock = row.min_stock or 0
-            is_low = (row.quantity or 0) <= min_stock
-            if is_low:
-                low_stock_count += 1
-
-            if row.product_id not in product_min_stock:
-                product_min_stock[row.product_id] = int(min_stock)
-            else:
-                product_min_stock[row.product_id] = min(product_min_stock[row.product_id], int(min_stock))
-
-            if row.size:
-                sizes.add(row.size)
-            if row.color:
-                colors.add(row.color)
-            if row.category_name:
-                categories.add(row.category_name)
-
-            items.append({
-                'inventory_id': row.inventory_id,
-                'product_id': row.product_id,
-                'product_name': row.product_name,
-                'sku': row.sku,
-                'size': row.size,
-                'color': row.color,
-                'category': row.category_name,
-                'store_id': row.store_id,
-                'store_name': row.store_name,
-                'location': row.location,
-                'quantity': int(row.quantity or 0),
-                'min_stock': int(row.min_stock or 0),
-                'low_stock': is_low
-            })
+        total_units = sum(int(row.quantity or 0) for row in inventory_rows)
+        low_stock_count = sum(1 for row in inventory_rows if row.low_stock)
+        sizes = {row.size for row in inventory_rows if row.size}
+        colors = {row.color for row in inventory_rows if row.color}
+        categories = {row.category for row in inventory_rows if row.category}
 
         active_alerts_query = db.session.query(func.count(StockAlert.id)).join(
             Inventory, StockAlert.inventory_id == Inventory.id
@@ -1738,12 +4697,28 @@ def create_app(config_class=DevelopmentConfig):
         stores_query = Store.query.filter_by(active=True)
         if store_ids is not None:
             stores_query = stores_query.filter(Store.id.in_(store_ids))
-        stores = stores_query.order_by(Store.name).all()
-        products = Product.query.order_by(Product.name).all()
+        stores = stores_query.with_entities(Store.id, Store.name, Store.location).order_by(Store.name).all()
 
-        return jsonify({
+        product_min_stock = apply_store_filter(
+            db.session.query(Inventory.product_id, func.min(min_stock).label('min_stock')),
+            Inventory.store_id
+        ).group_by(Inventory.product_id).subquery()
+        products = db.session.query(
+            Product.id,
+            Product.name,
+            Product.sku,
+            Product.size,
+            Product.color,
+            Category.name.label('category'),
+            Product.price,
+            product_min_stock.c.min_stock
+        ).outerjoin(Category, Product.category_id == Category.id) \
+         .outerjoin(product_min_stock, product_min_stock.c.product_id == Product.id) \
+         .order_by(Product.name).all()
+
+        return jsonify_rows({
             'summary': {
-                'total_items': len(items),
+                'total_items': len(inventory_rows),
                 'total_units': total_units,
                 'low_stock': low_stock_count,
                 'pending_transfers': pending_transfers,
@@ -1754,24 +4729,9 @@ def create_app(config_class=DevelopmentConfig):
                 'colors': sorted(colors),
                 'categories': sorted(categories)
             },
-            'items': items,
-            'stores': [
-                {'id': store.id, 'name': store.name, 'location': store.location}
-                for store in stores
-            ],
-            'products': [
-                {
-                    'id': product.id,
-                    'name': product.name,
-                    'sku': product.sku,
-                    'size': product.size,
-                    'color': product.color,
-                    'category': product.category.name if product.category else None,
-                    'price': float(product.price) if product.price is not None else None,
-                    'min_stock': product_min_stock.get(product.id)
-                }
-                for product in products
-            ]
+            'items': inventory_rows,
+            'stores': stores,
+            'products': products
         })
 
     @app.route('/api/inventory/alerts', methods=['GET'])
@@ -2066,18 +5026,45 @@ def create_app(config_class=DevelopmentConfig):
             target_store = aliased(Store)
             approver_user = aliased(User)
             confirmer_user = aliased(User)
+            store_ids = get_accessible_store_ids()
+
+            status_labels = {
+                'pending': 'Pendiente de aprobación',
+                'approved': 'Aprobada / En tránsito',
+                'completed': 'Recibida',
+                'rejected': 'Rechazada'
+            }
+
+            def transfer_permission(status, store_column):
+                if current_user.user_type not in [1, 2]:
+                    return false()
+                condition = TransferRequest.status == status
+                if store_ids is not None:
+                    condition = and_(condition, store_column.in_(store_ids))
+                return case((condition, true()), else_=false())
 
+            # Las filas se entregan tal cual al proveedor JSON
             transfers_query = db.session.query(
-                TransferRequest,
+                TransferRequest.id,
                 Product.name.label('product_name'),
                 Product.sku,
+                TransferRequest.quantity,
+                TransferRequest.status,
+                # Los estados sin etiqueta llegan tal cual y el cliente los capitaliza
+                case(status_labels, value=TransferRequest.status, else_=TransferRequest.status).label('status_label'),
                 Store.name.label('source_store'),
                 Store.location.label('source_location'),
                 target_store.name.label('target_store'),
                 target_store.location.label('target_location'),
-                User.username.label('requester_name'),
-                approver_user.username.label('approver_name'),
-                confirmer_user.username.label('confirmer_name')
+                TransferRequest.requested_at,
+                TransferRequest.approved_at,
+                TransferRequest.confirmed_at,
+                User.username.label('requested_by'),
+                approver_user.username.label('approved_by'),
+                confirmer_user.username.label('confirmed_by'),
+                TransferRequest.notes,
+                transfer_permission('pending', TransferRequest.source_store_id).label('can_approve'),
+                transfer_permission('approved', TransferRequest.target_store_id).label('can_confirm')
             ).join(Product, TransferRequest.product_id == Product.id) \
              .join(Store, TransferRequest.source_store_id == Store.id) \
              .join(target_store, TransferRequest.target_store_id == target_store.id) \
@@ -2086,7 +5073,6 @@ def create_app(config_class=DevelopmentConfig):
              .outerjoin(confirmer_user, TransferRequest.confirmed_by == confirmer_user.id) \
              .order_by(TransferRequest.requested_at.desc())
 
-            store_ids = get_accessible_store_ids()
             if store_ids is not None:
                 transfers_query = transfers_query.filter(
                     or_(
@@ -2095,49 +5081,7 @@ def create_app(config_class=DevelopmentConfig):
                     )
                 )
 
-            transfers = transfers_query.all()
-
-            status_labels = {
-                'pending': 'Pendiente de aprobación',
-                'approved': 'Aprobada / En tránsito',
-                'completed': 'Recibida',
-                'rejected': 'Rechazada'
-            }
-
-            accessible_ids = None if store_ids is None else set(store_ids)
-
-            return jsonify([
-                {
-                    'id': transfer.TransferRequest.id,
-                    'product_name': transfer.product_name,
-                    'sku': transfer.sku,
-                    'quantity': int(transfer.TransferRequest.quantity),
-                    'status': transfer.TransferRequest.status,
-                    'status_label': status_labels.get(transfer.TransferRequest.status, transfer.TransferRequest.status.title()),
-                    'source_store': transfer.source_store,
-                    'source_location': transfer.source_location,
-                    'target_store': transfer.target_store,
-                    'target_location': transfer.target_location,
-                    'requested_at': transfer.TransferRequest.requested_at.strftime('%Y-%m-%d %H:%M'),
-                    'approved_at': transfer.TransferRequest.approved_at.strftime('%Y-%m-%d %H:%M') if transfer.TransferRequest.approved_at else None,
-                    'confirmed_at': transfer.TransferRequest.confirmed_at.strftime('%Y-%m-%d %H:%M') if transfer.TransferRequest.confirmed_at else None,
-                    'requested_by': transfer.requester_name,
-                    'approved_by': transfer.approver_name,
-                    'confirmed_by': transfer.confirmer_name,
-                    'notes': transfer.TransferRequest.notes,
-                    'can_approve': (
-                        current_user.user_type in [1, 2]
-                        and transfer.TransferRequest.status == 'pending'
-                        and (accessible_ids is None or transfer.TransferRequest.source_store_id in accessible_ids)
-                    ),
-                    'can_confirm': (
-                        current_user.user_type in [1, 2]
-                        and transfer.TransferRequest.status == 'approved'
-                        and (accessible_ids is None or transfer.TransferRequest.target_store_id in accessible_ids)
-                    )
-                }
-                for transfer in transfers
-            ])
+            return jsonify_rows(transfers_query.all())
 
         data = request.get_json() or {}
         product_id = data.get('product_id')
@@ -2426,7 +5370,33 @@ def create_app(config_class=DevelopmentConfig):
             'total_sales': float(total_sales),
             'inventory': [{'name': n, 'quantity': q} for (n, q) in inventory_items]
         })
-    def serialize_customer(customer, include_metrics=False):
+    def load_customer_metrics(customer_ids):
+        customer_ids = list(customer_ids)
+        metrics = {
+            customer_id: {'invoice_count': 0, 'total_spent': 0.0, 'first_purchase': None, 'last_purchase': None}
+            for customer_id in customer_ids
+        }
+        if not customer_ids:
+            return metrics
+
+        stats_query = CustomerStats.query.filter(CustomerStats.customer_id.in_(customer_ids))
+        stats_query = apply_store_filter(stats_query, CustomerStats.store_id)
+        for stats in stats_query.all():
+            entry = metrics[stats.customer_id]
+            entry['invoice_count'] += int(stats.invoice_count or 0)
+            entry['total_spent'] += float(stats.total_spent or 0)
+            if stats.first_purchase and (entry['first_purchase'] is None or stats.first_purchase < entry['first_purchase']):
+                entry['first_purchase'] = stats.first_purchase
+            if stats.last_purchase and (entry['last_purchase'] is None or stats.last_purchase > entry['last_purchase']):
+                entry['last_purchase'] = stats.last_purchase
+
+        for entry in metrics.values():
+            entry['total_spent'] = round(entry['total_spent'], 2)
+            for key in ('first_purchase', 'last_purchase'):
+                entry[key] = entry[key].strftime('%Y-%m-%d %H:%M') if entry[key] else None
+        return metrics
+
+    def serialize_customer(customer, include_metrics=False, metrics=None):
         data = {
             'id': customer.id,
             'name': customer.name,
@@ -2435,61 +5405,97 @@ def create_app(config_class=DevelopmentConfig):
             'created_at': customer.created_at.strftime('%Y-%m-%d %H:%M') if customer.created_at else None
         }
 
-        if include_metrics:
-            metrics_query = db.session.query(
-                func.count(Invoice.id),
-                func.coalesce(func.sum(Invoice.total_amount), 0),
-                func.max(Invoice.created_at)
-            ).filter(Invoice.customer_id == customer.id)
-
-            metrics_query = apply_store_filter(metrics_query, Invoice.store_id)
-            invoice_count, invoice_total, last_purchase = metrics_query.one()
-
-            data.update({
-                'invoice_count': int(invoice_count or 0),
-                'total_spent': float(invoice_total or 0),
-                'last_purchase': last_purchase.strftime('%Y-%m-%d %H:%M') if last_purchase else None
-            })
+        if include_metrics and metrics is None:
+            metrics = load_customer_metrics([customer.id])[customer.id]
+        if metrics is not None:
+            data.update(metrics)
 
         return data
 
-    def serialize_invoice(invoice, detailed=False):
-        items = []
-        for item in invoice.items:
-            entry = {
+    def serialize_invoices(invoice_ids, detailed=False):
+        invoice_ids = list(invoice_ids)
+        if not invoice_ids:
+            return []
+
+        invoice_rows = db.session.query(
+            Invoice.id,
+            Invoice.invoice_number,
+            Invoice.customer_id,
+            Invoice.user_id,
+            Invoice.store_id,
+            Invoice.session_id,
+            Invoice.total_amount,
+            Invoice.payment_method,
+            Invoice.status,
+            Invoice.created_at,
+            Customer.name.label('customer_name'),
+            Store.name.label('store_name'),
+            User.username.label('user_name')
+        ).select_from(Invoice) \
+         .outerjoin(Customer, Invoice.customer_id == Customer.id) \
+         .outerjoin(Store, Invoice.store_id == Store.id) \
+         .outerjoin(User, Invoice.user_id == User.id) \
+         .filter(Invoice.id.in_(invoice_ids)).all()
+
+        positions = {invoice_id: index for index, invoice_id in enumerate(invoice_ids)}
+        invoice_rows.sort(key=lambda row: positions[row.id])
+
+        item_rows = db.session.query(
+            InvoiceItem.id,
+            InvoiceItem.invoice_id,
+            InvoiceItem.product_id,
+            InvoiceItem.quantity,
+            InvoiceItem.unit_price,
+            InvoiceItem.discount,
+            InvoiceItem.line_total,
+            Product.name.label('product_name'),
+            Product.sku.label('product_sku')
+        ).outerjoin(Product, InvoiceItem.product_id == Product.id) \
+         .filter(InvoiceItem.invoice_id.in_(invoice_ids)) \
+         .order_by(InvoiceItem.invoice_id, InvoiceItem.id).all()
+
+        items_by_invoice = defaultdict(list)
+        for item in item_rows:
+            items_by_invoice[item.invoice_id].append({
                 'invoice_item_id': item.id,
-                'product': item.product.name if item.product else 'Producto',
+                'product': item.product_name or 'Producto',
                 'product_id': item.product_id,
-                'product_sku': item.product.sku if item.product else None,
+                'product_sku': item.product_sku,
                 'quantity': item.quantity,
                 'unit_price': float(item.unit_price or 0),
                 'discount': float(item.discount or 0),
                 'line_total': float(item.line_total or 0)
+            })
+
+        invoices = []
+        for row in invoice_rows:
+            data = {
+                'id': row.id,
+                'invoice_number': row.invoice_number,
+                'customer': row.customer_name or 'Consumidor final',
+                'customer_id': row.customer_id,
+                'total_amount': float(row.total_amount or 0),
+                'payment_method': row.payment_method,
+                'created_at': row.created_at.strftime('%Y-%m-%d %H:%M') if row.created_at else None,
+                'status': row.status,
+                'items': items_by_invoice.get(row.id, [])
             }
-            items.append(entry)
 
-        data = {
-            'id': invoice.id,
-            'invoice_number': invoice.invoice_number,
-            'customer': invoice.customer.name if invoice.customer else 'Consumidor final',
-            'customer_id': invoice.customer_id,
-            'total_amount': float(invoice.total_amount or 0),
-            'payment_method': invoice.payment_method,
-            'created_at': invoice.created_at.strftime('%Y-%m-%d %H:%M') if invoice.created_at else None,
-            'status': invoice.status,
-            'items': items
-        }
+            if detailed:
+                data.update({
+                    'store_id': row.store_id,
+                    'store': row.store_name,
+                    'session_id': row.session_id,
+                    'user_id': row.user_id,
+                    'user': row.user_name
+                })
 
-        if detailed:
-            data.update({
-                'store_id': invoice.store_id,
-                'store': invoice.store.name if invoice.store else None,
-                'session_id': invoice.session_id,
-                'user_id': invoice.user_id,
-                'user': invoice.user.username if invoice.user else None
-            })
+            invoices.append(data)
 
-        return data
+        return invoices
+
+    def serialize_invoice(invoice, detailed=False):
+        return serialize_invoices([invoice.id], detailed=detailed)[0]
 
     @app.route('/api/customers', methods=['GET', 'POST'])
     @login_required
@@ -2497,20 +5503,86 @@ def create_app(config_class=DevelopmentConfig):
         ensure_management_access()
         if request.method == 'GET':
             query_value = (request.args.get('query') or '').strip()
+            limit = min(max(request.args.get('limit', 100, type=int), 1), 100)
+            name_key = func.coalesce(Customer.search_name, '')
             base_query = Customer.query
+            rank = literal(0)
 
             if query_value:
-                like_value = f"%{query_value}%"
-                base_query = base_query.filter(
-                    or_(
-                        Customer.name.ilike(like_value),
-                        Customer.email.ilike(like_value),
-                        Customer.phone.ilike(like_value)
-                    )
-                )
+                folded = fold_search_text(query_value)
+                email_value = query_value.lower()
+                digits = phone_to_digits(query_value)
 
-            customers = base_query.order_by(Customer.name.asc()).limit(100).all()
-            return jsonify([serialize_customer(customer) for customer in customers])
+                matches = [
+                    Customer.email_normalized == email_value,
+                    Customer.email_normalized.like(like_prefix(email_value), escape='\\')
+                ]
+                rank_cases = [(Customer.email_normalized == email_value, 0)]
+                if len(digits) >= 3:
+                    matches.append(Customer.phone_digits.like(like_prefix(digits), escape='\\'))
+                    rank_cases.append((Customer.phone_digits == digits, 0))
+                if folded:
+                    token_filters = [
+                        Customer.id.in_(
+                            db.select(CustomerSearchToken.customer_id)
+                            .where(CustomerSearchToken.token.like(like_prefix(token[:50]), escape='\\'))
+                        )
+                        for token in folded.split()
+                    ]
+                    matches.append(and_(*token_filters))
+                    rank_cases.append((Customer.search_name == folded, 1))
+                    rank_cases.append((Customer.search_name.like(like_prefix(folded), escape='\\'), 2))
+
+                base_query = base_query.filter(or_(*matches))
+                rank = case(*rank_cases, else_=3)
+
+            cursor = request.args.get('cursor')
+            if cursor:
+                try:
+                    cursor_rank, cursor_name, cursor_id = decode_cursor(cursor)
+                except ValueError:
+                    return jsonify({'error': 'El cursor de paginación no es válido.'}), 400
+                base_query = base_query.filter(or_(
+                    rank > cursor_rank,
+                    and_(rank == cursor_rank, or_(
+                        name_key > cursor_name,
+                        and_(name_key == cursor_name, Customer.id > cursor_id)
+                    ))
+                ))
+
+            base_query = base_query.outerjoin(CustomerSegment, CustomerSegment.customer_id == Customer.id)
+            segment = (request.args.get('segment') or '').strip()
+            if segment:
+                if segment not in CUSTOMER_SEGMENTS:
+                    return jsonify({'error': 'El segmento solicitado no existe.'}), 400
+                base_query = base_query.filter(CustomerSegment.segment == segment)
+            for argument, column in (('min_r', CustomerSegment.r_score), ('min_f', CustomerSegment.f_score), ('min_m', CustomerSegment.m_score)):
+                min_score = request.args.get(argument, type=int)
+                if min_score:
+                    base_query = base_query.filter(column >= min_score)
+
+            rows = base_query.add_columns(rank.label('rank'), CustomerSegment) \
+                .order_by(rank, name_key, Customer.id) \
+                .limit(limit + 1).all()
+
+            customers = [row[0] for row in rows[:limit]]
+            metrics = load_customer_metrics(customer.id for customer in customers)
+            payload = []
+            for customer, _, customer_segment in rows[:limit]:
+                data = serialize_customer(customer, metrics=metrics[customer.id])
+                data['segment'] = {
+                    'name': customer_segment.segment,
+                    'recency_days': customer_segment.recency_days,
+                    'r': customer_segment.r_score,
+                    'f': customer_segment.f_score,
+                    'm': customer_segment.m_score
+                } if customer_segment else None
+                payload.append(data)
+            response = jsonify(payload)
+            if len(rows) > limit:
+                last_customer, last_rank, _ = rows[limit - 1]
+                response.headers['X-Next-Cursor'] = encode_cursor([last_rank, last_customer.search_name or '', last_customer.id])
+            return response
 
         data = request.get_json(force=True)
         name = (data.get('name') or '').strip()
@@ -2522,6 +5594,7 @@ def create_app(config_class=DevelopmentConfig):
             email=(data.get('email') or '').strip() or None,
             phone=(data.get('phone') or '').strip() or None
         )
+        customer.refresh_search_keys()
         db.session.add(customer)
         db.session.commit()
         return jsonify({'message': 'Cliente registrado correctamente.', 'customer': serialize_customer(customer)}), 201
@@ -2539,6 +5612,7 @@ def create_app(config_class=DevelopmentConfig):
         customer.name = name
         customer.email = (data.get('email') or '').strip() or None
         customer.phone = (data.get('phone') or '').strip() or None
+        customer.refresh_search_keys()
         db.session.commit()
         return jsonify({'message': 'Cliente actualizado correctamente.', 'customer': serialize_customer(customer)})
 
@@ -2547,12 +5621,68 @@ def create_app(config_class=DevelopmentConfig):
     def get_customer_history(customer_id):
         ensure_management_access()
         customer = Customer.query.get_or_404(customer_id)
-        invoices_query = Invoice.query.filter_by(customer_id=customer.id)
+        limit = min(max(request.args.get('limit', 25, type=int), 1), 100)
+        store_id = request.args.get('store_id', type=int)
+        status = (request.args.get('status') or '').strip()
+
+        invoices_query = db.session.query(Invoice.id, Invoice.created_at).filter(Invoice.customer_id == customer.id)
         invoices_query = apply_store_filter(invoices_query, Invoice.store_id)
-        invoices = invoices_query.order_by(Invoice.created_at.desc()).limit(25).all()
+        if store_id:
+            ensure_store_permission(store_id)
+            invoices_query = invoices_query.filter(Invoice.store_id == store_id)
+        if status:
+            invoices_query = invoices_query.filter(Invoice.status == status)
+
+        try:
+            start_param = request.args.get('start_date')
+            end_param = request.args.get('end_date')
+            if start_param:
+                invoices_query = invoices_query.filter(Invoice.created_at >= datetime.strptime(start_param, '%Y-%m-%d'))
+            if end_param:
+                end_date = datetime.strptime(end_param, '%Y-%m-%d') + timedelta(days=1)
+                invoices_query = invoices_query.filter(Invoice.created_at < end_date)
+        except ValueError:
+            return jsonify({'error': 'Las fechas deben tener el formato AAAA-MM-DD.'}), 400
+
+        # Se recorre sobre (created_at, id) para que ix_invoices_customer_created
+        # resuelva la búsqueda y el orden; las facturas sin fecha van al final,
+        # paginadas solo por id (cursor con fecha nula)
+        dated_query = invoices_query.filter(Invoice.created_at.isnot(None))
+        undated_query = invoices_query.filter(Invoice.created_at.is_(None))
+        cursor = request.args.get('cursor')
+        if cursor:
+            try:
+                cursor_created, cursor_id = decode_cursor(cursor)
+                cursor_created = datetime.fromisoformat(cursor_created) if cursor_created is not None else None
+                cursor_id = int(cursor_id)
+            except (ValueError, TypeError):
+                return jsonify({'error': 'El cursor de paginación no es válido.'}), 400
+            if cursor_created is None:
+                dated_query = None
+                undated_query = undated_query.filter(Invoice.id < cursor_id)
+            else:
+                dated_query = dated_query.filter(or_(
+                    Invoice.created_at < cursor_created,
+                    and_(Invoice.created_at == cursor_created, Invoice.id < cursor_id)
+                ))
+
+        rows = []
+        if dated_query is not None:
+            rows = dated_query.order_by(Invoice.created_at.desc(), Invoice.id.desc()).limit(limit + 1).all()
+        if len(rows) <= limit:
+            rows += undated_query.order_by(Invoice.id.desc()).limit(limit + 1 - len(rows)).all()
+        next_cursor = None
+        if len(rows) > limit:
+            last_row = rows[limit - 1]
+            next_cursor = encode_cursor([
+                last_row.created_at.isoformat() if last_row.created_at else None,
+                last_row.id
+            ])
+
         return jsonify({
             'customer': serialize_customer(customer, include_metrics=True),
-            'history': [serialize_invoice(invoice) for invoice in invoices]
+            'history': serialize_invoices(row.id for row in rows[:limit]),
+            'next_cursor': next_cursor
         })
 
     @app.route('/api/pos/products', methods=['GET'])
@@ -2618,7 +5748,10 @@ def create_app(config_class=DevelopmentConfig):
 
         ensure_store_permission(current_session.store_id)
 
-        total_sales = db.session.query(func.sum(Sale.total_amount)).filter(Sale.session_id == current_session.id).scalar() or Decimal('0')
+        total_sales = db.session.query(func.sum(Invoice.total_amount)).filter(
+            Invoice.session_id == current_session.id,
+            Invoice.status != 'void'
+        ).scalar() or Decimal('0')
         return jsonify({
             'session': {
                 'id': current_session.id,
@@ -2683,7 +5816,10 @@ def create_app(config_class=DevelopmentConfig):
         data = request.get_json(force=True)
         closing_amount = Decimal(str(data.get('closing_amount', '0') or '0'))
 
-        total_sales = db.session.query(func.sum(Sale.total_amount)).filter(Sale.session_id == pos_session.id).scalar() or Decimal('0')
+        total_sales = db.session.query(func.sum(Invoice.total_amount)).filter(
+            Invoice.session_id == pos_session.id,
+            Invoice.status != 'void'
+        ).scalar() or Decimal('0')
 
         pos_session.status = 'closed'
         pos_session.closed_at = datetime.utcnow()
@@ -2700,11 +5836,46 @@ def create_app(config_class=DevelopmentConfig):
             }
         })
 
+    def checkout_replay(idempotency_key):
+        record = db.session.get(CheckoutIdempotencyKey, (current_user.id, idempotency_key))
+        if not record:
+            return None
+        response = jsonify({
+            'message': 'La venta ya había sido registrada.',
+            'invoice': serialize_invoices([record.invoice_id])[0]
+        })
+        response.headers['Idempotent-Replayed'] = 'true'
+        return response
+
+    def rollback_checkout():
+        db.session.rollback()
+        discard_invoice_audit()
+
     @app.route('/api/pos/checkout', methods=['POST'])
     @login_required
     def pos_checkout():
         ensure_management_access()
         data = request.get_json(force=True)
+        idempotency_key = (request.headers.get('Idempotency-Key') or '').strip()
+        if not idempotency_key:
+            return process_checkout(data)
+        if len(idempotency_key) > 64:
+            return jsonify({'error': 'La clave de idempotencia no puede superar 64 caracteres.'}), 400
+
+        def attempt():
+            return checkout_replay(idempotency_key) or process_checkout(data, idempotency_key)
+
+        try:
+            return run_with_db_retry(attempt, app.config, cleanup=rollback_checkout)
+        except IntegrityError:
+            # Otra solicitud con la misma clave se confirmó primero
+            rollback_checkout()
+            replay = checkout_replay(idempotency_key)
+            if replay is None:
+                raise
+            return replay
+
+    def process_checkout(data, idempotency_key=None):
         items = data.get('items') or []
         customer_id = data.get('customer_id')
         payment_method = (data.get('payment_method') or 'Efectivo').strip()
@@ -2779,41 +5950,39 @@ def create_app(config_class=DevelopmentConfig):
             db.session.add(invoice_item)
 
             inventory_map[product.id].quantity -= quantity
-
-            sale = Sale(
-                store_id=current_session.store_id,
-                product_id=product.id,
-                quantity=quantity,
-                total_amount=line_total,
-                sale_date=datetime.utcnow(),
-                session_id=current_session.id,
-                invoice_id=invoice.id
-            )
-            db.session.add(sale)
-            processed_items.append({
-                'product_id': product.id,
-                'name': product.name,
-                'quantity': quantity,
-                'unit_price': float(unit_price),
-                'discount': float(discount),
-                'line_total': float(line_total)
-            })
+            processed_items.append(invoice_item)
 
         invoice.total_amount = total_amount
         invoice.invoice_number = f"INV-{datetime.utcnow().strftime('%Y%m%d%H%M%S')}-{invoice.id}"
+        db.session.flush()
+
+        if invoice.customer_id:
+            apply_customer_stats_delta(invoice.customer_id, invoice.store_id, 1, total_amount, invoice.created_at)
 
         record_invoice_audit(
             invoice,
             'create',
             'Factura generada desde el punto de venta.',
             {
-                'items': processed_items,
+                'v': INVOICE_AUDIT_FORMAT,
+                'items': [compact_invoice_line(invoice_item) for invoice_item in processed_items],
                 'total_amount': float(total_amount),
-                'payment_method': payment_method
+                'payment_method': payment_method,
+                'status': invoice.status
             }
         )
 
+        enqueue_sales_projection([invoice.id])
+        flush_invoice_audit()
+        count_on_commit(INVOICES_CREATED, store_id=str(invoice.store_id))
+        if idempotency_key:
+            db.session.add(CheckoutIdempotencyKey(
+                user_id=current_user.id,
+                idempotency_key=idempotency_key,
+                invoice_id=invoice.id
+            ))
         db.session.commit()
+        schedule_sales_projection()
 
         return jsonify({
             'message': 'Venta registrada correctamente.',
@@ -2834,8 +6003,8 @@ def create_app(config_class=DevelopmentConfig):
             Invoice.created_at <= end,
             Invoice.status != 'void'
         )
-        invoices = invoices_query.order_by(Invoice.created_at.desc()).limit(20).all()
-        return jsonify({'invoices': [serialize_invoice(invoice) for invoice in invoices]})
+        invoice_ids = invoices_query.order_by(Invoice.created_at.desc()).limit(20).with_entities(Invoice.id).all()
+        return jsonify({'invoices': serialize_invoices(row.id for row in invoice_ids)})
 
     @app.route('/api/invoices/<int:invoice_id>', methods=['GET', 'PUT'])
     @login_required
@@ -2865,12 +6034,18 @@ def create_app(config_class=DevelopmentConfig):
         for entry in items_payload:
             product_id = entry.get('product_id')
             quantity = entry.get('quantity')
+            invoice_item_id = entry.get('invoice_item_id')
             if not product_id:
                 return jsonify({'error': 'Cada item debe incluir un producto válido.'}), 400
             try:
                 product_id = int(product_id)
             except (TypeError, ValueError):
                 return jsonify({'error': 'El identificador del producto no es válido.'}), 400
+            if invoice_item_id is not None:
+                try:
+                    invoice_item_id = int(invoice_item_id)
+                except (TypeError, ValueError):
+                    return jsonify({'error': 'El identificador de la línea de factura no es válido.'}), 400
             try:
                 quantity = int(quantity)
             except (TypeError, ValueError):
@@ -2902,6 +6077,7 @@ def create_app(config_class=DevelopmentConfig):
             line_total = effective_price * quantity
 
             new_items.append({
+                'invoice_item_id': invoice_item_id,
                 'product_id': product_id,
                 'product_name': product.name,
                 'quantity': quantity,
@@ -2916,41 +6092,59 @@ def create_app(config_class=DevelopmentConfig):
         for item in old_items:
             old_counts[item.product_id] = old_counts.get(item.product_id, 0) + item.quantity
 
-        all_product_ids = set(old_counts) | set(new_counts)
+        item_diff = diff_invoice_items(old_items, new_items)
+        payment_changed = payment_method != invoice.payment_method
+        audit_baseline = None
+        if invoice_audit_needs_baseline(invoice.id):
+            audit_baseline = {
+                'items': [compact_invoice_line(item) for item in old_items],
+                'total_amount': float(invoice.total_amount or 0),
+                'payment_method': invoice.payment_method,
+                'status': invoice.status
+            }
+
+        if not any(item_diff.values()) and not payment_changed:
+            return jsonify({'message': 'La factura no presenta cambios.', 'invoice': serialize_invoice(invoice, detailed=True)})
+
+        stock_deltas = {
+            product_id: new_counts.get(product_id, 0) - old_counts.get(product_id, 0)
+            for product_id in set(old_counts) | set(new_counts)
+        }
+        stock_deltas = {product_id: delta for product_id, delta in stock_deltas.items() if delta}
 
         inventory_records = {}
-        if all_product_ids:
+        if stock_deltas:
             inventories = Inventory.query.filter(
                 Inventory.store_id == invoice.store_id,
-                Inventory.product_id.in_(all_product_ids)
-            ).with_for_update().all()
+                Inventory.product_id.in_(stock_deltas)
+            ).order_by(Inventory.product_id).with_for_update().all()
             inventory_records = {inventory.product_id: inventory for inventory in inventories}
 
-        for product_id in all_product_ids:
+        for product_id, delta in stock_deltas.items():
             inventory = inventory_records.get(product_id)
-            if not inventory:
-                inventory = Inventory(product_id=product_id, store_id=invoice.store_id, quantity=0)
-                db.session.add(inventory)
-                inventory_records[product_id] = inventory
-            available = int(inventory.quantity or 0) + old_counts.get(product_id, 0)
-            required = new_counts.get(product_id, 0)
-            if available < required:
+            if delta > 0 and (not inventory or int(inventory.quantity or 0) < delta):
                 return jsonify({'error': f'Stock insuficiente para el producto {product_id}.'}), 400
 
         try:
-            new_total = Decimal('0')
-
-            Sale.query.filter_by(invoice_id=invoice.id).delete(synchronize_session=False)
-
-            for item in old_items:
+            for product_id, delta in stock_deltas.items():
+                inventory = inventory_records.get(product_id)
+                if not inventory:
+                    inventory = Inventory(product_id=product_id, store_id=invoice.store_id, quantity=0)
+                    db.session.add(inventory)
+                inventory.quantity = int(inventory.quantity or 0) - delta
+
+            previous_lines = [compact_invoice_line(item) for item, _ in item_diff['updated']]
+            for item, entry in item_diff['updated']:
+                item.quantity = entry['quantity']
+                item.unit_price = entry['unit_price']
+                item.discount = entry['discount']
+                item.line_total = entry['line_total']
+
+            for item in item_diff['removed']:
                 db.session.delete(item)
 
-            for product_id, inventory in inventory_records.items():
-                available = int(inventory.quantity or 0) + old_counts.get(product_id, 0)
-                required = new_counts.get(product_id, 0)
-                inventory.quantity = available - required
-
-            for entry in new_items:
+            added_items = []
+            for entry in item_diff['added']:
                 invoice_item = InvoiceItem(
                     invoice_id=invoice.id,
                     product_id=entry['product_id'],
@@ -2960,51 +6154,119 @@ def create_app(config_class=DevelopmentConfig):
                     line_total=entry['line_total']
                 )
                 db.session.add(invoice_item)
+                added_items.append(invoice_item)
 
-                sale = Sale(
-                    store_id=invoice.store_id,
-                    product_id=entry['product_id'],
-                    quantity=entry['quantity'],
-                    total_amount=entry['line_total'],
-                    sale_date=datetime.utcnow(),
-                    session_id=invoice.session_id,
-                    invoice_id=invoice.id
-                )
-                db.session.add(sale)
-
-                new_total += entry['line_total']
-
+            new_total = sum((entry['line_total'] for entry in new_items), Decimal('0'))
+            total_delta = new_total - Decimal(invoice.total_amount or 0)
+            total_changed = total_delta != 0
+            if total_changed and invoice.customer_id and invoice.status != 'void':
+                apply_customer_stats_delta(invoice.customer_id, invoice.store_id, 0, total_delta)
             invoice.total_amount = new_total
             invoice.payment_method = payment_method
+            db.session.flush()
 
-            record_invoice_audit(
-                invoice,
-                'update',
-                'Factura modificada por administrador.',
-                {
-                    'items': [
-                        {
-                            'product_id': entry['product_id'],
-                            'product_name': entry['product_name'],
-                            'quantity': entry['quantity'],
-                            'unit_price': float(entry['unit_price']),
-                            'discount': float(entry['discount']),
-                            'line_total': float(entry['line_total'])
-                        }
-                        for entry in new_items
-                    ],
-                    'total_amount': float(new_total),
-                    'payment_method': payment_method
-                }
-            )
-
+            audit_payload = {'v': INVOICE_AUDIT_FORMAT}
+            if audit_baseline:
+                audit_payload['baseline'] = audit_baseline
+            if added_items:
+                audit_payload['added'] = [compact_invoice_line(invoice_item) for invoice_item in added_items]
+            if item_diff['updated']:
+                audit_payload['updated'] = []
+                for (item, _), before in zip(item_diff['updated'], previous_lines):
+                    after = compact_invoice_line(item)
+                    change = {field: after[field] for field in INVOICE_LINE_FIELDS if after[field] != before[field]}
+                    audit_payload['updated'].append({'id': item.id, **change})
+            if item_diff['removed']:
+                audit_payload['removed'] = [item.id for item in item_diff['removed']]
+            if total_changed:
+                audit_payload['total_amount'] = float(new_total)
+            if payment_changed:
+                audit_payload['payment_method'] = payment_method
+
+            record_invoice_audit(invoice, 'update', 'Factura modificada por administrador.', audit_payload)
+
+            if any(item_diff.values()):
+                enqueue_sales_projection([invoice.id])
+            flush_invoice_audit()
             db.session.commit()
         except Exception:
             db.session.rollback()
+            discard_invoice_audit()
             return jsonify({'error': 'No se pudo actualizar la factura. Revisa los datos ingresados.'}), 500
 
+        schedule_sales_projection()
+
         return jsonify({'message': 'Factura actualizada correctamente.', 'invoice': serialize_invoice(invoice, detailed=True)})
 
+    def void_invoices(invoices):
+        invoice_ids = [invoice.id for invoice in invoices]
+        invoice_map = {invoice.id: invoice for invoice in invoices}
+        item_rows = db.session.query(
+            InvoiceItem.invoice_id,
+            InvoiceItem.product_id,
+            func.sum(InvoiceItem.quantity).label('quantity')
+        ).filter(InvoiceItem.invoice_id.in_(invoice_ids)) \
+         .group_by(InvoiceItem.invoice_id, InvoiceItem.product_id).all()
+
+        restock = defaultdict(int)
+        for row in item_rows:
+            store_id = invoice_map[row.invoice_id].store_id
+            restock[(store_id, row.product_id)] += int(row.quantity or 0)
+
+        inventory_records = {}
+        if restock:
+            store_ids = {store_id for store_id, _ in restock}
+            product_ids = {product_id for _, product_id in restock}
+            inventories = Inventory.query.filter(
+                Inventory.store_id.in_(store_ids),
+                Inventory.product_id.in_(product_ids)
+            ).order_by(Inventory.store_id, Inventory.product_id).with_for_update().all()
+            inventory_records = {
+                (inventory.store_id, inventory.product_id): inventory
+                for inventory in inventories
+                if (inventory.store_id, inventory.product_id) in restock
+            }
+
+        for key, quantity in restock.items():
+            inventory = inventory_records.get(key)
+            if not inventory:
+                inventory = Inventory(store_id=key[0], product_id=key[1], quantity=0)
+                db.session.add(inventory)
+                inventory_records[key] = inventory
+            inventory.quantity = int(inventory.quantity or 0) + quantity
+
+        if item_rows:
+            db.session.execute(db.insert(InventoryMovement), [
+                {
+                    'product_id': row.product_id,
+                    'store_id': invoice_map[row.invoice_id].store_id,
+                    'quantity': int(row.quantity or 0),
+                    'movement_type': 'entry',
+                    'performed_by': current_user.id,
+                    'notes': f'Reingreso por anulación de factura {invoice_map[row.invoice_id].invoice_number}'[:255],
+                    'created_at': datetime.utcnow()
+                }
+                for row in item_rows
+            ])
+            count_on_commit(INVENTORY_MOVEMENTS, len(item_rows), movement_type='entry')
+
+        enqueue_sales_projection(invoice_ids)
+
+        for invoice in invoices:
+            invoice.status = 'void'
+            count_on_commit(INVOICES_VOIDED, store_id=str(invoice.store_id))
+            record_invoice_audit(
+                invoice,
+                'void',
+                'Factura anulada por administrador.',
+                {'v': INVOICE_AUDIT_FORMAT, 'status': 'void'}
+            )
+
+        db.session.flush()
+        update_stock_alerts_bulk(list(inventory_records.values()))
+        refresh_customer_stats(invoice.customer_id for invoice in invoices)
+        flush_invoice_audit()
+
     @app.route('/api/invoices/<int:invoice_id>/void', methods=['POST'])
     @login_required
     def void_invoice(invoice_id):
@@ -3015,21 +6277,59 @@ def create_app(config_class=DevelopmentConfig):
         if invoice.status == 'void':
             return jsonify({'error': 'La factura ya está anulada.'}), 400
 
-        for item in invoice.items:
-            inventory = Inventory.query.filter_by(product_id=item.product_id, store_id=invoice.store_id).with_for_update().first()
-            if not inventory:
-                inventory = Inventory(product_id=item.product_id, store_id=invoice.store_id, quantity=0)
-                db.session.add(inventory)
-            inventory.quantity = int(inventory.quantity or 0) + item.quantity
+        void_invoices([invoice])
+
+        db.session.commit()
+        schedule_sales_projection()
+        return jsonify({'message': 'Factura anulada correctamente.', 'invoice': serialize_invoice(invoice, detailed=True)})
 
-        Sale.query.filter_by(invoice_id=invoice.id).delete(synchronize_session=False)
+    @app.route('/api/invoices/void', methods=['POST'])
+    @login_required
+    def bulk_void_invoices():
+        ensure_invoice_edit_permission()
+        data = request.get_json(force=True)
+        raw_ids = data.get('invoice_ids') or []
+        if not isinstance(raw_ids, list) or not raw_ids:
+            return jsonify({'error': 'Debe indicar las facturas a anular.'}), 400
 
-        invoice.status = 'void'
+        try:
+            requested_ids = list(dict.fromkeys(int(invoice_id) for invoice_id in raw_ids))
+        except (TypeError, ValueError):
+            return jsonify({'error': 'Los identificadores de factura no son válidos.'}), 400
 
-        record_invoice_audit(invoice, 'void', 'Factura anulada por administrador.')
+        limit = app.config['BULK_VOID_LIMIT']
+        if len(requested_ids) > limit:
+            return jsonify({'error': f'Solo se pueden anular hasta {limit} facturas por solicitud.'}), 400
 
-        db.session.commit()
-        return jsonify({'message': 'Factura anulada correctamente.', 'invoice': serialize_invoice(invoice, detailed=True)})
+        invoices = {
+            invoice.id: invoice
+            for invoice in Invoice.query.filter(Invoice.id.in_(requested_ids)).order_by(Invoice.id).all()
+        }
+        store_ids = get_accessible_store_ids()
+
+        to_void = []
+        skipped = []
+        for invoice_id in requested_ids:
+            invoice = invoices.get(invoice_id)
+            if not invoice:
+                skipped.append({'invoice_id': invoice_id, 'error': 'Factura no encontrada.'})
+            elif store_ids is not None and invoice.store_id not in store_ids:
+                skipped.append({'invoice_id': invoice_id, 'error': 'No autorizado para esta sucursal.'})
+            elif invoice.status == 'void':
+                skipped.append({'invoice_id': invoice_id, 'error': 'La factura ya está anulada.'})
+            else:
+                to_void.append(invoice)
+
+        if to_void:
+            void_invoices(to_void)
+            db.session.commit()
+            schedule_sales_projection()
+
+        return jsonify({
+            'message': f'{len(to_void)} facturas anuladas correctamente.',
+            'voided': [invoice.id for invoice in to_void],
+            'skipped': skipped
+        })
 
     @app.route('/api/invoices/<int:invoice_id>/logs', methods=['GET'])
     @login_required
@@ -3037,8 +6337,75 @@ def create_app(config_class=DevelopmentConfig):
         ensure_invoice_edit_permission()
         invoice = Invoice.query.get_or_404(invoice_id)
         ensure_store_permission(invoice.store_id)
-        logs = InvoiceAuditLog.query.filter_by(invoice_id=invoice.id).order_by(InvoiceAuditLog.created_at.desc()).all()
-        return jsonify({'logs': [serialize_audit_log(entry) for entry in logs]})
+        page = max(request.args.get('page', 1, type=int), 1)
+        per_page = min(max(request.args.get('per_page', 20, type=int), 1), 100)
+
+        entry_ids = [
+            row.id for row in db.session.query(InvoiceAuditLog.id)
+            .filter(InvoiceAuditLog.invoice_id == invoice.id)
+            .order_by(InvoiceAuditLog.created_at.asc(), InvoiceAuditLog.id.asc())
+        ]
+        total = len(entry_ids)
+        end = max(total - (page - 1) * per_page, 0)
+        start = max(end - per_page, 0)
+
+        page_entries = []
+        if end > start:
+            # La reconstrucción parte del último estado completo en o antes de la página
+            origin = start + 1
+            while origin > 0:
+                batch_start = max(origin - INVOICE_AUDIT_CHECKPOINT_EVERY, 0)
+                batch = dict(
+                    db.session.query(InvoiceAuditLog.id, InvoiceAuditLog.metadatas)
+                    .filter(InvoiceAuditLog.id.in_(entry_ids[batch_start:origin])).all()
+                )
+                found = next(
+                    (index for index in range(origin - 1, batch_start - 1, -1)
+                     if is_full_audit_state(batch[entry_ids[index]])),
+                    None
+                )
+                origin = batch_start if found is None else found
+                if found is not None:
+                    break
+
+            entries = db.session.query(
+                InvoiceAuditLog.id,
+                InvoiceAuditLog.action,
+                InvoiceAuditLog.description,
+                InvoiceAuditLog.metadatas,
+                InvoiceAuditLog.created_at,
+                User.username.label('username')
+            ).outerjoin(User, InvoiceAuditLog.user_id == User.id) \
+             .filter(InvoiceAuditLog.id.in_(entry_ids[origin:end])) \
+             .order_by(InvoiceAuditLog.created_at.asc(), InvoiceAuditLog.id.asc()).all()
+
+            snapshots = []
+            snapshot = None
+            for entry in entries:
+                snapshot = apply_invoice_audit_delta(snapshot, entry.metadatas)
+                snapshots.append(snapshot)
+            page_entries = list(zip(entries[start - origin:], snapshots[start - origin:]))[::-1]
+
+        product_ids = {
+            line.get('product_id')
+            for _, page_snapshot in page_entries
+            for line in (page_snapshot or {}).get('items', [])
+        }
+        product_names = {}
+        if product_ids:
+            product_names = dict(
+                db.session.query(Product.id, Product.name).filter(Product.id.in_(product_ids)).all()
+            )
+
+        return jsonify({
+            'logs': [serialize_audit_log(entry, page_snapshot, product_names) for entry, page_snapshot in page_entries],
+            'pagination': {
+                'page': page,
+                'per_page': per_page,
+                'total': total,
+                'pages': (total + per_page - 1) // per_page
+            }
+        })
 
     @app.route('/invoices/<int:invoice_id>/pdf', methods=['GET'])
     @login_required
@@ -3046,28 +6413,30 @@ def create_app(config_class=DevelopmentConfig):
         ensure_management_access()
         invoice = Invoice.query.get_or_404(invoice_id)
         ensure_store_permission(invoice.store_id)
+        invoice_data = serialize_invoice(invoice, detailed=True)
 
         lines = [
-            f'Fecha: {invoice.created_at.strftime("%Y-%m-%d %H:%M") if invoice.created_at else "N/A"}',
-            f'Sucursal: {invoice.store.name if invoice.store else "General"}',
-            f'Cliente: {invoice.customer.name if invoice.customer else "Consumidor final"}',
-            f'Vendedor: {invoice.user.username if invoice.user else "N/A"}',
-            f'Método de pago: {invoice.payment_method or "N/A"}',
-            f'Estado: {invoice.status}'
+            f'Fecha: {invoice_data["created_at"] or "N/A"}',
+            f'Sucursal: {invoice_data["store"] or "General"}',
+            f'Cliente: {invoice_data["customer"]}',
+            f'Vendedor: {invoice_data["user"] or "N/A"}',
+            f'Método de pago: {invoice_data["payment_method"] or "N/A"}',
+            f'Estado: {invoice_data["status"]}'
         ]
 
         total_discount = Decimal('0')
         lines.append('')
         lines.append('Detalle de productos:')
-        for item in invoice.items:
-            discount = Decimal(item.discount or 0)
-            total_discount += discount * item.quantity
-            lines.append(f'- {item.quantity} x {item.product.name if item.product else "Producto"}')
-            item_line = f'  Precio: ${Decimal(item.unit_price or 0):.2f}'
+        for item in invoice_data['items']:
+            unit_price = Decimal(str(item['unit_price']))
+            discount = Decimal(str(item['discount']))
+            total_discount += discount * item['quantity']
+            lines.append(f'- {item["quantity"]} x {item["product"]}')
+            item_line = f'  Precio: ${unit_price:.2f}'
             if discount:
-                item_line += f' | Descuento: ${discount:.2f} | Neto: ${(Decimal(item.unit_price or 0) - discount):.2f}'
+                item_line += f' | Descuento: ${discount:.2f} | Neto: ${(unit_price - discount):.2f}'
             lines.append(item_line)
-            lines.append(f'  Total línea: ${Decimal(item.line_total or 0):.2f}')
+            lines.append(f'  Total línea: ${Decimal(str(item["line_total"])):.2f}')
 
         lines.append('')
         lines.append(f'Descuentos aplicados: ${total_discount:.2f}')
@@ -3189,10 +6558,100 @@ def create_app(config_class=DevelopmentConfig):
         filename = f'cierre_{report["date"]}.csv'
         return send_file(csv_bytes, as_attachment=True, download_name=filename, mimetype='text/csv')
 
+    @app.after_request
+    def compress_response(response):
+        levels = app.config['COMPRESSION_LEVELS'].get(response.mimetype)
+        if not app.config['COMPRESSION_ENABLED'] or not levels or request.method == 'HEAD':
+            return response
+        response.vary.add('Accept-Encoding')
+        if response.status_code < 200 or response.status_code in (204, 206, 304) \
+                or 'Content-Encoding' in response.headers \
+                or 'no-transform' in response.headers.get('Cache-Control', ''):
+            return response
+        if response.content_length is not None and response.content_length < app.config['COMPRESSION_MIN_SIZE']:
+            return response
+        encoding = negotiate_encoding(
+            request.accept_encodings,
+            [encoding for encoding in app.config['COMPRESSION_ENCODINGS'] if encoding in levels]
+        )
+        if encoding is None:
+            return response
+
+        etag, weak = response.get_etag()
+        if etag:
+            # send_file comparó If-None-Match con la ETag sin sufijo: se repite
+            # la comparación con la ETag de esta codificación antes de comprimir
+            response.set_etag(f'{etag}-{encoding}', weak=weak)
+            response.make_conditional(request)
+            if response.status_code == 304:
+                # El cuerpo no se envía; se cierra el archivo que abrió send_file
+                if hasattr(response.response, 'close'):
+                    response.response.close()
+                response.response = []
+                return response
+
+        if response.is_streamed or response.direct_passthrough:
+            response.response = compress_chunks(
+                response.response, encoding, levels[encoding], response.mimetype,
+                flush_size=app.config['COMPRESSION_STREAM_FLUSH_SIZE']
+            )
+            response.direct_passthrough = False
+            response.headers.pop('Content-Length', None)
+            response.headers.pop('Accept-Ranges', None)
+        else:
+            data = response.get_data()
+            started = time.perf_counter()
+            compressed = compress_body(data, encoding, levels[encoding])
+            elapsed = time.perf_counter() - started
+            if len(compressed) >= len(data):
+                return response
+            record_compression(encoding, response.mimetype, len(data), len(compressed), elapsed)
+            response.set_data(compressed)
+
+        response.headers['Content-Encoding'] = encoding
+        return response
+
+    app.extensions['static_manifest'] = load_static_manifest(app.static_folder) if app.config['STATIC_FINGERPRINTS'] else {}
+
+    @app.url_defaults
+    def fingerprinted_static_url(endpoint, values):
+        # url_for('static', filename='js/sales.js') resuelve la versión con huella si existe
+        if endpoint == 'static':
+            values['filename'] = app.extensions['static_manifest'].get(values.get('filename'), values.get('filename'))
+
+    @app.after_request
+    def cache_fingerprinted_assets(response):
+        filename = (request.view_args or {}).get('filename', '') if request.endpoint == 'static' else ''
+        if filename.startswith(STATIC_BUILD_DIR + '/') and not filename.endswith(STATIC_MANIFEST) \
+                and response.status_code in (200, 304):
+            response.cache_control.no_cache = None
+            response.cache_control.public = True
+            response.cache_control.max_age = app.config['STATIC_IMMUTABLE_MAX_AGE']
+            response.cache_control.immutable = True
+        return response
+
+    def rollback_read_retry():
+        db.session.rollback()
+        # Si falla la réplica, el reintento se hace contra el primario
+        if db.session().info.pop('use_replica', None):
+            g.db_route = 'primary'
+
+    def with_read_retry(view):
+        @wraps(view)
+        def retrying_view(*args, **kwargs):
+            if request.method not in ('GET', 'HEAD'):
+                return view(*args, **kwargs)
+            return run_with_db_retry(lambda: view(*args, **kwargs), app.config, cleanup=rollback_read_retry)
+        return retrying_view
+
+    for endpoint, view in list(app.view_functions.items()):
+        if endpoint != 'static':
+            app.view_functions[endpoint] = with_read_retry(view)
+
     return app
 
 if __name__ == '__main__':
-    app = create_app()
+    app = create_app(get_config())
     with app.app_context():
         db.create_all()
     app.run(debug=True)
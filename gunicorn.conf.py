@@ -0,0 +1,16 @@
+import os
+import shutil
+
+# Directorio compartido por los workers para las métricas de Prometheus
+os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', '/tmp/sisinfo_prometheus')
+
+
+def on_starting(server):
+    directory = os.environ['PROMETHEUS_MULTIPROC_DIR']
+    shutil.rmtree(directory, ignore_errors=True)
+    os.makedirs(directory, exist_ok=True)
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
@@ -7,5 +7,8 @@ apt-get install -y unixodbc-dev unixodbc g++
 # Instalar las dependencias de Python
 pip install -r requirements.txt
 
+# Generar los archivos estáticos minificados y con huella (static/dist)
+flask --app "app:create_app()" build-assets --clean
+
 # Iniciar la aplicación
-gunicorn --bind=0.0.0.0 --timeout 600 app:app
\ No newline at end of file
+gunicorn -c gunicorn.conf.py --bind=0.0.0.0 --timeout 600 app:app
\ No newline at end of file
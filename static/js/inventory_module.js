@@ -157,6 +157,17 @@
       });
   }
 
+  function formatDateTime(value) {
+    // Fechas ISO 8601 (2024-05-01T14:30:00) como 2024-05-01 14:30; otros formatos se muestran tal cual
+    return value ? value.replace(/^(\d{4}-\d{2}-\d{2})T(\d{2}:\d{2}).*$/, '$1 $2') : '—';
+  }
+
+  function transferStatusLabel(transfer) {
+    // Los estados sin etiqueta en el servidor llegan tal cual: se capitalizan como str.title()
+    if (transfer.status_label !== transfer.status) return transfer.status_label;
+    return (transfer.status || '').toLowerCase().replace(/(^|[^a-z])([a-z])/g, (match, separator, letter) => separator + letter.toUpperCase());
+  }
+
   function formatProductLabel(product) {
     const sku = product.sku ? product.sku : 'SKU sin asignar';
     return `${product.name} (${sku})`;
@@ -651,7 +662,7 @@
             <span class="transfer-product">${transfer.product_name}</span>
             <small class="transfer-sku">${transfer.sku || ''}</small>
           </div>
-          <span class="status-pill ${transfer.status}">${transfer.status_label}</span>
+          <span class="status-pill ${transfer.status}">${transferStatusLabel(transfer)}</span>
         </header>
         <div class="transfer-body">
           <div>
@@ -672,7 +683,7 @@
         <footer class="transfer-footer">
           <div class="transfer-meta">
             <span>Solicitado por: ${transfer.requested_by || '—'}</span>
-            <span>Fecha: ${transfer.requested_at}</span>
+            <span>Fecha: ${formatDateTime(transfer.requested_at)}</span>
           </div>
           <div class="transfer-actions">
             ${transfer.can_approve ? '<button class="btn-secondary" data-action="approve">Aprobar</button>' : ''}
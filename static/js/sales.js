@@ -733,6 +733,7 @@
         }
         const payload = {
             items: state.invoiceEditor.items.map((item) => ({
+                invoice_item_id: item.invoice_item_id,
                 product_id: item.product_id,
                 quantity: item.quantity,
                 unit_price: item.unit_price,